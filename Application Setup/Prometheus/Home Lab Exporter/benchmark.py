@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""Offline benchmark for the Home Lab Exporter
+
+Runs the exporter in-process against fake backends: a synthetic /srv tree, a
+stub Docker socket and cgroup tree, a stub systemctl and speedtest, local ping
+targets and (unless --real-psutil) a fake psutil describing a host of the given
+size. Measures full collection latency, /metrics latency and throughput under
+concurrent scrapers, and CPU and peak RSS, then writes the results as JSON.
+
+    python3 benchmark.py --output before.json
+    python3 benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import socket
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import http.client
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler
+
+
+def install_fake_psutil(cores, interfaces):
+    """Register a psutil stand-in with deterministic, steadily increasing counters"""
+    fake = types.ModuleType('psutil')
+    started = time.monotonic()
+    cpu_times = namedtuple('scputimes', 'user nice system idle iowait irq softirq steal guest guest_nice')
+    net_io = namedtuple('snetio', 'bytes_sent bytes_recv packets_sent packets_recv errin errout dropin dropout')
+    memory = namedtuple('svmem', 'total available percent used free')
+    disk = namedtuple('sdiskusage', 'total used free percent')
+    process_cpu = namedtuple('pcputimes', 'user system children_user children_system')
+    process_memory = namedtuple('pmem', 'rss vms')
+
+    class AccessDenied(Exception):
+        pass
+
+    def elapsed():
+        return time.monotonic() - started
+
+    def fake_cpu_times(percpu=False):
+        t = elapsed() * 100
+        times = [cpu_times(t * 0.2, 0, t * 0.1, t * 0.65, t * 0.05, 0, 0, 0, 0, 0) for _ in range(cores)]
+        return times if percpu else times[0]
+
+    def fake_net_io_counters(pernic=False):
+        t = elapsed()
+        counters = {f'eth{i}': net_io(int(t * 125_000), int(t * 1_250_000), int(t * 100), int(t * 1000), 0, 0, 0, 0)
+                    for i in range(interfaces)}
+        counters['lo'] = net_io(0, 0, 0, 0, 0, 0, 0, 0)
+        if pernic:
+            return counters
+        return net_io(*(sum(values) for values in zip(*counters.values())))
+
+    class Process:
+        """Reports the real process from /proc, so RSS and fds are still measured"""
+
+        def oneshot(self):
+            return open(os.devnull)
+
+        def cpu_times(self):
+            times = os.times()
+            return process_cpu(times.user, times.system, times.children_user, times.children_system)
+
+        def memory_info(self):
+            with open('/proc/self/statm') as f:
+                size, rss = (int(field) * resource.getpagesize() for field in f.read().split()[:2])
+            return process_memory(rss, size)
+
+        def num_fds(self):
+            return len(os.listdir('/proc/self/fd'))
+
+        def num_threads(self):
+            return threading.active_count()
+
+    fake.AccessDenied = AccessDenied
+    fake.Process = Process
+    fake.cpu_times = fake_cpu_times
+    fake.net_io_counters = fake_net_io_counters
+    fake.virtual_memory = lambda: memory(16 << 30, 8 << 30, 50.0, 8 << 30, 8 << 30)
+    fake.disk_usage = lambda path: disk(1 << 40, 1 << 39, 1 << 39, 50.0)
+    sys.modules['psutil'] = fake
+
+
+def build_srv_tree(root, apps, dirs, files, file_size):
+    """Create apps x dirs x files files of file_size bytes (sparse, so disk use stays small)"""
+    for app in range(apps):
+        for directory in range(dirs):
+            path = os.path.join(root, f'app{app}', f'dir{directory}')
+            os.makedirs(path)
+            for number in range(files):
+                with open(os.path.join(path, f'file{number}'), 'wb') as f:
+                    f.truncate(file_size)
+
+
+def build_cgroup_tree(root, container_ids):
+    """Create a cgroup v2 tree with a systemd-driver scope per container, all pointing at this process"""
+    with open(os.path.join(root, 'cgroup.controllers'), 'w') as f:
+        f.write('cpu io memory pids\n')
+    files = {
+        'cpu.stat': 'usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\nnr_periods 0\n'
+                    'nr_throttled 0\nthrottled_usec 0\n',
+        'memory.current': '104857600\n',
+        'memory.max': 'max\n',
+        'memory.stat': 'anon 50000000\nfile 40000000\nkernel 1000000\nshmem 0\n',
+        'io.stat': '8:0 rbytes=1000 wbytes=2000 rios=10 wios=20 dbytes=0 dios=0\n',
+        'cgroup.procs': f'{os.getpid()}\n',
+    }
+    for container_id in container_ids:
+        scope = os.path.join(root, 'system.slice', f'docker-{container_id}.scope')
+        os.makedirs(scope)
+        for name, content in files.items():
+            with open(os.path.join(scope, name), 'w') as f:
+                f.write(content)
+
+
+def start_docker_stub(socket_path, containers):
+    """Serve /containers/json and an idle /events stream on a Unix socket"""
+    body = json.dumps([{'Id': container_id, 'Names': [f'/{name}'], 'State': 'running',
+                        'HostConfig': {'NetworkMode': 'bridge'}}
+                       for name, container_id in containers.items()]).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def address_string(self):
+            return 'docker-stub'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.startswith('/events'):
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.wfile.flush()
+                # No events, the stream stays open until the client gives up
+                time.sleep(3600)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    server = Server(socket_path, Handler)
+    threading.Thread(target=server.serve_forever, name='docker-stub', daemon=True).start()
+    return server
+
+
+def start_tcp_target():
+    """Listen on a local port for the TCP fallback of the latency prober"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            conn.close()
+
+    threading.Thread(target=accept, name='tcp-target', daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def percentiles(samples) -> dict:
+    """Return count, mean, p50, p99 and max in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def at(q):
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {'count': len(ordered), 'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+            'p50_ms': round(at(0.5), 3), 'p99_ms': round(at(0.99), 3), 'max_ms': round(ordered[-1] * 1000, 3)}
+
+
+def cpu_seconds() -> float:
+    times = os.times()
+    return times.user + times.system
+
+
+def bench_collect(exporter, iterations) -> dict:
+    """Time full synchronous collections (every enabled collector, then render)"""
+    latencies = []
+    cpu_started = cpu_seconds()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        exporter.collect_all_metrics()
+        latencies.append(time.perf_counter() - started)
+    result = percentiles(latencies)
+    result['cpu_ms_per_collection'] = round((cpu_seconds() - cpu_started) / iterations * 1000, 3)
+    return result
+
+
+def bench_scrape(port, concurrency, duration, headers) -> dict:
+    """Scrape /metrics from concurrency keep-alive clients for duration seconds"""
+    latencies = []
+    errors = [0]
+    body_bytes = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def scraper():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        own = []
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                conn.request('GET', '/metrics', headers=headers)
+                response = conn.getresponse()
+                size = len(response.read())
+                if response.status != 200:
+                    raise OSError(f'HTTP {response.status}')
+            except Exception:
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                with lock:
+                    errors[0] += 1
+                continue
+            own.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(own)
+            body_bytes[0] = size if own else body_bytes[0]
+
+    cpu_started = cpu_seconds()
+    wall_started = time.monotonic()
+    threads = [threading.Thread(target=scraper, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.monotonic() - wall_started
+
+    result = percentiles(latencies)
+    result.update(concurrency=concurrency, errors=errors[0], body_bytes=body_bytes[0],
+                  requests_per_second=round(len(latencies) / wall, 1),
+                  # Includes the background collectors and the scraper threads themselves
+                  cpu_ms_per_scrape=round((cpu_seconds() - cpu_started) / max(len(latencies), 1) * 1000, 3))
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip()
+    except (OSError, subprocess.TimeoutExpired):
+        return ''
+
+
+def compare(baseline, results):
+    """Print every numeric result next to the baseline's, with the relative change"""
+    def flatten(prefix, value, out):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                flatten(f'{prefix}.{key}' if prefix else key, item, out)
+        elif isinstance(value, list):
+            for item in value:
+                flatten(f"{prefix}[c={item.get('concurrency')}]", item, out)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[prefix] = value
+        return out
+
+    old = flatten('', baseline['results'], {})
+    new = flatten('', results['results'], {})
+    print(f"{'metric':<48} {baseline.get('commit') or 'baseline':>12} {results.get('commit') or 'current':>12}"
+          f" {'change':>8}")
+    for key in new:
+        if key not in old:
+            continue
+        change = f'{(new[key] - old[key]) / old[key]:+.1%}' if old[key] else ''
+        print(f'{key:<48} {old[key]:>12} {new[key]:>12} {change:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--apps', type=int, default=10, help='App directories under the fake /srv')
+    parser.add_argument('--dirs', type=int, default=20, help='Directories per app')
+    parser.add_argument('--files', type=int, default=50, help='Files per directory')
+    parser.add_argument('--file-size', type=int, default=1 << 20, help='Apparent size of each file in bytes')
+    parser.add_argument('--containers', type=int, default=20, help='Containers behind the stub Docker socket')
+    parser.add_argument('--cores', type=int, default=8, help='CPU cores reported by the fake psutil')
+    parser.add_argument('--interfaces', type=int, default=4, help='NICs reported by the fake psutil')
+    parser.add_argument('--real-psutil', action='store_true', help='Measure against the real psutil instead')
+    parser.add_argument('--iterations', type=int, default=50, help='Full collections to time')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per concurrency level')
+    parser.add_argument('--concurrency', default='1,4,16', help='Comma separated concurrent scraper counts')
+    parser.add_argument('--plain', action='store_true', help='Scrape plain text instead of gzipped OpenMetrics')
+    parser.add_argument('--output', default='benchmark-results.json', help='Where to write the JSON results')
+    parser.add_argument('--compare', metavar='BASELINE', help='Results file to compare against')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    if not args.real_psutil:
+        install_fake_psutil(args.cores, args.interfaces)
+
+    workdir = tempfile.mkdtemp(prefix='homelab-exporter-bench-')
+    try:
+        srv = os.path.join(workdir, 'srv')
+        build_srv_tree(srv, args.apps, args.dirs, args.files, args.file_size)
+        containers = {f'container{number}': f'{number:064x}' for number in range(args.containers)}
+        cgroup_root = os.path.join(workdir, 'cgroup')
+        os.makedirs(cgroup_root)
+        build_cgroup_tree(cgroup_root, containers.values())
+        docker_socket = os.path.join(workdir, 'docker.sock')
+        start_docker_stub(docker_socket, containers)
+        tcp_port = start_tcp_target()
+
+        # systemctl answers from a stub on PATH, as it would for a running unit
+        bin_dir = os.path.join(workdir, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'systemctl'), 'w') as f:
+            f.write('#!/bin/sh\necho active\n')
+        os.chmod(os.path.join(bin_dir, 'systemctl'), 0o755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import homelab_exporter as exporter
+
+        exporter.docker_client.socket_path = docker_socket
+        exporter.speedtest_worker.state_file = os.path.join(workdir, 'speedtest.json')
+        exporter.speedtest_worker.command = [sys.executable, '-c', 'import json; print(json.dumps({'
+                                             '"download_mbps": 940.1, "upload_mbps": 35.2, "server_id": "1",'
+                                             '"server_name": "stub", "ping_ms": 4.2}))']
+
+        config = json.loads(json.dumps(exporter.DEFAULT_CONFIG))
+        collectors = config['collectors']
+        collectors['disk']['path'] = srv
+        collectors['app_disk']['base_path'] = srv
+        collectors['network_latency'].update(targets=['127.0.0.1'], tcp_port=tcp_port)
+        collectors['internet']['targets'] = ['127.0.0.1']
+        collectors['containers']['cgroup_root'] = cgroup_root
+        # No system bus here, so tailscale falls back to the systemctl stub
+        collectors['systemd']['enabled'] = False
+        names = list(containers)
+        collectors['services']['service_groups'] = {f'service{number}': names[number:number + 2]
+                                                    for number in range(0, len(names), 2)}
+
+        # Cold walk of the synthetic tree, then the cost of a warm pass
+        engine = exporter.DirectorySizeEngine(srv, use_inotify=False)
+        started = time.perf_counter()
+        engine.refresh(budget=3600)
+        cold_walk = time.perf_counter() - started
+        started = time.perf_counter()
+        engine.refresh(budget=3600)
+        warm_walk = time.perf_counter() - started
+
+        exporter.speedtest_worker.run_once()
+        exporter.cpu_monitor.prime()
+        exporter.apply_config(config)
+        exporter.app_disk_engine.refresh(budget=3600)
+        exporter.collect_all_metrics()
+
+        results = {
+            'app_disk': {'files': args.apps * args.dirs * args.files, 'cold_walk_ms': round(cold_walk * 1000, 3),
+                         'warm_walk_ms': round(warm_walk * 1000, 3)},
+            'collect': bench_collect(exporter, args.iterations),
+        }
+
+        server = exporter.PooledHTTPServer(('127.0.0.1', 0), exporter.MetricsHandler,
+                                           max_workers=config['server']['max_workers'])
+        threading.Thread(target=server.serve_forever, name='http-server', daemon=True).start()
+        headers = {} if args.plain else {'Accept': 'application/openmetrics-text; version=1.0.0',
+                                         'Accept-Encoding': 'gzip'}
+        results['scrape'] = [bench_scrape(server.server_address[1], int(level), args.duration, headers)
+                             for level in args.concurrency.split(',')]
+        server.shutdown()
+
+        # ru_maxrss is in KiB on Linux
+        results['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        profiler = exporter.self_profiler
+        results['collectors'] = {
+            name: {'runs': wall.count, 'mean_wall_ms': round(wall.sum / wall.count * 1000, 3),
+                   'mean_cpu_ms': round(profiler.collector_cpu[name].sum / wall.count * 1000, 3)}
+            for name, wall in sorted(profiler.collector_wall.items()) if wall.count
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'psutil': 'real' if args.real_psutil else 'fake',
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(json.dumps(output['results'], indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == '__main__':
+    main()
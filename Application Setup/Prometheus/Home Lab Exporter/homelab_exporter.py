@@ -2,152 +2,834 @@
 
 import psutil
 import os
+import copy
+import signal
+import errno
+import struct
+import socket
+import json
+import base64
+import http.client
+import urllib.parse
+import math
+import bisect
+import re
+import fnmatch
+import random
+import queue
+import atexit
+from collections import deque
+from datetime import datetime, timedelta
+from array import array
 import subprocess
 import logging
 import sys
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import time
-from threading import Thread
-import requests
-import speedtest
+from threading import Thread, Lock, Event, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait as futures_wait
+
+
+# Default settings, overridden per key by the YAML config file (see config.yml)
+DEFAULT_CONFIG = {
+    'server': {
+        'port': 9090,
+        'max_workers': 16,
+        # Seconds after the process started to wait for every collector's first run before
+        # serving and telling systemd the exporter is ready
+        'startup_budget': 10,
+        # Serve /debug (exporter self metrics) and /debug/profile (on-demand stack sampling)
+        'debug': True,
+    },
+    # Collectors run in a shared pool; one that fails failure_threshold times in a row is
+    # backed off, starting at its interval and doubling up to max_backoff seconds
+    'scheduler': {
+        'max_workers': 6,
+        'failure_threshold': 3,
+        'max_backoff': 600,
+    },
+    'collectors': {
+        'cpu': {'enabled': True, 'interval': 15, 'deadline': 5},
+        'memory': {'enabled': True, 'interval': 15, 'deadline': 5},
+        'disk': {'enabled': True, 'interval': 30, 'deadline': 10, 'path': '/srv'},
+        # Block devices from /proc/diskstats are picked by allow/deny, mounts by file system type;
+        # a mount whose statvfs takes longer than statvfs_timeout is served from its last result
+        'filesystems': {'enabled': True, 'interval': 15, 'deadline': 5, 'allow': ['*'], 'deny': ['loop*', 'ram*'],
+                        'fstypes': ['ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'zfs', 'f2fs', 'vfat', 'exfat',
+                                    'ntfs3', 'fuseblk', 'nfs', 'nfs4', 'cifs'],
+                        'statvfs_timeout': 1.0},
+        'app_disk': {'enabled': True, 'interval': 30, 'deadline': 5, 'base_path': '/srv',
+                     'budget': 2.0, 'pause': 8.0, 'full_rescan_interval': 86400},
+        # window is the number of recent measurements smoothed over, buckets the throughput histogram bounds in Mbps
+        'network_speed': {'enabled': True, 'interval': 15, 'deadline': 5, 'window': 10,
+                          'buckets': [1, 5, 10, 25, 50, 100, 250, 500, 1000]},
+        'network_interfaces': {'enabled': True, 'interval': 15, 'deadline': 5,
+                               'allow': ['*'], 'deny': ['lo', 'veth*']},
+        # window is the number of recent probes per target that loss and jitter cover, buckets the RTT bounds in ms
+        'network_latency': {'enabled': True, 'interval': 30, 'deadline': 15, 'targets': ['8.8.8.8', '1.1.1.1'],
+                            'count': 3, 'timeout': 3, 'tcp_port': 443, 'window': 20,
+                            'buckets': [1, 5, 10, 20, 50, 100, 200, 500, 1000, 3000]},
+        'speedtest': {'enabled': True, 'interval': 60, 'deadline': 5, 'schedule': '0 * * * *', 'jitter': 300,
+                      'min_gap': 1800, 'timeout': 180},
+        'tailscale': {'enabled': True, 'interval': 30, 'deadline': 10, 'unit': 'tailscaled', 'timeout': 5},
+        'services': {
+            'enabled': True,
+            'interval': 30,
+            'deadline': 15,
+            'timeout': 10,
+            # Each service maps to the containers it needs
+            'service_groups': {
+                'immich': ['immich_server', 'immich_postgres', 'immich_machine_learning', 'immich_redis'],
+                'homepage': ['homepage-dashboard'],
+                'mealie': ['mealie', 'mealie-postgres'],
+                'caddy': ['caddy'],
+                'filebrowser': ['filebrowser'],
+                'vaultwarden': ['vaultwarden'],
+                'jellyfin': ['jellyfin'],
+                'adguardhome': ['adguardhome'],
+            },
+            # A service with flap_threshold container restarts within flap_window seconds is flapping
+            'flap_window': 600,
+            'flap_threshold': 3,
+        },
+        # Units followed over D-Bus (the tailscale collector's unit is always watched too)
+        'systemd': {'enabled': True, 'interval': 15, 'deadline': 5,
+                    'units': ['docker', 'sshd', 'firewalld', 'chronyd'], 'bus_socket': '/run/dbus/system_bus_socket',
+                    'flap_window': 600, 'flap_threshold': 3},
+        'containers': {'enabled': True, 'interval': 15, 'deadline': 5, 'cgroup_root': '/sys/fs/cgroup'},
+        'internet': {'enabled': True, 'interval': 30, 'deadline': 10, 'targets': ['8.8.8.8', '1.1.1.1']},
+        # Results written by Backup Configuration/backup.py
+        'backups': {'enabled': True, 'interval': 60, 'deadline': 5,
+                    'status_file': '/var/lib/homelab_backup/status.json'},
+    },
+    # Optional push to a Prometheus remote-write endpoint, buffered on disk while it can't be reached
+    'remote_write': {
+        'enabled': False,
+        'url': '',
+        'interval': 30,
+        'timeout': 10,
+        'job': 'homelab-exporter',
+        'instance': '',  # Defaults to the hostname
+        'buffer_dir': '/var/lib/homelab_exporter/remote_write',
+        'max_buffer_bytes': 64 << 20,
+        'max_samples_per_send': 2000,
+        'username': '',
+        'password': '',
+    },
+    # The exporter's own log output (syslog, falling back to a file, plus stdout)
+    'logging': {
+        'level': 'INFO',
+        'format': 'text',  # text or json (one object per line)
+        # Each distinct message may be logged rate_limit_burst times per rate_limit_interval seconds,
+        # further repeats are dropped and counted in exporter_log_messages_suppressed_total
+        'rate_limit_burst': 5,
+        'rate_limit_interval': 60,
+    },
+    # Optional aggregation of peer exporters into this one's /metrics, each series labelled with its instance
+    'federation': {
+        'enabled': False,
+        'peers': [],  # host:port or full /metrics URLs
+        'ttl': 15,
+        'timeout': 5,
+        'instance': '',  # Label for this exporter's own series, defaults to the hostname
+    },
+}
+
+DEFAULT_CONFIG_PATH = '/etc/homelab_exporter/config.yml'
+
+# Active configuration, replaced as a whole on load/reload
+config = copy.deepcopy(DEFAULT_CONFIG)
+
+
+def collector_config(name) -> dict:
+    """Return the active settings of one collector"""
+    return config['collectors'][name]
+
+
+METRIC_NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+LABEL_NAME_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+# Scrape bodies are small, a low level keeps compression cheap
+GZIP_LEVEL = 1
+
+
+def format_value(value) -> str:
+    """Format a sample value the way both exposition formats expect"""
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class MetricFamily:
+    """A typed metric family with HELP text, label names and samples
+
+    Collectors build families once per run; the snapshot then serves them many
+    times, so each family caches its encoded bytes per exposition format.
+    """
+
+    metric_type = 'unknown'
+
+    def __init__(self, name, help_text, labels=()):
+        if not METRIC_NAME_RE.match(name):
+            raise ValueError(f"Invalid metric name: {name!r}")
+        for label in labels:
+            if not LABEL_NAME_RE.match(label) or label.startswith('__'):
+                raise ValueError(f"Invalid label name for {name}: {label!r}")
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.samples = []  # (name suffix, ((label, value), ...), value)
+        self._encoded = {}
+
+    def _add(self, suffix, label_values, value, extra_labels=()):
+        if len(label_values) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {label_values}")
+        labels = tuple(zip(self.labels, (str(v) for v in label_values))) + tuple(extra_labels)
+        self.samples.append((suffix, labels, value))
+        return self
+
+    def _type_name(self, openmetrics):
+        return self.name
+
+    def encode(self, openmetrics=False) -> bytes:
+        """Return the family's HELP/TYPE lines and samples as bytes, cached per format"""
+        encoded = self._encoded.get(openmetrics)
+        if encoded is not None:
+            return encoded
+
+        type_name = self._type_name(openmetrics)
+        help_text = self.help.replace('\\', '\\\\').replace('\n', '\\n')
+        metric_type = self.metric_type if openmetrics or self.metric_type != 'unknown' else 'untyped'
+        lines = [f'# HELP {type_name} {help_text}', f'# TYPE {type_name} {metric_type}']
+        for suffix, labels, value in self.samples:
+            if labels:
+                label_text = ','.join(f'{label}="{escape_label_value(v)}"' for label, v in labels)
+                lines.append(f'{self.name}{suffix}{{{label_text}}} {format_value(value)}')
+            else:
+                lines.append(f'{self.name}{suffix} {format_value(value)}')
+        encoded = ('\n'.join(lines) + '\n').encode()
+        self._encoded[openmetrics] = encoded
+        return encoded
+
+
+class GaugeFamily(MetricFamily):
+    metric_type = 'gauge'
+
+    def set(self, value, *label_values):
+        return self._add('', label_values, value)
+
+
+class CounterFamily(MetricFamily):
+    """Counter family, named without the _total suffix that every sample gets"""
+
+    metric_type = 'counter'
+
+    def set(self, value, *label_values):
+        return self._add('_total', label_values, value)
+
+    def _type_name(self, openmetrics):
+        # OpenMetrics names the family without _total, the classic text format names it after the samples
+        return self.name if openmetrics else f'{self.name}_total'
+
+
+class HistogramFamily(MetricFamily):
+    metric_type = 'histogram'
+
+    def add(self, histogram, *label_values):
+        """Add the _bucket/_sum/_count samples of a Histogram"""
+        cumulative = 0
+        for bound, count in zip(histogram.bounds + (math.inf,), histogram.counts):
+            cumulative += count
+            le = '+Inf' if bound == math.inf else repr(float(bound))
+            self._add('_bucket', label_values, cumulative, (('le', le),))
+        self._add('_sum', label_values, histogram.sum)
+        return self._add('_count', label_values, histogram.count)
+
+
+class SummaryFamily(MetricFamily):
+    metric_type = 'summary'
+
+    def add(self, window, histogram, *label_values, quantiles=(0.5, 0.9, 0.99)):
+        """Add quantiles over a RingBuffer window, with _sum/_count from the cumulative Histogram"""
+        for q, value in window.quantiles(quantiles).items():
+            self._add('', label_values, value, (('quantile', repr(float(q))),))
+        self._add('_sum', label_values, histogram.sum)
+        return self._add('_count', label_values, histogram.count)
+
+
+def render_families(families, openmetrics=False) -> bytes:
+    """Join the pre-encoded families into one exposition payload"""
+    chunks = [family.encode(openmetrics) for family in families]
+    if openmetrics:
+        chunks.append(b'# EOF\n')
+    return b''.join(chunks)
+
+
+# Family class for each TYPE in the text format
+FAMILY_TYPES = {
+    'gauge': GaugeFamily,
+    'counter': CounterFamily,
+    'histogram': HistogramFamily,
+    'summary': SummaryFamily,
+}
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)(?:\s+\S+)?$')
+LABEL_RE = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*"((?:[^"\\]|\\.)*)"\s*,?')
+
+
+def unescape_label_value(value) -> str:
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+
+def parse_exposition(text) -> list:
+    """Parse the Prometheus text format back into families (used to merge peer exporters)
+
+    Sample timestamps are dropped, and samples without a TYPE line become untyped families.
+    """
+    families = {}
+    helps = {}
+    current = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if line.startswith('#'):
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] == 'HELP':
+                helps[parts[2]] = unescape_label_value(parts[3]) if len(parts) > 3 else ''
+            elif len(parts) >= 4 and parts[1] == 'TYPE':
+                name, metric_type = parts[2], parts[3].strip()
+                family_class = FAMILY_TYPES.get(metric_type, MetricFamily)
+                if family_class is CounterFamily and name.endswith('_total'):
+                    name = name[:-len('_total')]
+                current = families.setdefault(name, family_class(name, helps.get(parts[2], '')))
+            continue
+
+        match = SAMPLE_RE.match(line)
+        if not match:
+            raise ValueError(f"Invalid sample line: {line!r}")
+        sample_name, label_text, value = match.groups()
+        if current is None or not sample_name.startswith(current.name):
+            current = families.setdefault(sample_name, MetricFamily(sample_name, helps.get(sample_name, '')))
+        labels = tuple((label, unescape_label_value(label_value))
+                       for label, label_value in LABEL_RE.findall(label_text or ''))
+        number = int(value) if value.lstrip('-').isdigit() else float(value)
+        current.samples.append((sample_name[len(current.name):], labels, number))
+    return list(families.values())
+
+
+class RingBuffer:
+    """Fixed-size ring buffer of floats backed by a preallocated array
+
+    A running sum and count of the non-NaN values give the mean in O(1). The sum is
+    recomputed from scratch each time the buffer wraps so float error can't build up.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = array('d', [0.0]) * capacity
+        self.index = 0
+        self.count = 0
+        self.total = 0.0  # Sum of the non-NaN values currently stored
+        self.valid = 0  # Number of non-NaN values currently stored
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        if self.count == self.capacity:
+            evicted = self.data[self.index]
+            if not math.isnan(evicted):
+                self.total -= evicted
+                self.valid -= 1
+        if not math.isnan(value):
+            self.total += value
+            self.valid += 1
+
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        if self.index == 0:
+            self.total = math.fsum(v for v in self.data if not math.isnan(v))
+
+    def mean(self):
+        """Mean of the non-NaN values in the window"""
+        return self.total / self.valid if self.valid else 0
+
+    def values(self) -> list:
+        """Return the stored values from oldest to newest"""
+        if self.count < self.capacity:
+            return self.data[:self.count].tolist()
+        return (self.data[self.index:] + self.data[:self.index]).tolist()
+
+    def quantiles(self, quantiles) -> dict:
+        """Nearest-rank quantiles of the non-NaN values in the window"""
+        ordered = sorted(v for v in self.values() if not math.isnan(v))
+        if not ordered:
+            return {q: math.nan for q in quantiles}
+        return {q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] for q in quantiles}
+
+    def resized(self, capacity):
+        """Return a buffer of the new capacity holding the newest values of this one"""
+        resized = RingBuffer(capacity)
+        for value in self.values()[-capacity:]:
+            resized.append(value)
+        return resized
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram with fixed bucket bounds, so memory stays constant"""
+
+    def __init__(self, buckets):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = array('Q', [0]) * (len(self.bounds) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class SelfProfiler:
+    """Tracks the exporter's own cost: time spent per collector and per subprocess, plus process resources"""
+
+    TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 15, 60)
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self.collector_wall = {}  # collector -> Histogram of wall seconds
+        self.collector_cpu = {}  # collector -> Histogram of CPU seconds
+        self.subprocess_time = {}  # command -> Histogram of wall seconds
+        self.subprocess_failures = {}  # command -> failed or timed out runs
+        self.startup_seconds = None  # From process start until the first snapshot was warm
+        self.process = psutil.Process()
+
+    def _observe(self, histograms, key, value):
+        with self._lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def call_collector(self, name, func):
+        """Call a collect function, recording its wall time and the CPU time of the thread running it"""
+        wall_started = time.monotonic()
+        cpu_started = time.thread_time()
+        try:
+            return func()
+        finally:
+            self._observe(self.collector_wall, name, time.monotonic() - wall_started)
+            self._observe(self.collector_cpu, name, time.thread_time() - cpu_started)
+
+    def run_subprocess(self, name, args, **kwargs):
+        """subprocess.run() that records the run under name"""
+        started = time.monotonic()
+        try:
+            return subprocess.run(args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.subprocess_failures[name] = self.subprocess_failures.get(name, 0) + 1
+            raise
+        finally:
+            self._observe(self.subprocess_time, name, time.monotonic() - started)
+
+    def families(self) -> list:
+        """Return the timing histograms and current process resource usage as families"""
+        collector_wall = HistogramFamily('exporter_collector_wall_seconds', 'Wall time of collector runs',
+                                         ['collector'])
+        collector_cpu = HistogramFamily('exporter_collector_cpu_seconds', 'CPU time of collector runs',
+                                        ['collector'])
+        subprocess_time = HistogramFamily('exporter_subprocess_seconds', 'Wall time of subprocess runs',
+                                          ['command'])
+        subprocess_failures = CounterFamily('exporter_subprocess_failures',
+                                            'Subprocess runs that failed to start or timed out', ['command'])
+        with self._lock:
+            for family, histograms in ((collector_wall, self.collector_wall), (collector_cpu, self.collector_cpu),
+                                       (subprocess_time, self.subprocess_time)):
+                for key, histogram in sorted(histograms.items()):
+                    family.add(histogram, key)
+            for command in sorted(self.subprocess_time):
+                subprocess_failures.set(self.subprocess_failures.get(command, 0), command)
+
+        with self.process.oneshot():
+            cpu_times = self.process.cpu_times()
+            resources = [
+                GaugeFamily('exporter_resident_memory_bytes', 'Resident memory of the exporter')
+                .set(self.process.memory_info().rss),
+                GaugeFamily('exporter_open_fds', 'Open file descriptors of the exporter')
+                .set(self.process.num_fds()),
+                GaugeFamily('exporter_threads', 'Threads of the exporter').set(self.process.num_threads()),
+                CounterFamily('exporter_cpu_seconds', 'CPU time used by the exporter', ['mode'])
+                .set(cpu_times.user, 'user').set(cpu_times.system, 'system'),
+            ]
+        if self.startup_seconds is not None:
+            resources.append(GaugeFamily('exporter_startup_seconds', 'Time from process start until ready to serve')
+                             .set(round(self.startup_seconds, 3)))
+        return [collector_wall, collector_cpu, subprocess_time, subprocess_failures] + resources
+
+
+# Global self profiler instance
+self_profiler = SelfProfiler()
+
+
+class StackSampler:
+    """Samples the stack of every thread at a fixed rate, for on-demand profiles of the running exporter
+
+    cProfile only sees the thread that enabled it, while the collectors run on
+    pool threads, so profiles are built from wall-clock stack samples instead.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._lock = Lock()
+
+    def sample(self, seconds) -> dict:
+        """Sample for the given time and return stack (root first) -> sample count
+
+        Raises RuntimeError if another profile is already running.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            own_thread = threading.get_ident()
+            samples = {}
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_thread:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    key = tuple(reversed(stack))
+                    samples[key] = samples.get(key, 0) + 1
+                time.sleep(self.interval)
+            return samples
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def collapsed(samples) -> str:
+        """Format samples as collapsed stacks ("thread;outer;inner count"), as read by flamegraph tools"""
+        return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(samples.items()))
+
+    @staticmethod
+    def top(samples, limit=50) -> str:
+        """Format samples as a table of functions by own and cumulative samples, like pstats"""
+        total = sum(samples.values()) or 1
+        own = {}
+        cumulative = {}
+        for stack, count in samples.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            # A recursive function only counts once per stack
+            for function in set(stack[1:]):
+                cumulative[function] = cumulative.get(function, 0) + count
+        lines = [f"{total} samples\n", f"{'own':>8} {'own%':>6} {'cum':>8} {'cum%':>6}  function"]
+        for function in sorted(cumulative, key=lambda f: (own.get(f, 0), cumulative[f]), reverse=True)[:limit]:
+            lines.append(f"{own.get(function, 0):>8} {own.get(function, 0) / total:>6.1%} "
+                         f"{cumulative[function]:>8} {cumulative[function] / total:>6.1%}  {function}")
+        return '\n'.join(lines) + '\n'
+
+
+# Global stack sampler instance for /debug/profile
+stack_sampler = StackSampler()
+
+
+class LatencyProber:
+    """Probes many targets concurrently with ICMP echo (or TCP connect) and keeps a rolling window per target
+
+    ICMP uses unprivileged datagram sockets, which need the exporter's group to be in
+    net.ipv4.ping_group_range. When that isn't allowed the prober falls back to timing
+    a TCP connect to tcp_port. Lost probes are stored as NaN so the window also gives loss.
+    """
+
+    RTT_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000, 3000)
+
+    def __init__(self, count=3, timeout=3, interval=0.2, window=20, tcp_port=443, buckets=RTT_BUCKETS):
+        self.count = count
+        self.timeout = timeout
+        self.interval = interval
+        self.window = window
+        self.tcp_port = tcp_port
+        self.buckets = buckets
+        self.use_icmp = True
+        self.windows = {}  # target -> RingBuffer of RTTs in ms (NaN for a lost probe)
+        self.histograms = {}  # target -> Histogram of RTTs in ms
+        self._lock = Lock()
+
+    def configure(self, window, buckets):
+        """Apply a new window size and histogram buckets, keeping the newest probes of each window
+
+        Histograms are restarted when their buckets change, which Prometheus reads as a counter reset.
+        """
+        buckets = tuple(buckets)
+        with self._lock:
+            if window != self.window:
+                self.windows = {target: values.resized(window) for target, values in self.windows.items()}
+                self.window = window
+            if buckets != self.buckets:
+                self.histograms = {}
+                self.buckets = buckets
+
+    def probe(self, targets, count=None, record=True) -> dict:
+        """Probe every target concurrently within one deadline, returns {target: replies received}
+
+        With record=False the probes are one-off checks and stay out of the windows and histograms.
+        """
+        # Loaded on the first probe, so processes that never probe (e.g. the speed test) don't pay for it
+        import asyncio
+        count = self.count if count is None else count
+        deadline = self.timeout + self.interval * count + 1
+        try:
+            results = asyncio.run(asyncio.wait_for(self._probe_all(targets, count), timeout=deadline))
+        except asyncio.TimeoutError:
+            results = {target: [None] * count for target in targets}
+
+        if not record:
+            return {target: sum(1 for rtt in rtts if rtt is not None) for target, rtts in results.items()}
+
+        replies = {}
+        with self._lock:
+            for target, rtts in results.items():
+                window = self.windows.setdefault(target, RingBuffer(self.window))
+                histogram = self.histograms.setdefault(target, Histogram(self.buckets))
+                for rtt in rtts:
+                    window.append(math.nan if rtt is None else rtt * 1000)
+                    if rtt is not None:
+                        histogram.observe(rtt * 1000)
+                replies[target] = sum(1 for rtt in rtts if rtt is not None)
+        return replies
+
+    def stats(self, target) -> dict:
+        """Return RTT min/avg/max/jitter in ms and loss ratio over the target's window"""
+        with self._lock:
+            window = self.windows.get(target)
+            values = window.values() if window else []
+        rtts = [value for value in values if not math.isnan(value)]
+        if not rtts:
+            return {'min': 0, 'avg': 0, 'max': 0, 'jitter': 0, 'loss': 1 if values else 0}
+
+        jitter = 0
+        if len(rtts) > 1:
+            jitter = sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) / (len(rtts) - 1)
+        return {
+            'min': round(min(rtts), 3),
+            'avg': round(sum(rtts) / len(rtts), 3),
+            'max': round(max(rtts), 3),
+            'jitter': round(jitter, 3),
+            'loss': round(1 - len(rtts) / len(values), 3),
+        }
+
+    def metric_families(self, targets) -> list:
+        """Return the RTT histogram and windowed summary families for the given targets"""
+        histograms = HistogramFamily('network_rtt_ms', 'Round-trip time of probes in milliseconds', ['target'])
+        summaries = SummaryFamily('network_rtt_window_ms', 'Round-trip time quantiles over the recent window',
+                                  ['target'])
+        with self._lock:
+            for target in targets:
+                if target not in self.histograms:
+                    continue
+                histograms.add(self.histograms[target], target)
+                summaries.add(self.windows[target], self.histograms[target], target)
+        return [histograms, summaries]
+
+    async def _probe_all(self, targets, count):
+        import asyncio
+        results = await asyncio.gather(*(self._probe_target(target, count) for target in targets))
+        return dict(zip(targets, results))
+
+    async def _probe_target(self, target, count):
+        import asyncio
+        logger = logging.getLogger('prometheus_exporter')
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(target, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            address = infos[0][4][0]
+        except (socket.gaierror, IndexError) as e:
+            logger.error(f"Error resolving probe target {target}: {e}")
+            return [None] * count
+
+        async def delayed(seq):
+            await asyncio.sleep(seq * self.interval)
+            return await self._probe_once(address, seq)
+
+        return list(await asyncio.gather(*(delayed(seq) for seq in range(count))))
+
+    async def _probe_once(self, address, seq):
+        if self.use_icmp:
+            try:
+                return await self._icmp_probe(address, seq)
+            except PermissionError:
+                logging.getLogger('prometheus_exporter').warning(
+                    f"ICMP sockets not permitted (net.ipv4.ping_group_range), "
+                    f"falling back to TCP connect on port {self.tcp_port}")
+                self.use_icmp = False
+            except OSError:
+                return None
+        return await self._tcp_probe(address)
+
+    @staticmethod
+    def _checksum(data):
+        if len(data) % 2:
+            data += b'\0'
+        total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+        total = (total >> 16) + (total & 0xffff)
+        total += total >> 16
+        return ~total & 0xffff
+
+    async def _icmp_probe(self, address, seq):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        payload = b'homelab-exporter'
+        # The kernel fills in the identifier for datagram ICMP sockets
+        header = struct.pack('!BBHHH', 8, 0, 0, 0, seq)
+        packet = struct.pack('!BBHHH', 8, 0, self._checksum(header + payload), 0, seq) + payload
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        sock.setblocking(False)
+        try:
+            started = time.perf_counter()
+            sock.sendto(packet, (address, 0))
+            end = started + self.timeout
+            while True:
+                remaining = end - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                try:
+                    reply = await asyncio.wait_for(loop.sock_recv(sock, 1024), timeout=remaining)
+                except asyncio.TimeoutError:
+                    return None
+                # Echo reply (type 0) carrying our sequence number
+                if len(reply) >= 8 and reply[0] == 0 and struct.unpack('!H', reply[6:8])[0] == seq:
+                    return time.perf_counter() - started
+        finally:
+            sock.close()
+
+    async def _tcp_probe(self, address):
+        import asyncio
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(address, self.tcp_port), timeout=self.timeout)
+        except ConnectionRefusedError:
+            # A refusal still means the host answered
+            return time.perf_counter() - started
+        except (asyncio.TimeoutError, OSError):
+            return None
+        rtt = time.perf_counter() - started
+        writer.close()
+        return rtt
+
+
+# Global prober shared by the latency and internet status collectors
+network_prober = LatencyProber()
 
 
 class NetworkMonitor:
     """Class to handle network metrics with time series data"""
     
-    def __init__(self):
+    THROUGHPUT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, max_history=10, buckets=THROUGHPUT_BUCKETS):
         self.last_network_io = None
         self.last_check_time = None
-        self.upload_speeds = []  # Store recent upload speeds
-        self.download_speeds = []  # Store recent download speeds
-        self.latencies = []  # Store recent latencies
-        self.max_history = 10  # Keep last 10 measurements for smoothing
+        self.max_history = max_history  # Keep last N measurements for smoothing
+        self.upload_speeds = RingBuffer(max_history)  # Store recent upload speeds
+        self.download_speeds = RingBuffer(max_history)  # Store recent download speeds
+        self.buckets = buckets
+        self.upload_histogram = Histogram(buckets)
+        self.download_histogram = Histogram(buckets)
+
+    def configure(self, max_history, buckets):
+        """Apply a new smoothing window and histogram buckets, keeping the newest measurements"""
+        buckets = tuple(buckets)
+        if max_history != self.max_history:
+            self.upload_speeds = self.upload_speeds.resized(max_history)
+            self.download_speeds = self.download_speeds.resized(max_history)
+            self.max_history = max_history
+        if buckets != self.buckets:
+            self.upload_histogram = Histogram(buckets)
+            self.download_histogram = Histogram(buckets)
+            self.buckets = buckets
         
     def get_network_io_counters(self):
-        """Get current network I/O statistics"""
-        try:
-            # Get network stats, handle potential permission issues
-            return psutil.net_io_counters()
-        except (PermissionError, OSError, psutil.AccessDenied) as e:
-            logging.getLogger('prometheus_exporter').error(f"Permission error getting network I/O: {e}")
-            return None
-        except Exception as e:
-            logging.getLogger('prometheus_exporter').error(f"Error getting network I/O: {e}")
-            return None
+        """Get current network I/O statistics, errors propagate so the collector is marked failed"""
+        counters = psutil.net_io_counters()
+        if counters is None:
+            raise OSError("No network interfaces to read I/O counters from")
+        return counters
     
     def calculate_network_speed(self):
         """Calculate network upload/download speed in Mbps"""
-        logger = logging.getLogger('prometheus_exporter')
+        current_io = self.get_network_io_counters()
+        current_time = time.time()
         
-        try:
-            current_io = self.get_network_io_counters()
-            current_time = time.time()
+        if self.last_network_io is not None and self.last_check_time is not None:
+            time_diff = current_time - self.last_check_time
             
-            if current_io is None:
-                return 0, 0
+            if time_diff > 0:
+                # Calculate bytes per second
+                bytes_sent_per_sec = (current_io.bytes_sent - self.last_network_io.bytes_sent) / time_diff
+                bytes_recv_per_sec = (current_io.bytes_recv - self.last_network_io.bytes_recv) / time_diff
                 
-            if self.last_network_io is not None and self.last_check_time is not None:
-                time_diff = current_time - self.last_check_time
+                # Convert to Mbps (megabits per second)
+                upload_speed = (bytes_sent_per_sec * 8) / 1_000_000
+                download_speed = (bytes_recv_per_sec * 8) / 1_000_000
                 
-                if time_diff > 0:
-                    # Calculate bytes per second
-                    bytes_sent_per_sec = (current_io.bytes_sent - self.last_network_io.bytes_sent) / time_diff
-                    bytes_recv_per_sec = (current_io.bytes_recv - self.last_network_io.bytes_recv) / time_diff
-                    
-                    # Convert to Mbps (megabits per second)
-                    upload_speed = (bytes_sent_per_sec * 8) / (1024 * 1024)
-                    download_speed = (bytes_recv_per_sec * 8) / (1024 * 1024)
-                    
-                    # Store for averaging (smooth out spikes)
-                    self.upload_speeds.append(upload_speed)
-                    self.download_speeds.append(download_speed)
-                    
-                    # Keep only recent measurements
-                    if len(self.upload_speeds) > self.max_history:
-                        self.upload_speeds.pop(0)
-                    if len(self.download_speeds) > self.max_history:
-                        self.download_speeds.pop(0)
-                    
-                    # Return averaged speeds
-                    avg_upload = sum(self.upload_speeds) / len(self.upload_speeds)
-                    avg_download = sum(self.download_speeds) / len(self.download_speeds)
-                    
-                    self.last_network_io = current_io
-                    self.last_check_time = current_time
-                    
-                    return round(avg_upload, 2), round(avg_download, 2)
-            
-            # First measurement - store but return 0
-            self.last_network_io = current_io
-            self.last_check_time = current_time
-            return 0, 0
-            
-        except Exception as e:
-            logger.error(f"Error calculating network speed: {e}")
-            return 0, 0
-    
-    def measure_latency(self, host='8.8.8.8', count=3):
-        """Measure network latency using ping"""
-        logger = logging.getLogger('prometheus_exporter')
+                # Store for averaging (smooth out spikes), the ring buffers drop the oldest
+                self.upload_speeds.append(upload_speed)
+                self.download_speeds.append(download_speed)
+                self.upload_histogram.observe(upload_speed)
+                self.download_histogram.observe(download_speed)
+                
+                # Return averaged speeds
+                avg_upload = self.upload_speeds.mean()
+                avg_download = self.download_speeds.mean()
+                
+                self.last_network_io = current_io
+                self.last_check_time = current_time
+                
+                return round(avg_upload, 2), round(avg_download, 2)
         
-        try:
-            result = subprocess.run(
-                ['ping', '-c', str(count), '-W', '3', host],
-                capture_output=True,
-                text=True,
-                timeout=15,
-                stdin=subprocess.DEVNULL
-            )
-            
-            if result.returncode == 0:
-                # Parse ping output for average latency
-                lines = result.stdout.split('\n')
-                for line in lines:
-                    if ('avg' in line or 'rtt' in line) and 'ms' in line:
-                        # Handle Rocky Linux ping format
-                        if '=' in line:
-                            try:
-                                parts = line.split('=')[1].strip().split('/')
-                                if len(parts) >= 2:
-                                    avg_latency = float(parts[1])
-                                    
-                                    # Store for smoothing
-                                    self.latencies.append(avg_latency)
-                                    if len(self.latencies) > self.max_history:
-                                        self.latencies.pop(0)
-                                    
-                                    return round(sum(self.latencies) / len(self.latencies), 2)
-                            except (ValueError, IndexError):
-                                continue
-            
-            return 0
-            
-        except (subprocess.TimeoutExpired, subprocess.CalledProcessError, BrokenPipeError, OSError) as e:
-            logger.error(f"Error measuring latency to {host}: {e}")
-            return 0
+        # First measurement - store but return 0
+        self.last_network_io = current_io
+        self.last_check_time = current_time
+        return 0, 0
     
-    def run_speedtest(self):
-        """Run internet speed test (use sparingly - maybe once per hour)"""
-        logger = logging.getLogger('prometheus_exporter')
-        
-        try:
-            # Set timeout and configure speedtest
-            st = speedtest.Speedtest(timeout=60)
-            st.get_best_server()
-            
-            download_speed = st.download() / (1024 * 1024)  # Convert to Mbps
-            upload_speed = st.upload() / (1024 * 1024)      # Convert to Mbps
-            
-            return round(download_speed, 2), round(upload_speed, 2)
-            
-        except (speedtest.ConfigRetrievalError, speedtest.NoMatchedServers, 
-                speedtest.SpeedtestException, ConnectionError, OSError, 
-                BrokenPipeError) as e:
-            logger.error(f"Speedtest failed: {e}")
-            return 0, 0
-        except Exception as e:
-            logger.error(f"Unexpected error in speedtest: {e}")
-            return 0, 0
+    def metric_families(self) -> list:
+        """Return the throughput histogram and windowed summary families"""
+        families = []
+        for direction, window, histogram in (('upload', self.upload_speeds, self.upload_histogram),
+                                             ('download', self.download_speeds, self.download_histogram)):
+            families.append(HistogramFamily(f'network_{direction}_throughput_mbps',
+                                            f'Host {direction} throughput in Mbps').add(histogram))
+            families.append(SummaryFamily(f'network_{direction}_throughput_window_mbps',
+                                          f'Host {direction} throughput quantiles over the recent window')
+                            .add(window, histogram))
+        return families
+    
+    def measure_latency(self, host='8.8.8.8', count=3):
+        """Measure network latency with the native prober, returns the average RTT in ms over its window"""
+        network_prober.probe([host], count=count)
+        return network_prober.stats(host)['avg']
 
 
 # Global network monitor instance
@@ -155,21 +837,54 @@ network_monitor = NetworkMonitor()
 
 
 class MetricsHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps scraper connections alive between requests
+    protocol_version = 'HTTP/1.1'
+    # Drop idle or stuck connections so they don't hold a worker forever
+    timeout = 60
+    # Headers and body are written separately, so without TCP_NODELAY the body waits on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    # Longest on-demand profile, each one holds an HTTP worker for its duration
+    MAX_PROFILE_SECONDS = 60
+
     def do_GET(self):
         logger = logging.getLogger('prometheus_exporter')
-        
-        if self.path == '/metrics':
+        url = urllib.parse.urlsplit(self.path)
+
+        if url.path.startswith('/debug') and not config['server']['debug']:
+            self._send_response(404, 'text/plain', b"Not Found\n")
+
+        elif url.path == '/metrics':
             try:
-                metrics_data = collect_all_metrics()
-                self._send_response(200, 'text/plain', metrics_data.encode())
+                # Prometheus asks for OpenMetrics first when it supports it
+                openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+                if config['federation']['enabled'] and not self.headers.get(PeerFederation.HOP_HEADER):
+                    families = peer_federation.merge(metrics_snapshot.families())
+                    metrics_data = render_families(families, openmetrics)
+                else:
+                    metrics_data = metrics_snapshot.render(openmetrics=openmetrics)
+                headers = {'Vary': 'Accept, Accept-Encoding'}
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    import gzip
+                    metrics_data = gzip.compress(metrics_data, compresslevel=GZIP_LEVEL)
+                    headers['Content-Encoding'] = 'gzip'
+                content_type = OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE
+                self._send_response(200, content_type, metrics_data, headers)
             except Exception as e:
                 logger.error(f"Error generating metrics: {e}")
                 self._send_response(500, 'text/plain', b"Error generating metrics\n")
                 
-        elif self.path == '/health':
+        elif url.path == '/health':
             self._send_response(200, 'text/plain', b"OK\n")
-            
-        elif self.path == '/':
+
+        elif url.path == '/debug':
+            families = self_profiler.families() + remote_writer.metric_families()
+            self._send_response(200, TEXT_CONTENT_TYPE, render_families(families))
+
+        elif url.path == '/debug/profile':
+            self._send_profile(urllib.parse.parse_qs(url.query))
+
+        elif url.path == '/':
             html = """
             <html>
             <head><title>Prometheus Exporter</title></head>
@@ -177,6 +892,7 @@ class MetricsHandler(BaseHTTPRequestHandler):
                 <h1>Prometheus Exporter</h1>
                 <p>Metrics: <a href="/metrics">/metrics</a></p>
                 <p>Health: <a href="/health">/health</a></p>
+                <p>Debug: <a href="/debug">/debug</a>, <a href="/debug/profile?seconds=10">/debug/profile</a></p>
             </body>
             </html>
             """.encode()
@@ -184,13 +900,39 @@ class MetricsHandler(BaseHTTPRequestHandler):
         else:
             self._send_response(404, 'text/plain', b"Not Found\n")
     
-    def _send_response(self, status_code, content_type, data):
+    def _send_profile(self, query):
+        """Sample all threads for ?seconds=N and send the profile as ?format=collapsed or top"""
+        try:
+            seconds = float(query.get('seconds', ['10'])[0])
+        except ValueError:
+            self._send_response(400, 'text/plain', b"seconds must be a number\n")
+            return
+        if not 0 < seconds <= self.MAX_PROFILE_SECONDS:
+            message = f"seconds must be between 0 and {self.MAX_PROFILE_SECONDS}\n"
+            self._send_response(400, 'text/plain', message.encode())
+            return
+        output = query.get('format', ['collapsed'])[0]
+        if output not in ('collapsed', 'top'):
+            self._send_response(400, 'text/plain', b"format must be collapsed or top\n")
+            return
+
+        try:
+            samples = stack_sampler.sample(seconds)
+        except RuntimeError as e:
+            self._send_response(409, 'text/plain', f"{e}\n".encode())
+            return
+        text = stack_sampler.collapsed(samples) if output == 'collapsed' else stack_sampler.top(samples)
+        self._send_response(200, 'text/plain; charset=utf-8', text.encode())
+
+    def _send_response(self, status_code, content_type, data, headers=None):
         """Send HTTP response with proper error handling for broken pipes"""
         logger = logging.getLogger('prometheus_exporter')
         try:
             self.send_response(status_code)
             self.send_header('Content-Type', content_type)
             self.send_header('Content-Length', str(len(data)))
+            for header, value in (headers or {}).items():
+                self.send_header(header, value)
             self.end_headers()
             self.wfile.write(data)
             self.wfile.flush()
@@ -205,188 +947,1410 @@ class MetricsHandler(BaseHTTPRequestHandler):
         pass
 
 
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class LogRateLimiter(logging.Filter):
+    """Drops log records that repeat too often, so an outage doesn't turn into a flood of identical errors
+
+    Records are keyed by call site and message with numbers blanked out, and each
+    key may log burst records per interval seconds. The first record of a key let
+    through after some were dropped says how many ("suppressed N similar").
+    """
+
+    NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+    # Expired windows are dropped once there are this many keys
+    MAX_KEYS = 1000
+
+    def __init__(self, burst=5, interval=60):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._lock = Lock()
+        self._windows = {}  # key -> [window start, records let through, records dropped]
+        self.emitted = {}  # level name -> records let through
+        self.suppressed = {}  # level name -> records dropped
+
+    def filter(self, record):
+        message = record.getMessage()
+        key = (record.levelno, record.pathname, record.lineno, self.NUMBER_RE.sub('#', message))
+        now = time.monotonic()
+        dropped = 0
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window else 0
+                if window is None and len(self._windows) >= self.MAX_KEYS:
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.interval}
+                window = self._windows[key] = [now, 0, 0]
+            if window[1] >= self.burst:
+                window[2] += 1
+                self.suppressed[record.levelname] = self.suppressed.get(record.levelname, 0) + 1
+                return False
+            window[1] += 1
+            self.emitted[record.levelname] = self.emitted.get(record.levelname, 0) + 1
+
+        if dropped:
+            record.msg = f"{message} (suppressed {dropped} similar)"
+            record.args = ()
+        return True
+
+    def metric_families(self) -> list:
+        """Return the counts of log records written and dropped per level"""
+        emitted = CounterFamily('exporter_log_messages', 'Log records written by the exporter', ['level'])
+        suppressed = CounterFamily('exporter_log_messages_suppressed',
+                                   'Log records dropped by the rate limit as repeats', ['level'])
+        with self._lock:
+            for level in sorted(self.emitted.keys() | self.suppressed.keys()):
+                emitted.set(self.emitted.get(level, 0), level)
+                suppressed.set(self.suppressed.get(level, 0), level)
+        return [emitted, suppressed]
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object per line, with any traceback kept inside the message"""
+
+    def format(self, record):
+        message = record.getMessage()
+        # Queued records already carry the traceback in their message and have exc_info cleared
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            message = f"{message}\n{record.exc_text}"
+        return json.dumps({
+            'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': message,
+        })
+
+
+# Global log rate limiter and the listener thread that writes queued records
+log_rate_limiter = LogRateLimiter()
+log_listener = None
+
+
 def setup_logging():
-    """Setup logging configuration"""
+    """Setup logging configuration
+
+    Callers only put records on a queue; a listener thread does the syslog, file
+    and console writes, so a slow syslog never holds up a scrape or a collector.
+    """
+    global log_listener
+    from logging.handlers import SysLogHandler, QueueHandler, QueueListener
+
     # Create logger
     logger = logging.getLogger('prometheus_exporter')
     logger.setLevel(logging.INFO)
-    
-    # Create formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
+    handlers = []
+
     # Try to log to /var/log/messages via syslog, fallback to file
     try:
+        # SysLogHandler only fails on the first message when there is no syslog socket
+        if not os.path.exists('/dev/log'):
+            raise FileNotFoundError('/dev/log')
         # Use syslog handler for Linux systems
-        from logging.handlers import SysLogHandler
-        syslog_handler = SysLogHandler(address='/dev/log')
-        syslog_handler.setFormatter(formatter)
-        logger.addHandler(syslog_handler)
+        handlers.append(SysLogHandler(address='/dev/log'))
     except (FileNotFoundError, PermissionError):
         # Fallback to file logging
         try:
-            file_handler = logging.FileHandler('/var/log/prometheus_exporter.log')
-            file_handler.setFormatter(formatter)
-            logger.addHandler(file_handler)
+            handlers.append(logging.FileHandler('/var/log/prometheus_exporter.log'))
         except PermissionError:
             # Last resort: log to current directory
-            file_handler = logging.FileHandler('prometheus_exporter.log')
-            file_handler.setFormatter(formatter)
-            logger.addHandler(file_handler)
-    
+            handlers.append(logging.FileHandler('prometheus_exporter.log'))
+
     # Also log to console for debugging
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
-    
+    handlers.append(logging.StreamHandler(sys.stdout))
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    # Repeats are dropped before they are queued
+    queue_handler.addFilter(log_rate_limiter)
+    logger.addHandler(queue_handler)
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    # Write out whatever is still queued when the process exits
+    atexit.register(log_listener.stop)
+
     return logger
 
 
-def export_cpu_usage(interval=1) -> int:
-    ''' Returns the system CPU usage as a percentage '''
-    logger = logging.getLogger('prometheus_exporter')
-    try:
-        # Get per-core CPU usage
-        cpu_percents = psutil.cpu_percent(interval=int(interval), percpu=True)
-        # Return average across all cores
-        return int(sum(cpu_percents) / len(cpu_percents))
-    except Exception as e:
-        logger.error(f"Error exporting CPU usage: {e}")
-        return 0
+def configure_logging(settings):
+    """Apply the logging section of the config: level, text or JSON lines, and the rate limit"""
+    logging.getLogger('prometheus_exporter').setLevel(settings['level'].upper())
+    log_rate_limiter.burst = settings['rate_limit_burst']
+    log_rate_limiter.interval = settings['rate_limit_interval']
+    if log_listener is not None:
+        formatter = JsonFormatter() if settings['format'] == 'json' else logging.Formatter(LOG_FORMAT)
+        for handler in log_listener.handlers:
+            handler.setFormatter(formatter)
+
+
+class CpuMonitor:
+    """CPU usage computed from cpu_times deltas between samples, so sampling never sleeps"""
+
+    # Modes exported per core when the platform reports them (iowait/steal are Linux only)
+    MODES = ('user', 'system', 'iowait', 'steal', 'idle')
+
+    def __init__(self):
+        self.last_times = None
+        self._lock = Lock()
+
+    def prime(self):
+        """Take the sample the first collection is measured against"""
+        current = psutil.cpu_times(percpu=True)
+        with self._lock:
+            self.last_times = current
+
+    @staticmethod
+    def _total(times):
+        # Guest time is already counted in user/nice on Linux
+        return sum(times) - getattr(times, 'guest', 0) - getattr(times, 'guest_nice', 0)
+
+    @staticmethod
+    def _busy(times, total):
+        return total - times.idle - getattr(times, 'iowait', 0)
+
+    def sample(self):
+        """Return (average usage, per-core usage, per-core per-mode percent) since the previous sample"""
+        current = psutil.cpu_times(percpu=True)
+        with self._lock:
+            previous, self.last_times = self.last_times, current
+
+        core_usage = {}
+        mode_usage = {}
+        if previous is None or len(previous) != len(current):
+            return 0, core_usage, mode_usage
+
+        for core, (before, after) in enumerate(zip(previous, current)):
+            total_delta = self._total(after) - self._total(before)
+            if total_delta <= 0:
+                continue
+            busy_delta = self._busy(after, self._total(after)) - self._busy(before, self._total(before))
+            core_usage[core] = round(min(max(busy_delta / total_delta * 100, 0), 100), 2)
+            for mode in self.MODES:
+                if hasattr(after, mode):
+                    delta = getattr(after, mode) - getattr(before, mode)
+                    mode_usage[(core, mode)] = round(max(delta / total_delta * 100, 0), 2)
+
+        average = round(sum(core_usage.values()) / len(core_usage), 2) if core_usage else 0
+        return average, core_usage, mode_usage
+
+
+# Global CPU monitor, primed by main() so the first collection already has a delta
+cpu_monitor = CpuMonitor()
+
+
+# The export_* functions below raise on failure instead of returning 0, so the
+# scheduler can record the failure and keep serving the last good value as stale.
+
+def export_cpu_usage():
+    ''' Returns CPU usage percentages (average, per core, per core and mode) since the last call '''
+    return cpu_monitor.sample()
 
 
 def export_memory_usage() -> int:
     ''' Returns the system memory usage as a percentage '''
-    logger = logging.getLogger('prometheus_exporter')
-    try:
-        return int(psutil.virtual_memory().percent)
-    except Exception as e:
-        logger.error(f"Error exporting memory usage: {e}")
-        return 0
+    return int(psutil.virtual_memory().percent)
 
 
 def export_disk_usage(path="/srv") -> int:
     ''' Returns disk usage as a percentage for the specified path '''
-    logger = logging.getLogger('prometheus_exporter')
-    try:
-        disk = psutil.disk_usage(path)
-        return int((disk.used / disk.total) * 100)
-    except Exception as e:
-        logger.error(f"Error exporting disk usage for path {path}: {e}")
-        return 0
+    disk = psutil.disk_usage(path)
+    return int((disk.used / disk.total) * 100)
 
-def get_directory_size_du(path):
-    ''' Calculate directory size using du command (like your monitoring command) '''
-    logger = logging.getLogger('prometheus_exporter')
-    try:
-        # Use du command to get size in bytes
-        result = subprocess.run(
-            ['sudo', 'du', '-sb', path],  # -s for summary, -b for bytes
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        if result.returncode == 0:
-            # Parse output: "1234567890\t/path/to/directory"
-            size_str = result.stdout.strip().split('\t')[0]
-            return int(size_str)
-        else:
-            logger.error(f"du command failed for {path}: {result.stderr}")
-            return 0
-            
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError, ValueError) as e:
-        logger.error(f"Error running du command for {path}: {e}")
-        return 0
 
-def export_app_disk_usage(base_path="/srv") -> dict:
-    ''' Returns disk usage in GB (numeric) for each directory under the specified path '''
-    ''' Returns disk usage in bytes for each directory '''
-    logger = logging.getLogger('prometheus_exporter')
-    try:
-        app_usage = {}
-        
-        for item in os.listdir(base_path):
-            item_path = os.path.join(base_path, item)
-            
-            if os.path.isdir(item_path):
-                try:
-                    size_bytes = get_directory_size_du(item_path)
-                    app_usage[f"{item}_disk_usage_bytes"] = size_bytes
-                except (PermissionError, OSError) as e:
-                    logger.error(f"Error accessing directory {item_path}: {e}")
-                    app_usage[f"{item}_disk_usage_bytes"] = 0
-        
-        return app_usage
-    except Exception as e:
-        logger.error(f"Error exporting app disk usage: {e}")
-        return {}
+# /proc/diskstats counts in 512 byte sectors whatever the device's real sector size
+DISKSTATS_SECTOR_BYTES = 512
 
+# /proc/diskstats columns after "major minor device", in order
+DISKSTATS_FIELDS = (
+    'reads', 'reads_merged', 'sectors_read', 'read_ms', 'writes', 'writes_merged', 'sectors_written', 'write_ms',
+    'io_in_progress', 'io_ms', 'io_weighted_ms', 'discards', 'discards_merged', 'sectors_discarded', 'discard_ms',
+)
 
-def export_tailscale_status():
-    ''' Returns 1 if Tailscale service is running, 0 if stopped/failed '''
-    logger = logging.getLogger('prometheus_exporter')
-    try:
-        result = subprocess.run(
-            ['systemctl', 'is-active', 'tailscaled'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        
-        return 1 if result.stdout.strip() == 'active' else 0
-        
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError, FileNotFoundError) as e:
-        logger.error(f"Error checking Tailscale status: {e}")
-        return 0
 
+def export_block_device_counters(allow=('*',), deny=('loop*', 'ram*'), path='/proc/diskstats') -> dict:
+    ''' Returns raw /proc/diskstats counters for devices matching allow and not deny (fnmatch patterns) '''
+    devices = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            device = fields[2]
+            if (not any(fnmatch.fnmatch(device, pattern) for pattern in allow)
+                    or any(fnmatch.fnmatch(device, pattern) for pattern in deny)):
+                continue
+            # Older kernels have no discard columns, those are simply left out
+            devices[device] = dict(zip(DISKSTATS_FIELDS, map(int, fields[3:])))
+    return devices
 
-def export_container_status(container_names=None) -> dict:
-    ''' Returns 1 if container is running, 0 if stopped/doesn't exist '''
 
-    logger = logging.getLogger('prometheus_exporter')
-    container_status = {}
-    
-    for container in container_names:
+def unescape_mount_path(path) -> str:
+    """Undo the octal escaping (\\040 for a space etc.) of paths in /proc/self/mountinfo"""
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), path)
+
+
+def read_mounts(fstypes, path='/proc/self/mountinfo') -> dict:
+    """Return mount point -> {'device', 'fstype', 'readonly'} for every mount of one of fstypes"""
+    mounts = {}
+    with open(path) as f:
+        for line in f:
+            # "id parent major:minor root mountpoint options [optional fields...] - fstype source superoptions"
+            fields, _, tail = line.partition(' - ')
+            fields, tail = fields.split(), tail.split()
+            if tail[0] not in fstypes:
+                continue
+            # A later entry for the same mount point is mounted over the earlier one
+            mounts[unescape_mount_path(fields[4])] = {
+                'device': unescape_mount_path(tail[1]),
+                'fstype': tail[0],
+                'readonly': 'ro' in fields[5].split(','),
+            }
+    return mounts
+
+
+class MountStats:
+    """statvfs results per mount point, fetched off the scrape path
+
+    Each statvfs call runs in its own daemon thread and the collector only waits
+    timeout seconds for all of them. A mount that doesn't answer in time (e.g. an
+    NFS share whose server is gone) is served from its last result and flagged as
+    stale, and gets no new call until the hung one returns.
+    """
+
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+        self._lock = Lock()
+        # mount point -> last statvfs result
+        self._cache = {}
+        # mount point -> Event set once its outstanding statvfs call returns
+        self._pending = {}
+
+    def _statvfs(self, mountpoint, done):
         try:
-            # Check if container exists and get its status
-            result = subprocess.run(
-                ['docker', 'inspect', '--format={{.State.Running}}', container],
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
-            
-            if result.returncode == 0:
-                # Container exists, check if it's running
-                is_running = result.stdout.strip().lower() == 'true'
-                container_status[f'{container}'] = 1 if is_running else 0
+            result = os.statvfs(mountpoint)
+        except OSError as e:
+            logging.getLogger('prometheus_exporter').debug(f"statvfs of {mountpoint} failed: {e}")
+            result = None
+        with self._lock:
+            if result is None:
+                self._cache.pop(mountpoint, None)
             else:
-                # Container doesn't exist
-                container_status[f'{container}'] = 0
-                
-        except (subprocess.TimeoutExpired, subprocess.CalledProcessError, FileNotFoundError) as e:
-            logger.error(f"Error checking container {container} status: {e}")
-            # Docker command failed or doesn't exist
-            container_status[f'{container}'] = 0
-    
-    return container_status
+                self._cache[mountpoint] = result
+            del self._pending[mountpoint]
+        done.set()
 
+    def stats(self, mountpoints) -> dict:
+        """Return mount point -> (statvfs result or None, stale) for every one of mountpoints"""
+        waiting = []
+        with self._lock:
+            for mountpoint in mountpoints:
+                if mountpoint in self._pending:
+                    continue
+                done = Event()
+                self._pending[mountpoint] = done
+                Thread(target=self._statvfs, args=(mountpoint, done), name='statvfs', daemon=True).start()
+                waiting.append(done)
 
-def export_service_status() -> dict:
-    ''' Returns 1 if all containers for a service are running, 0 if any are down '''
-    logger = logging.getLogger('prometheus_exporter')
-    
-    # Define service groups - each service maps to required containers
-    service_groups = {
-        'immich': ['immich_server', 'immich_postgres', 'immich_machine_learning', 'immich_redis'],
-        'homepage': ['homepage-dashboard'],
-        'mealie': ['mealie', 'mealie-postgres'],
-        'caddy': ['caddy'],
-        'filebrowser': ['filebrowser'],
-        'vaultwarden': ['vaultwarden'],
-        'jellyfin': ['jellyfin'],
-        'adguardhome': ['adguardhome']
-    }
+        deadline = time.monotonic() + self.timeout
+        for done in waiting:
+            done.wait(max(deadline - time.monotonic(), 0))
+
+        with self._lock:
+            # Forget unmounted file systems, unless a call for them is still hanging
+            for mountpoint in set(self._cache) - set(mountpoints) - set(self._pending):
+                del self._cache[mountpoint]
+            return {mountpoint: (self._cache.get(mountpoint), mountpoint in self._pending)
+                    for mountpoint in mountpoints}
+
+
+# Global statvfs cache for the filesystems collector
+mount_stats = MountStats()
+
+
+def export_filesystem_usage(fstypes) -> dict:
+    ''' Returns size, free and inode counts for every mount of one of fstypes, keyed by mount point '''
+    mounts = read_mounts(fstypes)
+    usage = {}
+    for mountpoint, (stat, stale) in mount_stats.stats(list(mounts)).items():
+        usage[mountpoint] = dict(mounts[mountpoint], stale=stale)
+        if stat is not None:
+            usage[mountpoint].update(
+                size_bytes=stat.f_blocks * stat.f_frsize,
+                free_bytes=stat.f_bfree * stat.f_frsize,
+                avail_bytes=stat.f_bavail * stat.f_frsize,
+                used_bytes=(stat.f_blocks - stat.f_bfree) * stat.f_frsize,
+                files=stat.f_files,
+                files_free=stat.f_ffree,
+            )
+    return usage
+
+
+class InotifyHints:
+    """Optional inotify watches that mark directories dirty when their contents change"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        self.fd = -1
+        self.watches = {}  # watch descriptor -> directory path
+        self.exhausted = False  # Set once fs.inotify.max_user_watches is reached
+        try:
+            import ctypes
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (ImportError, OSError, AttributeError):
+            self.fd = -1
+
+    @property
+    def available(self):
+        return self.fd >= 0 and not self.exhausted
+
+    def watch(self, path):
+        """Start watching a directory, returns False if no more watches can be added"""
+        if not self.available:
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            import ctypes
+            if ctypes.get_errno() == errno.ENOSPC:
+                logging.getLogger('prometheus_exporter').warning(
+                    "inotify watch limit reached, falling back to mtime checks only")
+                self.exhausted = True
+            return False
+        self.watches[wd] = path
+        return True
+
+    def drain(self):
+        """Return the set of directories changed since the last call, or None if events were lost"""
+        dirty = set()
+        if self.fd < 0:
+            return dirty
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return dirty
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                if mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                elif wd in self.watches:
+                    dirty.add(self.watches[wd])
+
+
+class DirectorySizeEngine:
+    """Incrementally maintained apparent sizes (like `du -sb`) of each directory under a base path
+
+    Every directory's own file bytes are cached against its (device, inode, mtime).
+    A refresh stats each directory but only re-lists the ones that changed, so a
+    warm pass costs O(directories) instead of O(files). Directory mtimes don't
+    change when a file grows in place, so inotify hints (when available) and a
+    periodic full rescan cover that case. Work is done on a background thread in
+    slices of `budget` seconds followed by `pause` seconds of idle time, and walks
+    resume where they stopped, so a cold walk of a huge library never hogs the disk.
+    """
+
+    def __init__(self, base_path="/srv", budget=2.0, pause=8.0, full_rescan_interval=86400, use_inotify=True):
+        self.base_path = base_path
+        self.budget = budget
+        self.pause = pause
+        self.full_rescan_interval = full_rescan_interval
+        self.use_inotify = use_inotify
+        self.hints = None  # InotifyHints, set up by the first refresh
+        self._dirs = {}  # directory -> (stat key, own file bytes, subdirectories, scanned at)
+        self._pending = []  # (app name, app directory) still to walk in the current pass
+        self._walks = {}  # app directory -> in-progress walk state
+        self._totals = {}  # app name -> last completed size in bytes
+        self._dirty = set()  # directories flagged by inotify that still need a rescan
+        self._lock = Lock()  # Guards _totals
+        self._walk_lock = Lock()  # Held for a whole refresh slice so the walk state can't be swapped mid-walk
+        self.stop_event = None
+
+    def start(self):
+        """Start refreshing sizes on a background thread (no-op if already running)"""
+        if self.stop_event is not None and not self.stop_event.is_set():
+            return
+        self.stop_event = Event()
+        Thread(target=self._run, args=(self.stop_event,), name="directory-size-engine", daemon=True).start()
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    def set_base_path(self, base_path):
+        """Point the engine at another base path, dropping everything cached for the old one"""
+        if base_path == self.base_path:
+            return
+        with self._walk_lock, self._lock:
+            self.base_path = base_path
+            self._dirs = {}
+            self._pending = []
+            self._walks = {}
+            self._totals = {}
+            self._dirty = set()
+
+    def sizes(self) -> dict:
+        """Return the last completed size in bytes of every app directory"""
+        with self._lock:
+            return dict(self._totals)
+
+    def refresh(self, budget=None) -> bool:
+        """Advance the current pass over the app directories, returns True once the pass completed"""
+        # The background worker and direct callers (e.g. the benchmark) may refresh at the same time
+        with self._walk_lock:
+            return self._refresh(budget)
+
+    def _refresh(self, budget):
+        logger = logging.getLogger('prometheus_exporter')
+        deadline = time.monotonic() + (self.budget if budget is None else budget)
+
+        if self.use_inotify and self.hints is None:
+            self.hints = InotifyHints()
+        if self.hints:
+            changed = self.hints.drain()
+            # None means the kernel dropped events, so any directory might have changed
+            self._dirty.update(set(self._dirs) if changed is None else changed)
+
+        if not self._pending:
+            # Start a new pass over every app directory
+            try:
+                apps = [entry for entry in os.scandir(self.base_path) if entry.is_dir(follow_symlinks=False)]
+            except OSError as e:
+                logger.error(f"Error listing {self.base_path}: {e}")
+                return True
+            self._pending = [(app.name, app.path) for app in apps]
+            names = {app.name for app in apps}
+            with self._lock:
+                for name in list(self._totals):
+                    if name not in names:
+                        del self._totals[name]
+                        self._prune(os.path.join(self.base_path, name), set())
+
+        while self._pending:
+            name, path = self._pending[0]
+            walk = self._walks.setdefault(path, {'stack': [path], 'total': 0, 'seen': set()})
+            if not self._step(walk, deadline):
+                return False
+            self._pending.pop(0)
+            del self._walks[path]
+            self._prune(path, walk['seen'])
+            with self._lock:
+                self._totals[name] = walk['total']
+        return True
+
+    def _run(self, stop_event):
+        while not stop_event.is_set():
+            completed = self.refresh()
+            # Come back sooner while a pass is unfinished, e.g. during a cold walk
+            stop_event.wait(self.pause if completed else self.pause / 4)
+
+    def _step(self, walk, deadline) -> bool:
+        now = time.time()
+        stack = walk['stack']
+        while stack:
+            path = stack.pop()
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                continue
+            key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+            cached = self._dirs.get(path)
+            if (cached is None or cached[0] != key or path in self._dirty
+                    or now - cached[3] > self.full_rescan_interval):
+                cached = self._scan(path, key, now)
+            walk['seen'].add(path)
+            walk['total'] += st.st_size + cached[1]
+            stack.extend(cached[2])
+            if stack and time.monotonic() > deadline:
+                return False
+        return True
+
+    def _scan(self, path, key, now):
+        own_bytes = 0
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        else:
+                            own_bytes += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.getLogger('prometheus_exporter').error(f"Error scanning directory {path}: {e}")
+        if self.hints:
+            self.hints.watch(path)
+        self._dirty.discard(path)
+        entry = (key, own_bytes, subdirs, now)
+        self._dirs[path] = entry
+        return entry
+
+    def _prune(self, root, seen):
+        # Forget directories that were removed since the previous walk
+        prefix = root + os.sep
+        for path in [p for p in self._dirs if (p == root or p.startswith(prefix)) and p not in seen]:
+            del self._dirs[path]
+            self._dirty.discard(path)
+
+
+# Global engine that keeps /srv app sizes up to date
+app_disk_engine = DirectorySizeEngine(base_path="/srv")
+
+
+def export_app_disk_usage() -> dict:
+    ''' Returns disk usage in bytes for each directory under the engine's base path '''
+    return app_disk_engine.sizes()
+
+
+class StateTable:
+    """Latest state of each watched unit or container, with its transition history
+
+    A restart is a return to running after having been seen running and then not
+    running, so a crash and automatic restart between two scrapes is still counted.
+    An entry with flap_threshold restarts within flap_window seconds is flapping.
+    """
+
+    def __init__(self, flap_window=600, flap_threshold=3):
+        self.flap_window = flap_window
+        self.flap_threshold = flap_threshold
+        self._lock = Lock()
+        # name -> {'state', 'running', 'seen_running', 'last_transition', 'restarts', 'recent_restarts'}
+        self._entries = {}
+
+    def update(self, name, state, running, timestamp=None):
+        """Record the current state of name, timestamp (epoch seconds) defaults to now for a transition"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                # First sight, the time it got into this state is only known if the source says so
+                self._entries[name] = {'state': state, 'running': running, 'seen_running': running,
+                                       'last_transition': timestamp, 'restarts': 0, 'recent_restarts': deque()}
+                return
+            entry['state'] = state
+            if running == entry['running']:
+                return
+            entry['running'] = running
+            entry['last_transition'] = time.time() if timestamp is None else timestamp
+            if running and entry['seen_running']:
+                entry['restarts'] += 1
+                entry['recent_restarts'].append(time.monotonic())
+            entry['seen_running'] = entry['seen_running'] or running
+
+    def retain(self, names):
+        """Forget every entry not in names"""
+        with self._lock:
+            for name in set(self._entries) - set(names):
+                del self._entries[name]
+
+    def snapshot(self) -> dict:
+        """Return name -> {'state', 'running', 'last_transition', 'restarts', 'flapping'}"""
+        cutoff = time.monotonic() - self.flap_window
+        with self._lock:
+            snapshot = {}
+            for name, entry in self._entries.items():
+                recent = entry['recent_restarts']
+                while recent and recent[0] < cutoff:
+                    recent.popleft()
+                snapshot[name] = {
+                    'state': entry['state'],
+                    'running': entry['running'],
+                    'last_transition': entry['last_transition'],
+                    'restarts': entry['restarts'],
+                    'flapping': len(recent) >= self.flap_threshold,
+                }
+            return snapshot
+
+
+# D-Bus wire format: alignment of every type code, and the struct format of the fixed size ones
+DBUS_ALIGNMENT = {'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4, 'x': 8, 't': 8, 'd': 8, 'h': 4,
+                  's': 4, 'o': 4, 'g': 1, 'v': 1, 'a': 4, '(': 8, '{': 8}
+DBUS_FIXED = {'y': 'B', 'b': 'I', 'n': 'h', 'q': 'H', 'i': 'i', 'u': 'I', 'x': 'q', 't': 'Q', 'd': 'd', 'h': 'I'}
+
+
+def dbus_split_signature(signature) -> list:
+    """Split a D-Bus signature into its complete types, e.g. 'sa{sv}as' -> ['s', 'a{sv}', 'as']"""
+    types = []
+    start = 0
+    while start < len(signature):
+        end = start
+        while signature[end] == 'a':
+            end += 1
+        depth = 0
+        while True:
+            if signature[end] in '({':
+                depth += 1
+            elif signature[end] in ')}':
+                depth -= 1
+            end += 1
+            if depth == 0:
+                break
+        types.append(signature[start:end])
+        start = end
+    return types
+
+
+def dbus_marshal(buf, signature, value):
+    """Append value, of the single complete type signature, to buf in little-endian D-Bus format
+
+    Variants are given as (signature, value), dict entries as (key, value) and
+    arrays of dict entries as dicts.
+    """
+    code = signature[0]
+    buf.extend(b'\0' * (-len(buf) % DBUS_ALIGNMENT[code]))
+    if code in DBUS_FIXED:
+        buf.extend(struct.pack('<' + DBUS_FIXED[code], value))
+    elif code in 'so':
+        data = value.encode()
+        buf.extend(struct.pack('<I', len(data)) + data + b'\0')
+    elif code == 'g':
+        data = value.encode()
+        buf.extend(struct.pack('<B', len(data)) + data + b'\0')
+    elif code == 'v':
+        dbus_marshal(buf, 'g', value[0])
+        dbus_marshal(buf, value[0], value[1])
+    elif code == 'a':
+        length_at = len(buf)
+        buf.extend(b'\0\0\0\0')
+        element = signature[1:]
+        # The padding to the first element counts towards neither the length nor an empty array
+        buf.extend(b'\0' * (-len(buf) % DBUS_ALIGNMENT[element[0]]))
+        start = len(buf)
+        for item in (value.items() if element[0] == '{' else value):
+            dbus_marshal(buf, element, item)
+        struct.pack_into('<I', buf, length_at, len(buf) - start)
+    else:
+        for field_signature, field in zip(dbus_split_signature(signature[1:-1]), value):
+            dbus_marshal(buf, field_signature, field)
+
+
+def dbus_unmarshal(data, offset, signature, endian='<'):
+    """Read one value of the single complete type signature at offset, returning (value, next offset)
+
+    Variants are returned as their bare value, structs as lists and arrays of dict entries as dicts.
+    """
+    code = signature[0]
+    offset += -offset % DBUS_ALIGNMENT[code]
+    if code in DBUS_FIXED:
+        fmt = endian + DBUS_FIXED[code]
+        value = struct.unpack_from(fmt, data, offset)[0]
+        return (bool(value) if code == 'b' else value), offset + struct.calcsize(fmt)
+    if code in 'so':
+        (length,) = struct.unpack_from(endian + 'I', data, offset)
+        offset += 4
+        return bytes(data[offset:offset + length]).decode(), offset + length + 1
+    if code == 'g':
+        length = data[offset]
+        return bytes(data[offset + 1:offset + 1 + length]).decode(), offset + length + 2
+    if code == 'v':
+        inner, offset = dbus_unmarshal(data, offset, 'g', endian)
+        return dbus_unmarshal(data, offset, inner, endian)
+    if code == 'a':
+        (length,) = struct.unpack_from(endian + 'I', data, offset)
+        element = signature[1:]
+        offset += 4
+        offset += -offset % DBUS_ALIGNMENT[element[0]]
+        end = offset + length
+        items = []
+        while offset < end:
+            item, offset = dbus_unmarshal(data, offset, element, endian)
+            items.append(item)
+        return (dict(items) if element[0] == '{' else items), offset
+    fields = []
+    for field_signature in dbus_split_signature(signature[1:-1]):
+        field, offset = dbus_unmarshal(data, offset, field_signature, endian)
+        fields.append(field)
+    return fields, offset
+
+
+class DBusError(Exception):
+    """An error reply to a D-Bus method call"""
+
+
+class DBusConnection:
+    """Minimal blocking D-Bus client: EXTERNAL auth over a Unix socket, method calls and signals"""
+
+    METHOD_CALL, METHOD_RETURN, ERROR, SIGNAL = 1, 2, 3, 4
+    # Header field code -> (name, type)
+    HEADER_FIELDS = {1: ('path', 'o'), 2: ('interface', 's'), 3: ('member', 's'), 4: ('error_name', 's'),
+                     5: ('reply_serial', 'u'), 6: ('destination', 's'), 7: ('sender', 's'), 8: ('signature', 'g')}
+
+    def __init__(self, socket_path='/run/dbus/system_bus_socket', timeout=10):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self._serial = 0
+        self._buffer = bytearray()
+        # Signals that arrived while waiting for a method reply
+        self._signals = deque()
+
+    def connect(self):
+        """Connect, authenticate as our own uid and register with the bus"""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+        # A nul byte (which carries our credentials), then the uid hex-encoded as ASCII
+        self.sock.sendall(b'\0AUTH EXTERNAL ' + str(os.getuid()).encode().hex().encode() + b'\r\n')
+        while b'\r\n' not in self._buffer:
+            self._fill()
+        line, _, rest = bytes(self._buffer).partition(b'\r\n')
+        self._buffer = bytearray(rest)
+        if not line.startswith(b'OK '):
+            raise DBusError(f"D-Bus authentication failed: {line.decode(errors='replace')}")
+        self.sock.sendall(b'BEGIN\r\n')
+        self.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'Hello')
+
+    def close(self):
+        """Close the connection, waking up a thread blocked reading it"""
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def _fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("D-Bus connection closed")
+        self._buffer.extend(chunk)
+
+    def _read(self, size) -> bytearray:
+        while len(self._buffer) < size:
+            self._fill()
+        data = self._buffer[:size]
+        del self._buffer[:size]
+        return data
+
+    def send(self, message_type, fields, signature='', args=()) -> int:
+        """Send a message with header fields {code: value}, returning its serial"""
+        self._serial += 1
+        body = bytearray()
+        for type_signature, arg in zip(dbus_split_signature(signature), args):
+            dbus_marshal(body, type_signature, arg)
+        if signature:
+            fields = dict(fields)
+            fields[8] = signature
+        header = bytearray(b'l' + bytes((message_type, 0, 1)) + struct.pack('<II', len(body), self._serial))
+        dbus_marshal(header, 'a(yv)', [(code, (self.HEADER_FIELDS[code][1], value)) for code, value in fields.items()])
+        header.extend(b'\0' * (-len(header) % 8))
+        self.sock.sendall(header + body)
+        return self._serial
+
+    def receive(self):
+        """Read the next message, returning (message type, {field name: value}, body arguments)"""
+        fixed = self._read(16)
+        endian = '<' if fixed[0:1] == b'l' else '>'
+        body_length, _, fields_length = struct.unpack_from(endian + 'III', fixed, 4)
+        header_length = 16 + fields_length + (-(16 + fields_length) % 8)
+        data = fixed + self._read(header_length - 16 + body_length)
+        raw_fields, _ = dbus_unmarshal(data, 12, 'a(yv)', endian)
+        fields = {self.HEADER_FIELDS[code][0]: value for code, value in raw_fields if code in self.HEADER_FIELDS}
+        body = data[header_length:]
+        args = []
+        offset = 0
+        for type_signature in dbus_split_signature(fields.get('signature', '')):
+            arg, offset = dbus_unmarshal(body, offset, type_signature, endian)
+            args.append(arg)
+        return fixed[1], fields, args
+
+    def call(self, destination, path, interface, member, signature='', args=()) -> list:
+        """Call a method and return the arguments of its reply, raising DBusError on an error reply"""
+        serial = self.send(self.METHOD_CALL, {1: path, 2: interface, 3: member, 6: destination}, signature, args)
+        while True:
+            message_type, fields, body = self.receive()
+            if message_type == self.SIGNAL:
+                self._signals.append((fields, body))
+            elif fields.get('reply_serial') == serial:
+                if message_type == self.ERROR:
+                    raise DBusError(f"{fields.get('error_name')}: {body[0] if body else ''}")
+                return body
+
+    def signals(self):
+        """Yield (header fields, body arguments) of every signal as it arrives"""
+        while True:
+            while self._signals:
+                yield self._signals.popleft()
+            message_type, fields, body = self.receive()
+            if message_type == self.SIGNAL:
+                yield fields, body
+
+
+def systemd_unit_name(unit) -> str:
+    """Return the full unit name, systemctl style: a name without a type suffix is a service"""
+    return unit if '.' in unit else f'{unit}.service'
+
+
+class UnitStateWatcher:
+    """Follows the state of systemd units over D-Bus instead of forking systemctl on every scrape
+
+    Subscribes to PropertiesChanged of every watched unit, reads their current
+    state once after subscribing (so no change falls in between), then applies the
+    signals systemd sends. Reconnects and resyncs when the bus connection drops or
+    resync_interval passes without a signal.
+    """
+
+    SYSTEMD = 'org.freedesktop.systemd1'
+    MANAGER_PATH = '/org/freedesktop/systemd1'
+    MANAGER_INTERFACE = 'org.freedesktop.systemd1.Manager'
+    UNIT_INTERFACE = 'org.freedesktop.systemd1.Unit'
+    PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+    # ActiveStates in which a unit counts as running
+    RUNNING_STATES = ('active', 'reloading')
+
+    def __init__(self, socket_path='/run/dbus/system_bus_socket', timeout=10, resync_interval=300):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.resync_interval = resync_interval
+        self.units = []
+        self.table = StateTable()
+        self._synced = False
+        self._reconnect = False
+        self._connection = None
+        self._lock = Lock()
+        self.stop_event = None
+
+    def configure(self, units, socket_path):
+        """Set the watched units, resubscribing straight away if they changed"""
+        units = sorted({systemd_unit_name(unit) for unit in units})
+        with self._lock:
+            if units == self.units and socket_path == self.socket_path:
+                return
+            self.units = units
+            self.socket_path = socket_path
+            self._reconnect = True
+            connection = self._connection
+        if connection is not None:
+            connection.close()
+
+    def start(self):
+        """Start watching on a background thread (no-op if already running)"""
+        if self.stop_event is not None and not self.stop_event.is_set():
+            return
+        self.stop_event = Event()
+        Thread(target=self._run, args=(self.stop_event,), name="systemd-watcher", daemon=True).start()
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+        with self._lock:
+            self._synced = False
+            connection = self._connection
+        if connection is not None:
+            connection.close()
+
+    def states(self):
+        """Return unit -> state and transition history, or None until the first sync succeeded"""
+        with self._lock:
+            if not self._synced:
+                return None
+        return self.table.snapshot()
+
+    def _update(self, connection, unit, path, changed=None):
+        """Apply a unit's changed properties, reading them from systemd when not given"""
+        if changed is None or 'ActiveState' not in changed:
+            changed = {}
+            for name in ('ActiveState', 'StateChangeTimestamp'):
+                changed[name] = connection.call(self.SYSTEMD, path, self.PROPERTIES_INTERFACE, 'Get', 'ss',
+                                                (self.UNIT_INTERFACE, name))[0]
+        state = changed['ActiveState']
+        # Microseconds since the epoch, 0 if the unit never changed state
+        timestamp = changed.get('StateChangeTimestamp') or None
+        self.table.update(unit, state, state in self.RUNNING_STATES, timestamp and timestamp / 1_000_000)
+
+    def _watch(self, stop_event):
+        with self._lock:
+            units = list(self.units)
+            connection = self._connection = DBusConnection(self.socket_path, self.timeout)
+            self._reconnect = False
+        connection.connect()
+        # systemd only sends unit signals once some client subscribed
+        connection.call(self.SYSTEMD, self.MANAGER_PATH, self.MANAGER_INTERFACE, 'Subscribe')
+        paths = {}
+        for unit in units:
+            # LoadUnit (unlike GetUnit) also works for units that aren't loaded yet
+            path = connection.call(self.SYSTEMD, self.MANAGER_PATH, self.MANAGER_INTERFACE, 'LoadUnit', 's',
+                                   (unit,))[0]
+            paths[path] = unit
+            rule = (f"type='signal',sender='{self.SYSTEMD}',interface='{self.PROPERTIES_INTERFACE}',"
+                    f"member='PropertiesChanged',path='{path}'")
+            connection.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'AddMatch',
+                            's', (rule,))
+        for path, unit in paths.items():
+            self._update(connection, unit, path)
+        self.table.retain(units)
+        with self._lock:
+            self._synced = True
+
+        # Silence for resync_interval times the read out, which triggers a full resync
+        connection.sock.settimeout(self.resync_interval)
+        for fields, body in connection.signals():
+            if stop_event.is_set():
+                return
+            unit = paths.get(fields.get('path'))
+            if unit is not None and fields.get('member') == 'PropertiesChanged' and body[0] == self.UNIT_INTERFACE:
+                if 'ActiveState' in body[1] or 'ActiveState' in body[2]:
+                    self._update(connection, unit, fields['path'], body[1])
+
+    def _run(self, stop_event):
+        logger = logging.getLogger('prometheus_exporter')
+        while not stop_event.is_set():
+            try:
+                self._watch(stop_event)
+            except socket.timeout:
+                continue
+            except Exception as e:
+                if stop_event.is_set():
+                    return
+                with self._lock:
+                    reconnect = self._reconnect
+                    if not reconnect:
+                        self._synced = False
+                if reconnect:
+                    continue
+                logger.error(f"Error watching systemd units over D-Bus: {e}")
+                stop_event.wait(10)
+            finally:
+                with self._lock:
+                    connection, self._connection = self._connection, None
+                if connection is not None:
+                    connection.close()
+
+
+# Global systemd unit watcher, only started when the systemd or tailscale collector is enabled
+unit_watcher = UnitStateWatcher()
+
+
+def export_unit_states() -> dict:
+    ''' Returns the state, last transition time, restart count and flapping flag of every watched systemd unit '''
+    states = unit_watcher.states()
+    if states is None:
+        raise RuntimeError("systemd unit watcher has not synced with D-Bus")
+    return states
+
+
+def export_tailscale_status(unit='tailscaled', timeout=5):
+    ''' Returns 1 if Tailscale service is running, 0 if stopped/failed '''
+    states = unit_watcher.states()
+    if states is not None and systemd_unit_name(unit) in states:
+        return 1 if states[systemd_unit_name(unit)]['state'] == 'active' else 0
+
+    # Watcher isn't running or hasn't synced yet
+    # Raises if systemctl itself fails or hangs, which isn't the same as the unit being down
+    result = self_profiler.run_subprocess(
+        'systemctl',
+        ['systemctl', 'is-active', unit],
+        capture_output=True,
+        text=True,
+        timeout=timeout
+    )
+    
+    return 1 if result.stdout.strip() == 'active' else 0
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection that talks to a Unix domain socket instead of TCP"""
+
+    def __init__(self, socket_path, timeout=10):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+# Errors raised when the other end closed a kept-alive connection while it sat idle
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+def request_with_retry(get_connection, discard_connection, method, path, **kwargs):
+    """Send a request on a kept-alive connection and read the response, returning (connection, response, body)
+
+    The server may have closed an idle keep-alive connection, so a request that fails
+    that way is retried once on a fresh one from get_connection. A connection that
+    failed is passed to discard_connection; after a response the caller decides
+    whether to keep it (see response.will_close).
+    """
+    for attempt in range(2):
+        conn = get_connection()
+        try:
+            conn.request(method, path, **kwargs)
+            response = conn.getresponse()
+            return conn, response, response.read()
+        except STALE_CONNECTION_ERRORS:
+            discard_connection(conn)
+            if attempt:
+                raise
+        except Exception:
+            discard_connection(conn)
+            raise
+
+
+class DockerClient:
+    """Minimal Docker Engine API client with a small pool of keep-alive connections"""
+
+    def __init__(self, socket_path='/var/run/docker.sock', timeout=10, pool_size=2):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool = []
+        self._lock = Lock()
+
+    def _get_connection(self):
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+        return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+
+    def _release_connection(self, conn):
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def get(self, path):
+        """GET an API path and return the decoded JSON body"""
+        conn, response, body = request_with_retry(self._get_connection, lambda conn: conn.close(), 'GET', path)
+        if response.will_close:
+            conn.close()
+        else:
+            self._release_connection(conn)
+        if response.status != 200:
+            raise OSError(f"Docker API {path} returned HTTP {response.status}")
+        return json.loads(body)
+
+    def containers(self) -> dict:
+        """Return name -> {'id', 'state', 'network_mode'} for every container from a single API call"""
+        containers = {}
+        for container in self.get('/containers/json?all=1'):
+            for name in container.get('Names', []):
+                containers[name.lstrip('/')] = {
+                    'id': container.get('Id', ''),
+                    'state': container.get('State', ''),
+                    'network_mode': container.get('HostConfig', {}).get('NetworkMode', ''),
+                }
+        return containers
+
+    def container_states(self) -> dict:
+        """Return the state (running, exited, ...) of every container from a single API call"""
+        return {name: container['state'] for name, container in self.containers().items()}
+
+    def events(self, since=None, timeout=None):
+        """Yield container events from the /events stream until it ends or times out"""
+        filters = urllib.parse.quote(json.dumps({'type': ['container']}))
+        path = f'/events?filters={filters}'
+        if since is not None:
+            path += f'&since={since}'
+        # The stream holds its connection open, so it gets its own instead of one from the pool
+        conn = UnixHTTPConnection(self.socket_path, timeout=timeout)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise OSError(f"Docker API /events returned HTTP {response.status}")
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            conn.close()
+
+
+class ContainerStateCache:
+    """Containers loaded with one list call and kept current from the Docker event stream"""
+
+    # Event actions that change whether a container is running. kill is left out: it is sent for
+    # every signal (e.g. HUP for a config reload), and a kill that ends the container is followed by die.
+    EVENT_STATES = {
+        'start': 'running',
+        'restart': 'running',
+        'unpause': 'running',
+        'pause': 'paused',
+        'die': 'exited',
+        'stop': 'exited',
+        'oom': 'exited',
+        'destroy': None,
+    }
+
+    def __init__(self, client, resync_interval=300):
+        self.client = client
+        self.resync_interval = resync_interval
+        self._containers = {}  # name -> {'id', 'state', 'network_mode'}
+        self._synced = False
+        self._lock = Lock()
+        # Transition history per container name, kept across recreates with the same name
+        self.table = StateTable()
+        self.stop_event = None
+
+    def start(self):
+        """Start following Docker events on a background thread (no-op if already running)"""
+        if self.stop_event is not None and not self.stop_event.is_set():
+            return
+        self.stop_event = Event()
+        Thread(target=self._run, args=(self.stop_event,), name="docker-events", daemon=True).start()
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+        with self._lock:
+            self._synced = False
+
+    def states(self):
+        """Return the latest container states, or None until the first sync succeeded"""
+        with self._lock:
+            if not self._synced:
+                return None
+            return {name: container['state'] for name, container in self._containers.items()}
+
+    def containers(self):
+        """Return the latest id, state and network mode of every container, or None until the first sync"""
+        with self._lock:
+            if not self._synced:
+                return None
+            return {name: dict(container) for name, container in self._containers.items()}
+
+    def history(self):
+        """Return the state and transition history of every container, or None until the first sync"""
+        with self._lock:
+            if not self._synced:
+                return None
+        return self.table.snapshot()
+
+    def sync(self):
+        """Replace all containers with a fresh list call"""
+        containers = self.client.containers()
+        # Transitions missed while the event stream was down are recorded as happening now
+        for name, container in containers.items():
+            self.table.update(name, container['state'], container['state'] == 'running')
+        self.table.retain(containers)
+        with self._lock:
+            self._containers = containers
+            self._synced = True
+
+    def apply_event(self, event):
+        """Update the state table from one Docker event"""
+        action = event.get('Action') or event.get('status', '')
+        # Actions like "exec_start: sh" or "health_status: healthy" don't change the run state
+        if action not in self.EVENT_STATES:
+            return
+        actor = event.get('Actor', {})
+        name = actor.get('Attributes', {}).get('name')
+        if not name:
+            return
+        with self._lock:
+            if self.EVENT_STATES[action] is None:
+                self._containers.pop(name, None)
+                return
+            # Events don't carry the network mode, a new container gets it on the next resync
+            container = self._containers.setdefault(
+                name, {'id': actor.get('ID') or event.get('id', ''), 'network_mode': None})
+            container['state'] = self.EVENT_STATES[action]
+        timestamp = event['timeNano'] / 1e9 if event.get('timeNano') else event.get('time')
+        self.table.update(name, self.EVENT_STATES[action], self.EVENT_STATES[action] == 'running', timestamp)
+
+    def _run(self, stop_event):
+        logger = logging.getLogger('prometheus_exporter')
+        while not stop_event.is_set():
+            try:
+                since = int(time.time())
+                self.sync()
+                # The stream times out after resync_interval of silence, which triggers a full resync
+                for event in self.client.events(since=since, timeout=self.resync_interval):
+                    self.apply_event(event)
+                    if stop_event.is_set():
+                        return
+            except socket.timeout:
+                continue
+            except Exception as e:
+                logger.error(f"Error following Docker events: {e}")
+                with self._lock:
+                    self._synced = False
+                stop_event.wait(10)
+
+
+# Global Docker client and the event-driven container state cache built on it
+docker_client = DockerClient()
+container_state_cache = ContainerStateCache(docker_client)
+
+
+class ContainerCgroupReader:
+    """Reads per-container resource usage straight from the cgroup v2 files of each container
+
+    Handles both the systemd cgroup driver (system.slice/docker-<id>.scope) and
+    the cgroupfs driver (docker/<id>).
+    """
+
+    def __init__(self, cgroup_root='/sys/fs/cgroup'):
+        self.cgroup_root = cgroup_root
+
+    def scopes(self) -> dict:
+        """Return container id -> cgroup directory for every running container"""
+        if not os.path.exists(os.path.join(self.cgroup_root, 'cgroup.controllers')):
+            raise OSError(f"No cgroup v2 hierarchy mounted at {self.cgroup_root}")
+
+        scopes = {}
+        for parent, prefix, suffix in (('system.slice', 'docker-', '.scope'), ('docker', '', '')):
+            try:
+                entries = os.scandir(os.path.join(self.cgroup_root, parent))
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    name = entry.name
+                    if not (name.startswith(prefix) and name.endswith(suffix)) or not entry.is_dir():
+                        continue
+                    container_id = name[len(prefix):len(name) - len(suffix)]
+                    if len(container_id) == 64:
+                        scopes[container_id] = entry.path
+        return scopes
+
+    @staticmethod
+    def _read_keyed(path) -> dict:
+        """Parse a flat-keyed cgroup file ("key value" per line)"""
+        values = {}
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(' ')
+                values[key] = int(value)
+        return values
+
+    @staticmethod
+    def _read_io(path) -> dict:
+        """Sum the per-device counters of io.stat ("8:0 rbytes=... wbytes=... rios=... wios=...")"""
+        totals = {}
+        with open(path) as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    key, _, value = field.partition('=')
+                    totals[key] = totals.get(key, 0) + int(value)
+        return totals
+
+    @staticmethod
+    def _read_network(scope) -> dict:
+        """Sum the interface counters of the container's network namespace, read through one of its processes"""
+        with open(os.path.join(scope, 'cgroup.procs')) as f:
+            pid = f.readline().strip()
+        if not pid:
+            return {}
+        totals = {'rx_bytes': 0, 'rx_packets': 0, 'tx_bytes': 0, 'tx_packets': 0}
+        with open(f'/proc/{pid}/net/dev') as f:
+            # Two header lines, then "iface: rx_bytes rx_packets ... (8 rx fields) tx_bytes tx_packets ..."
+            for line in f.readlines()[2:]:
+                interface, _, counters = line.partition(':')
+                if interface.strip() == 'lo':
+                    continue
+                fields = counters.split()
+                totals['rx_bytes'] += int(fields[0])
+                totals['rx_packets'] += int(fields[1])
+                totals['tx_bytes'] += int(fields[8])
+                totals['tx_packets'] += int(fields[9])
+        return totals
+
+    def read(self, scope, network=True) -> dict:
+        """Return the CPU, memory, block I/O and (optionally) network usage of one container scope"""
+        cpu = self._read_keyed(os.path.join(scope, 'cpu.stat'))
+        memory = self._read_keyed(os.path.join(scope, 'memory.stat'))
+        io = self._read_io(os.path.join(scope, 'io.stat'))
+        with open(os.path.join(scope, 'memory.current')) as f:
+            memory_current = int(f.read())
+        with open(os.path.join(scope, 'memory.max')) as f:
+            memory_max = f.read().strip()
+
+        usage = {
+            'cpu_usage_seconds': cpu.get('usage_usec', 0) / 1_000_000,
+            'cpu_user_seconds': cpu.get('user_usec', 0) / 1_000_000,
+            'cpu_system_seconds': cpu.get('system_usec', 0) / 1_000_000,
+            'cpu_throttled_seconds': cpu.get('throttled_usec', 0) / 1_000_000,
+            'memory_usage_bytes': memory_current,
+            'memory_limit_bytes': None if memory_max == 'max' else int(memory_max),
+            'memory_anon_bytes': memory.get('anon', 0),
+            'memory_file_bytes': memory.get('file', 0),
+            'block_read_bytes': io.get('rbytes', 0),
+            'block_write_bytes': io.get('wbytes', 0),
+            'block_reads': io.get('rios', 0),
+            'block_writes': io.get('wios', 0),
+        }
+        if network:
+            net = self._read_network(scope)
+            if net:
+                usage.update(network_receive_bytes=net['rx_bytes'], network_receive_packets=net['rx_packets'],
+                             network_transmit_bytes=net['tx_bytes'], network_transmit_packets=net['tx_packets'])
+        return usage
+
+
+# Global cgroup reader for per-container resource usage
+container_cgroups = ContainerCgroupReader()
+
+
+def export_container_status(container_names=None) -> dict:
+    ''' Returns 1 if container is running, 0 if stopped/doesn't exist '''
+    states = container_state_cache.states()
+    if states is None:
+        # Event stream isn't running or hasn't synced yet, fall back to a single list call
+        # (raises if Docker is unreachable, rather than reporting every container as down)
+        states = docker_client.container_states()
+
+    return {container: 1 if states.get(container) == 'running' else 0 for container in container_names}
+
+
+def export_container_resources() -> dict:
+    ''' Returns cgroup v2 resource usage of every running container, keyed by container name '''
+    containers = container_state_cache.containers()
+    if containers is None:
+        containers = docker_client.containers()
+    scopes = container_cgroups.scopes()
+
+    usage = {}
+    for name, container in containers.items():
+        scope = scopes.get(container['id'])
+        if container['state'] != 'running' or scope is None:
+            continue
+        # Containers on the host's (or another container's) network would just repeat that namespace's traffic
+        mode = container['network_mode']
+        network = mode is not None and mode != 'host' and not mode.startswith('container:')
+        try:
+            usage[name] = container_cgroups.read(scope, network=network)
+        except FileNotFoundError:
+            # Container stopped between listing and reading
+            continue
+    return usage
+
+
+def export_service_status(service_groups) -> dict:
+    ''' Returns 1 if all containers for a service are running, 0 if any are down '''
+    logger = logging.getLogger('prometheus_exporter')
     
     service_status = {}
     
@@ -408,38 +2372,45 @@ def export_service_status() -> dict:
                 logger.debug(f"Service {service} is down - container {container} not running")
                 break
         
-        service_status[f'{service}_running'] = service_up
+        service_status[service] = service_up
         if service_up:
             logger.debug(f"Service {service} is up - all containers running")
     
     return service_status
 
 
+def export_service_history(service_groups) -> dict:
+    ''' Returns the last transition time, restart count and flapping flag of each service's containers combined '''
+    history = container_state_cache.history()
+    if history is None:
+        raise RuntimeError("Docker event stream has not synced")
+
+    services = {}
+    for service, containers in service_groups.items():
+        entries = [history[container] for container in containers if container in history]
+        transitions = [entry['last_transition'] for entry in entries if entry['last_transition'] is not None]
+        services[service] = {
+            'last_transition': max(transitions) if transitions else None,
+            'restarts': sum(entry['restarts'] for entry in entries),
+            'flapping': any(entry['flapping'] for entry in entries),
+        }
+    return services
+
+
+def export_backup_status(status_file) -> dict:
+    ''' Returns the latest backup result of every app, empty until the first backup ran '''
+    try:
+        with open(status_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
 def export_internet_status(test_hosts=None) -> int:
-    ''' Returns 1 if internet is up (can ping external servers), 0 if down '''
-    logger = logging.getLogger('prometheus_exporter')
-        
-    for host in test_hosts:
-        try:
-            # Ping with 1 packet, 3 second timeout
-            result = subprocess.run(
-                ['ping', '-c', '1', '-W', '3', host],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            
-            # If any ping succeeds, internet is up
-            if result.returncode == 0:
-                return 1
-                
-        except (subprocess.TimeoutExpired, subprocess.CalledProcessError, FileNotFoundError) as e:
-            logger.error(f"Error checking internet status for host {host}: {e}")
-            # Continue to next host if this one fails
-            continue
-    
-    # All pings failed
-    return 0
+    ''' Returns 1 if internet is up (any external server answered a probe), 0 if down '''
+    # One-off reachability check, kept out of the latency collector's windows and histograms
+    replies = network_prober.probe(test_hosts, count=1, record=False)
+    return 1 if any(replies.values()) else 0
 
 
 def export_network_speed():
@@ -451,104 +2422,1503 @@ def export_network_speed():
     }
 
 
-def export_network_latency():
-    """Export network latency metrics"""
-    latency = network_monitor.measure_latency()
+# Counter fields of psutil's per-NIC stats and the counter family each is exported as
+NETWORK_INTERFACE_COUNTERS = (
+    ('bytes_recv', 'network_receive_bytes', 'Bytes received per interface'),
+    ('bytes_sent', 'network_transmit_bytes', 'Bytes sent per interface'),
+    ('packets_recv', 'network_receive_packets', 'Packets received per interface'),
+    ('packets_sent', 'network_transmit_packets', 'Packets sent per interface'),
+    ('errin', 'network_receive_errors', 'Receive errors per interface'),
+    ('errout', 'network_transmit_errors', 'Transmit errors per interface'),
+    ('dropin', 'network_receive_drop', 'Inbound packets dropped per interface'),
+    ('dropout', 'network_transmit_drop', 'Outbound packets dropped per interface'),
+)
+
+
+def export_network_interface_counters(allow=('*',), deny=('lo', 'veth*')) -> dict:
+    ''' Returns raw per-interface counters for interfaces matching allow and not deny (fnmatch patterns) '''
+    counters = psutil.net_io_counters(pernic=True)
     return {
-        'network_latency_ms': latency
+        interface: stats for interface, stats in counters.items()
+        if any(fnmatch.fnmatch(interface, pattern) for pattern in allow)
+        and not any(fnmatch.fnmatch(interface, pattern) for pattern in deny)
     }
 
 
-def export_speedtest_metrics():
-    """Export internet speed test results (run less frequently)"""
-    # Only run speedtest every hour to avoid overloading your connection
-    current_time = time.time()
-    if not hasattr(export_speedtest_metrics, 'last_speedtest'):
-        export_speedtest_metrics.last_speedtest = 0
-        export_speedtest_metrics.last_download = 0
-        export_speedtest_metrics.last_upload = 0
-    
-    # Run speedtest every 3600 seconds (1 hour)
-    if current_time - export_speedtest_metrics.last_speedtest > 3600:
+def export_network_latency(targets=None):
+    """Export network latency metrics, probing every target concurrently"""
+    targets = targets or ['8.8.8.8', '1.1.1.1']
+    network_prober.probe(targets)
+    return {target: network_prober.stats(target) for target in targets}
+
+
+class CronSchedule:
+    """Minimal five-field cron expression: minute hour day-of-month month day-of-week"""
+
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES))
+        # Sunday may be written as 0 or 7
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # Like cron, a restricted day-of-month and day-of-week match if either matches
+        self.day_or_weekday = fields[2] != '*' and fields[4] != '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-'))
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Cron field {field!r} out of range {low}-{high}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        return (day or weekday) if self.day_or_weekday else (day and weekday)
+
+    def next_after(self, moment):
+        """Return the first matching minute strictly after moment"""
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never matches: {self.expression!r}")
+
+
+class SpeedtestWorker:
+    """Runs the speed test out of band in a subprocess on a cron schedule and persists recent results
+
+    Each run is started at the next schedule match plus a random jitter, but never
+    sooner than min_gap seconds after the previous run. The last `history` results
+    are kept in a small JSON file so a restarted exporter serves them immediately.
+    """
+
+    def __init__(self, schedule='0 * * * *', jitter=300, min_gap=1800, timeout=180,
+                 state_file='/var/lib/homelab_exporter/speedtest.json', history=24, command=None):
+        self.schedule = CronSchedule(schedule)
+        self.jitter = jitter
+        self.min_gap = min_gap
+        self.timeout = timeout
+        self.state_file = state_file
+        # The backend is this script in speedtest mode unless another command is given
+        self.command = command or [sys.executable, os.path.abspath(__file__), '--speedtest']
+        self.results = deque(maxlen=history)
+        self._lock = Lock()
+        self._loaded = False
+        self.stop_event = None
+
+    def start(self):
+        """Load the persisted results and start the scheduling thread (no-op if already running)"""
+        if self.stop_event is not None and not self.stop_event.is_set():
+            return
+        if not self._loaded:
+            self.load()
+        self.stop_event = Event()
+        Thread(target=self._run, args=(self.stop_event,), name="speedtest-worker", daemon=True).start()
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    def configure(self, schedule, jitter, min_gap, timeout):
+        """Apply new scheduling settings, picked up after the currently scheduled run"""
+        self.schedule = CronSchedule(schedule)
+        self.jitter = jitter
+        self.min_gap = min_gap
+        self.timeout = timeout
+
+    def load(self):
+        """Load persisted results, a missing or unreadable file just means no history"""
+        logger = logging.getLogger('prometheus_exporter')
+        self._loaded = True
         try:
-            download_speed, upload_speed = network_monitor.run_speedtest()
-            export_speedtest_metrics.last_download = download_speed
-            export_speedtest_metrics.last_upload = upload_speed
-            export_speedtest_metrics.last_speedtest = current_time
-        except Exception as e:
-            logging.getLogger('prometheus_exporter').error(f"Speedtest failed (likely internet down): {e}")
-            # Set speeds to 0 when speedtest fails (internet likely down)
-            export_speedtest_metrics.last_download = 0
-            export_speedtest_metrics.last_upload = 0
-            export_speedtest_metrics.last_speedtest = current_time  # Update timestamp to avoid immediate retry
-    
-    # Return cached values (either successful results or 0 if failed)
+            with open(self.state_file) as f:
+                results = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading speedtest results from {self.state_file}: {e}")
+            return
+        with self._lock:
+            self.results.extend(results)
+
+    def save(self):
+        """Write the results atomically so a crash can't leave a truncated file"""
+        logger = logging.getLogger('prometheus_exporter')
+        with self._lock:
+            results = list(self.results)
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            tmp_path = f"{self.state_file}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(results, f)
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            logger.error(f"Error saving speedtest results to {self.state_file}: {e}")
+
+    def next_run_time(self, now=None) -> float:
+        """Return the epoch time of the next run"""
+        now = time.time() if now is None else now
+        with self._lock:
+            last_run = self.results[-1]['timestamp'] if self.results else 0
+        earliest = max(now, last_run + self.min_gap)
+        scheduled = self.schedule.next_after(datetime.fromtimestamp(earliest)).timestamp()
+        return scheduled + random.uniform(0, self.jitter)
+
+    def run_once(self) -> dict:
+        """Run one speed test in a subprocess and record the result"""
+        logger = logging.getLogger('prometheus_exporter')
+        # Saving the result must not replace history that was never loaded
+        if not self._loaded:
+            self.load()
+        started = time.time()
+        result = {'timestamp': started, 'success': False, 'download_mbps': 0, 'upload_mbps': 0,
+                  'server_id': '', 'server_name': '', 'ping_ms': 0}
+        try:
+            completed = self_profiler.run_subprocess('speedtest', self.command, capture_output=True, text=True,
+                                                     timeout=self.timeout, stdin=subprocess.DEVNULL)
+            if completed.returncode == 0:
+                result.update(json.loads(completed.stdout))
+                result['success'] = True
+            else:
+                logger.error(f"Speedtest failed (likely internet down): {completed.stderr.strip()}")
+        except (subprocess.TimeoutExpired, OSError, ValueError) as e:
+            logger.error(f"Speedtest failed (likely internet down): {e}")
+        result['duration'] = round(time.time() - started, 3)
+
+        with self._lock:
+            self.results.append(result)
+        self.save()
+        return result
+
+    def metric_families(self) -> list:
+        """Return families for the latest run and the latest successful run"""
+        with self._lock:
+            results = list(self.results)
+        if not results:
+            return []
+
+        last = results[-1]
+        successes = [result for result in results if result['success']]
+        # Speeds read 0 when the latest run failed (internet likely down)
+        families = [
+            GaugeFamily('internet_download_speed_mbps', 'Download speed of the latest speed test in Mbps')
+            .set(last['download_mbps']),
+            GaugeFamily('internet_upload_speed_mbps', 'Upload speed of the latest speed test in Mbps')
+            .set(last['upload_mbps']),
+            GaugeFamily('speedtest_last_run_success', 'Whether the latest speed test succeeded')
+            .set(int(last['success'])),
+            GaugeFamily('speedtest_last_run_timestamp_seconds', 'Start time of the latest speed test')
+            .set(round(last['timestamp'])),
+            GaugeFamily('speedtest_last_run_duration_seconds', 'Duration of the latest speed test')
+            .set(last['duration']),
+        ]
+        if successes:
+            success = successes[-1]
+            families += [
+                GaugeFamily('speedtest_last_success_timestamp_seconds',
+                            'Start time of the latest successful speed test')
+                .set(round(success['timestamp'])),
+                GaugeFamily('speedtest_ping_ms', 'Ping to the speed test server in milliseconds')
+                .set(success['ping_ms']),
+                GaugeFamily('speedtest_server_info', 'Server used by the latest successful speed test',
+                            ['server_id', 'server_name']).set(1, success['server_id'], success['server_name']),
+            ]
+        return families
+
+    def _run(self, stop_event):
+        while not stop_event.is_set():
+            delay = self.next_run_time() - time.time()
+            if stop_event.wait(max(delay, 0)):
+                return
+            self.run_once()
+
+
+def speedtest_main():
+    """Run one speed test and print the result as JSON (the worker's subprocess backend)"""
+    try:
+        # Only the hourly subprocess needs speedtest-cli, so the exporter itself never loads it
+        import speedtest
+        st = speedtest.Speedtest(timeout=60)
+        server = st.get_best_server()
+        download_speed = st.download() / 1_000_000  # Convert bits/s to Mbps
+        upload_speed = st.upload() / 1_000_000
+    except Exception as e:
+        print(f"Speedtest failed: {e}", file=sys.stderr)
+        return 1
+
+    print(json.dumps({
+        'download_mbps': round(download_speed, 2),
+        'upload_mbps': round(upload_speed, 2),
+        'server_id': str(server.get('id', '')),
+        'server_name': server.get('sponsor', ''),
+        'ping_ms': round(server.get('latency', 0), 2),
+    }))
+    return 0
+
+
+# Global speedtest worker, results are served from its persisted history
+speedtest_worker = SpeedtestWorker()
+
+
+def collect_cpu_metrics() -> list:
+    """Collect CPU usage averaged, per core and per core and mode"""
+    cpu_usage, core_usage, mode_usage = export_cpu_usage()
+    cores = GaugeFamily('cpu_core_usage_percent', 'CPU usage per core', ['core'])
+    for core, usage in core_usage.items():
+        cores.set(usage, core)
+    modes = GaugeFamily('cpu_mode_percent', 'Share of CPU time per core and mode', ['core', 'mode'])
+    for (core, mode), usage in mode_usage.items():
+        modes.set(usage, core, mode)
+    return [GaugeFamily('cpu_usage_percent', 'CPU usage averaged across cores').set(cpu_usage), cores, modes]
+
+
+def collect_memory_metrics() -> list:
+    """Collect memory usage"""
+    memory_usage = export_memory_usage()
+    return [GaugeFamily('memory_usage_percent', 'Memory usage').set(memory_usage)]
+
+
+def collect_disk_metrics() -> list:
+    """Collect disk usage percentage for the configured path"""
+    disk_usage = export_disk_usage(path=collector_config('disk')['path'])
+    return [GaugeFamily('disk_usage_percent', 'Disk usage of the app data path').set(disk_usage)]
+
+
+# /proc/diskstats fields and the family each is exported as, with the factor that converts them to base units
+BLOCK_DEVICE_METRICS = (
+    ('reads', CounterFamily, 'disk_reads_completed', 'Reads completed by a block device', 1),
+    ('writes', CounterFamily, 'disk_writes_completed', 'Writes completed by a block device', 1),
+    ('reads_merged', CounterFamily, 'disk_reads_merged', 'Adjacent reads merged before reaching a block device', 1),
+    ('writes_merged', CounterFamily, 'disk_writes_merged', 'Adjacent writes merged before reaching a block device', 1),
+    ('sectors_read', CounterFamily, 'disk_read_bytes', 'Bytes read from a block device', DISKSTATS_SECTOR_BYTES),
+    ('sectors_written', CounterFamily, 'disk_written_bytes', 'Bytes written to a block device',
+     DISKSTATS_SECTOR_BYTES),
+    ('read_ms', CounterFamily, 'disk_read_time_seconds', 'Time spent on reads by a block device', 0.001),
+    ('write_ms', CounterFamily, 'disk_write_time_seconds', 'Time spent on writes by a block device', 0.001),
+    ('io_ms', CounterFamily, 'disk_io_time_seconds', 'Time a block device had I/O in flight', 0.001),
+    ('io_weighted_ms', CounterFamily, 'disk_io_weighted_time_seconds',
+     'Time spent on I/O by a block device, weighted by the number of requests in flight', 0.001),
+    ('io_in_progress', GaugeFamily, 'disk_io_now', 'I/O requests in flight on a block device', 1),
+    ('discards', CounterFamily, 'disk_discards_completed', 'Discards completed by a block device', 1),
+    ('sectors_discarded', CounterFamily, 'disk_discarded_bytes', 'Bytes discarded on a block device',
+     DISKSTATS_SECTOR_BYTES),
+)
+
+# Usage fields of a mount and the gauge each is exported as
+FILESYSTEM_METRICS = (
+    ('size_bytes', 'filesystem_size_bytes', 'Size of a file system'),
+    ('used_bytes', 'filesystem_used_bytes', 'Space used on a file system'),
+    ('free_bytes', 'filesystem_free_bytes', 'Free space on a file system, including blocks reserved for root'),
+    ('avail_bytes', 'filesystem_avail_bytes', 'Free space on a file system available to unprivileged users'),
+    ('files', 'filesystem_files', 'Inodes of a file system'),
+    ('files_free', 'filesystem_files_free', 'Free inodes of a file system'),
+    ('readonly', 'filesystem_readonly', 'Whether a file system is mounted read-only'),
+    ('stale', 'filesystem_stat_stale', 'Whether statvfs of a mount timed out and its last result is served'),
+)
+
+
+def collect_filesystem_metrics() -> list:
+    """Collect per-device I/O counters and per-mount usage"""
+    settings = collector_config('filesystems')
+    devices = export_block_device_counters(allow=settings['allow'], deny=settings['deny'])
+    families = []
+    for key, family_class, name, help_text, scale in BLOCK_DEVICE_METRICS:
+        family = family_class(name, help_text, ['device'])
+        for device, counters in sorted(devices.items()):
+            if key in counters:
+                family.set(counters[key] * scale, device)
+        families.append(family)
+
+    mounts = export_filesystem_usage(settings['fstypes'])
+    for key, name, help_text in FILESYSTEM_METRICS:
+        family = GaugeFamily(name, help_text, ['mountpoint', 'device', 'fstype'])
+        for mountpoint, usage in sorted(mounts.items()):
+            if key in usage:
+                family.set(int(usage[key]), mountpoint, usage['device'], usage['fstype'])
+        families.append(family)
+    return families
+
+
+def collect_app_disk_metrics() -> list:
+    """Collect per-app disk usage (sizes are maintained by app_disk_engine)"""
+    family = GaugeFamily('app_disk_usage_bytes', 'Apparent size of each app data directory', ['app'])
+    for app, size_bytes in export_app_disk_usage().items():
+        family.set(size_bytes, app)
+    return [family]
+
+
+def collect_network_speed_metrics() -> list:
+    """Collect real-time network speed"""
+    upload_speed, download_speed = network_monitor.calculate_network_speed()
+    return [
+        GaugeFamily('network_upload_speed_mbps', 'Smoothed host upload speed in Mbps').set(upload_speed),
+        GaugeFamily('network_download_speed_mbps', 'Smoothed host download speed in Mbps').set(download_speed),
+    ] + network_monitor.metric_families()
+
+
+def collect_network_interface_metrics() -> list:
+    """Collect raw per-interface counters, rates are left to rate() in Prometheus"""
+    settings = collector_config('network_interfaces')
+    counters = export_network_interface_counters(allow=settings['allow'], deny=settings['deny'])
+    families = []
+    for field, name, help_text in NETWORK_INTERFACE_COUNTERS:
+        family = CounterFamily(name, help_text, ['interface'])
+        for interface, stats in counters.items():
+            family.set(getattr(stats, field), interface)
+        families.append(family)
+    return families
+
+
+def collect_network_latency_metrics() -> list:
+    """Collect per-target RTT and loss over the prober's rolling window"""
+    targets = collector_config('network_latency')['targets']
+    network_latency = export_network_latency(targets=targets)
+    families = [GaugeFamily('network_latency_ms', 'Average RTT to the first latency target in milliseconds')
+                .set(network_latency[targets[0]]['avg'])]
+    for stat in ('min', 'avg', 'max', 'jitter'):
+        family = GaugeFamily(f'network_rtt_{stat}_ms', f'RTT {stat} over the recent window in milliseconds',
+                             ['target'])
+        for target, stats in network_latency.items():
+            family.set(stats[stat], target)
+        families.append(family)
+    loss = GaugeFamily('network_packet_loss_ratio', 'Share of probes lost over the recent window', ['target'])
+    for target, stats in network_latency.items():
+        loss.set(stats['loss'], target)
+    return families + [loss] + network_prober.metric_families(targets)
+
+
+def collect_speedtest_metrics() -> list:
+    """Collect the latest speed test results from the out-of-band worker"""
+    return speedtest_worker.metric_families()
+
+
+def collect_tailscale_metrics() -> list:
+    """Collect Tailscale status"""
+    settings = collector_config('tailscale')
+    tailscale_status = export_tailscale_status(unit=settings['unit'], timeout=settings['timeout'])
+    return [GaugeFamily('tailscaled_running', 'Whether the Tailscale daemon is active').set(tailscale_status)]
+
+
+def collect_service_metrics() -> list:
+    """Collect service status (grouped containers) and its transition history"""
+    service_groups = collector_config('services')['service_groups']
+    service_status = export_service_status(service_groups)
+    family = GaugeFamily('service_running', 'Whether every container of a service is running', ['service'])
+    for service, status in service_status.items():
+        family.set(status, service)
+    if container_state_cache.history() is None:
+        # Polled without the event stream, there is no history to report
+        return [family]
+
+    last_transition = GaugeFamily('service_last_transition_timestamp_seconds',
+                                  'Time a container of a service last started or stopped', ['service'])
+    restarts = CounterFamily('service_restarts', 'Restarts of the containers of a service seen by the exporter',
+                             ['service'])
+    flapping = GaugeFamily('service_flapping', 'Whether a container of a service keeps restarting', ['service'])
+    for service, history in export_service_history(service_groups).items():
+        if history['last_transition'] is not None:
+            last_transition.set(history['last_transition'], service)
+        restarts.set(history['restarts'], service)
+        flapping.set(history['flapping'], service)
+    return [family, last_transition, restarts, flapping]
+
+
+def collect_systemd_metrics() -> list:
+    """Collect state, last transition and restarts of the watched systemd units"""
+    units = export_unit_states()
+    active = GaugeFamily('systemd_unit_active', 'Whether a systemd unit is active', ['unit'])
+    state = GaugeFamily('systemd_unit_state', 'ActiveState of a systemd unit, always 1', ['unit', 'state'])
+    last_transition = GaugeFamily('systemd_unit_last_transition_timestamp_seconds',
+                                  'Time a systemd unit last started or stopped', ['unit'])
+    restarts = CounterFamily('systemd_unit_restarts', 'Restarts of a systemd unit seen by the exporter', ['unit'])
+    flapping = GaugeFamily('systemd_unit_flapping', 'Whether a systemd unit keeps restarting', ['unit'])
+    for unit, history in sorted(units.items()):
+        active.set(history['state'] == 'active', unit)
+        state.set(1, unit, history['state'])
+        if history['last_transition'] is not None:
+            last_transition.set(history['last_transition'], unit)
+        restarts.set(history['restarts'], unit)
+        flapping.set(history['flapping'], unit)
+    return [active, state, last_transition, restarts, flapping]
+
+
+# Resource usage fields of a container and the family each is exported as
+CONTAINER_RESOURCE_METRICS = (
+    ('cpu_usage_seconds', CounterFamily, 'container_cpu_usage_seconds', 'CPU time used by a container'),
+    ('cpu_user_seconds', CounterFamily, 'container_cpu_user_seconds', 'User CPU time used by a container'),
+    ('cpu_system_seconds', CounterFamily, 'container_cpu_system_seconds', 'System CPU time used by a container'),
+    ('cpu_throttled_seconds', CounterFamily, 'container_cpu_throttled_seconds',
+     'Time a container was throttled by its CPU limit'),
+    ('memory_usage_bytes', GaugeFamily, 'container_memory_usage_bytes', 'Memory charged to a container'),
+    ('memory_limit_bytes', GaugeFamily, 'container_memory_limit_bytes', 'Memory limit of a container'),
+    ('memory_anon_bytes', GaugeFamily, 'container_memory_anon_bytes', 'Anonymous (RSS) memory of a container'),
+    ('memory_file_bytes', GaugeFamily, 'container_memory_file_bytes', 'Page cache memory of a container'),
+    ('block_read_bytes', CounterFamily, 'container_block_read_bytes', 'Bytes read from block devices'),
+    ('block_write_bytes', CounterFamily, 'container_block_write_bytes', 'Bytes written to block devices'),
+    ('block_reads', CounterFamily, 'container_block_reads', 'Read operations on block devices'),
+    ('block_writes', CounterFamily, 'container_block_writes', 'Write operations on block devices'),
+    ('network_receive_bytes', CounterFamily, 'container_network_receive_bytes', 'Bytes received by a container'),
+    ('network_transmit_bytes', CounterFamily, 'container_network_transmit_bytes', 'Bytes sent by a container'),
+    ('network_receive_packets', CounterFamily, 'container_network_receive_packets',
+     'Packets received by a container'),
+    ('network_transmit_packets', CounterFamily, 'container_network_transmit_packets', 'Packets sent by a container'),
+)
+
+
+def collect_container_metrics() -> list:
+    """Collect per-container CPU, memory, block and network I/O, labelled with the service each belongs to"""
+    usage = export_container_resources()
+    services = {}
+    for service, containers in collector_config('services')['service_groups'].items():
+        for container in containers:
+            services.setdefault(container, service)
+
+    families = []
+    for key, family_class, name, help_text in CONTAINER_RESOURCE_METRICS:
+        family = family_class(name, help_text, ['container', 'service'])
+        for container, stats in sorted(usage.items()):
+            if stats.get(key) is not None:
+                family.set(stats[key], container, services.get(container, ''))
+        families.append(family)
+    return families
+
+
+# Backup status fields and the gauge each is exported as
+BACKUP_METRICS = (
+    ('duration_seconds', 'backup_duration_seconds', 'Duration of the latest successful backup'),
+    ('downtime_seconds', 'backup_downtime_seconds', 'Time the app was stopped during the latest successful backup'),
+    ('bytes', 'backup_bytes', 'Size of the app data in the latest successful backup'),
+    ('stored_bytes', 'backup_stored_bytes', 'New bytes written to the backup store by the latest successful backup'),
+    ('files', 'backup_files', 'Files in the latest successful backup'),
+    ('last_success_timestamp', 'backup_last_success_timestamp', 'Time the latest successful backup finished'),
+    ('timestamp', 'backup_last_run_timestamp', 'Time the latest backup started'),
+)
+
+
+def collect_backup_metrics() -> list:
+    """Collect per-app backup results from the backup engine's status file"""
+    status = export_backup_status(collector_config('backups')['status_file'])
+    families = []
+    for key, name, help_text in BACKUP_METRICS:
+        family = GaugeFamily(name, help_text, ['app'])
+        for app, result in sorted(status.items()):
+            if key in result:
+                family.set(result[key], app)
+        families.append(family)
+    success = GaugeFamily('backup_last_run_success', 'Whether the latest backup succeeded', ['app'])
+    for app, result in sorted(status.items()):
+        success.set(int(result['success']), app)
+    return families + [success]
+
+
+def collect_internet_metrics() -> list:
+    """Collect internet status"""
+    internet_status = export_internet_status(test_hosts=collector_config('internet')['targets'])
+    return [GaugeFamily('internet_up', 'Whether any internet target answered a probe').set(internet_status)]
+
+
+# Collector name -> collect function, intervals and enable flags come from the config
+COLLECTORS = {
+    'cpu': collect_cpu_metrics,
+    'memory': collect_memory_metrics,
+    'disk': collect_disk_metrics,
+    'filesystems': collect_filesystem_metrics,
+    'app_disk': collect_app_disk_metrics,
+    'network_speed': collect_network_speed_metrics,
+    'network_interfaces': collect_network_interface_metrics,
+    'network_latency': collect_network_latency_metrics,
+    'speedtest': collect_speedtest_metrics,
+    'tailscale': collect_tailscale_metrics,
+    'services': collect_service_metrics,
+    'systemd': collect_systemd_metrics,
+    'containers': collect_container_metrics,
+    'internet': collect_internet_metrics,
+    'backups': collect_backup_metrics,
+}
+
+
+def enabled_collectors(cfg) -> dict:
+    """Return collector name -> (collect function, interval, deadline) for every enabled collector"""
     return {
-        'internet_download_speed_mbps': export_speedtest_metrics.last_download,
-        'internet_upload_speed_mbps': export_speedtest_metrics.last_upload
+        name: (func, cfg['collectors'][name]['interval'], cfg['collectors'][name]['deadline'])
+        for name, func in COLLECTORS.items()
+        if cfg['collectors'][name]['enabled']
     }
 
 
+class MetricsSnapshot:
+    """Lock-protected store of the latest output of every collector
+
+    A failed run keeps the last good families, which keep being served and are
+    flagged with collector_stale until the collector succeeds again.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # Notified whenever a collector's result is stored
+        self._stored = threading.Condition(self._lock)
+        # collector name -> {'families', 'last_success', 'duration', 'success', 'breaker_open'}
+        self._results = {}
+
+    def update(self, name, families, duration):
+        """Store a successful run of a collector"""
+        with self._lock:
+            self._results[name] = {'families': families, 'last_success': time.time(), 'duration': duration,
+                                   'success': True, 'breaker_open': False}
+            self._stored.notify_all()
+
+    def record_failure(self, name, duration, breaker_open=False):
+        """Mark the latest run of a collector as failed, keeping its last good families"""
+        with self._lock:
+            result = self._results.setdefault(name, {'families': [], 'last_success': None})
+            result.update(duration=duration, success=False, breaker_open=breaker_open)
+            self._stored.notify_all()
+
+    def wait_warm(self, names, timeout) -> list:
+        """Wait up to timeout seconds for every one of names to have run once, return the ones that haven't"""
+        with self._lock:
+            self._stored.wait_for(lambda: all(name in self._results for name in names), timeout)
+            return [name for name in names if name not in self._results]
+
+    def retain(self, names):
+        """Drop stored results for collectors not in names"""
+        with self._lock:
+            for name in list(self._results):
+                if name not in names:
+                    del self._results[name]
+
+    def families(self) -> list:
+        """Return the stored families followed by the collector_* status families"""
+        with self._lock:
+            results = {name: dict(result) for name, result in self._results.items()}
+
+        now = time.time()
+        success = GaugeFamily('collector_success', 'Whether the latest run of a collector succeeded', ['collector'])
+        stale = GaugeFamily('collector_stale', 'Whether a collector is serving values from an earlier run',
+                            ['collector'])
+        breaker_open = GaugeFamily('collector_breaker_open', 'Whether the circuit breaker of a collector is open',
+                                   ['collector'])
+        duration = GaugeFamily('collector_duration_seconds', 'Duration of the latest run of a collector',
+                               ['collector'])
+        age = GaugeFamily('collector_age_seconds', 'Seconds since a collector last succeeded', ['collector'])
+        last_success = GaugeFamily('collector_last_success_timestamp', 'Time a collector last succeeded',
+                                   ['collector'])
+
+        families = []
+        for name, result in results.items():
+            families.extend(result['families'])
+            success.set(int(result['success']), name)
+            stale.set(int(not result['success'] and result['last_success'] is not None), name)
+            breaker_open.set(int(result['breaker_open']), name)
+            duration.set(round(result['duration'], 3), name)
+            if result['last_success'] is not None:
+                age.set(round(now - result['last_success'], 3), name)
+                last_success.set(round(result['last_success'], 3), name)
+        # The exporter's log volume sits next to collector health, suppressed errors often explain a failing collector
+        status = [success, stale, breaker_open, duration, age, last_success]
+        return families + status + log_rate_limiter.metric_families()
+
+    def render(self, openmetrics=False) -> bytes:
+        """Encode the stored results without running any collector
+
+        Collector families are encoded once and the cached bytes are reused by
+        every scrape until the collector runs again.
+        """
+        return render_families(self.families(), openmetrics)
+
+
+class SingleFlight:
+    """Lets concurrent callers for the same key share one in-flight call"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}  # key -> (done event, result holder)
+
+    def do(self, key, func):
+        """Run func, or wait for the identical call already running and return its result"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = (Event(), [None])
+                self._calls[key] = call
+
+        done, result = call
+        if not leader:
+            done.wait()
+            return result[0]
+
+        try:
+            result[0] = func()
+        finally:
+            with self._lock:
+                del self._calls[key]
+            done.set()
+        return result[0]
+
+
+class CircuitBreaker:
+    """Backs off a collector that keeps failing, doubling the pause after each further failure"""
+
+    def __init__(self, threshold=3, base_backoff=30, max_backoff=600):
+        self.threshold = threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.open_until = 0
+
+    @property
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            backoff = self.base_backoff * 2 ** (self.failures - self.threshold)
+            self.open_until = time.monotonic() + min(backoff, self.max_backoff)
+
+
+class CollectorScheduler:
+    """Runs each collector on its own interval, under its own deadline, in a shared executor
+
+    Each collector has a timer thread that submits runs to a shared pool. A run that
+    misses its deadline or raises is recorded as failed and its last good value is
+    served as stale. A run still stuck in the pool is never submitted again until it
+    finishes, and a circuit breaker backs off collectors that keep failing.
+    """
+
+    def __init__(self, snapshot, collectors, max_workers=6, failure_threshold=3, max_backoff=600):
+        self.snapshot = snapshot
+        self.collectors = collectors  # name -> (collect function, interval, deadline)
+        self.stop_event = Event()
+        self.max_workers = max_workers
+        self.executor = None  # Created by the first run
+        self.failure_threshold = failure_threshold
+        self.max_backoff = max_backoff
+        self.breakers = {}
+        self.running = {}  # name -> future of a run that may still be executing
+        self._lock = Lock()
+        # Share concurrent runs of the same collector
+        self.single_flight = SingleFlight()
+
+    def start(self):
+        """Start one daemon timer thread per collector"""
+        for name, (func, interval, deadline) in self.collectors.items():
+            Thread(target=self._run_collector, args=(name, interval, self.stop_event),
+                   name=f"collector-{name}", daemon=True).start()
+
+    def stop(self):
+        """Signal all collector threads to exit after their current run"""
+        self.stop_event.set()
+
+    def reconfigure(self, collectors, max_workers=6, failure_threshold=3, max_backoff=600):
+        """Replace the running collectors and pool settings, e.g. after a config reload
+
+        Runs already queued on a replaced pool still finish there, and breakers keep their failure counts.
+        """
+        self.stop()
+        with self._lock:
+            if max_workers != self.max_workers:
+                previous = self.executor
+                self.executor = None
+                self.max_workers = max_workers
+                if previous is not None:
+                    previous.shutdown(wait=False)
+            self.failure_threshold = failure_threshold
+            self.max_backoff = max_backoff
+            for name, breaker in self.breakers.items():
+                breaker.threshold = failure_threshold
+                breaker.max_backoff = max_backoff
+                if name in collectors:
+                    breaker.base_backoff = collectors[name][1]
+            self.collectors = collectors
+        self.stop_event = Event()
+        self.snapshot.retain(collectors)
+        self.start()
+
+    def run_once(self, name):
+        """Run a single collector, store its result in the snapshot and return its families"""
+        return self.single_flight.do(name, lambda: self._collect(name))
+
+    def _breaker(self, name):
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = self.breakers[name] = CircuitBreaker(
+                threshold=self.failure_threshold, base_backoff=self.collectors[name][1],
+                max_backoff=self.max_backoff)
+        return breaker
+
+    def _collect(self, name):
+        logger = logging.getLogger('prometheus_exporter')
+        if name not in self.collectors:
+            return None
+        func, interval, deadline = self.collectors[name]
+
+        with self._lock:
+            breaker = self._breaker(name)
+            if breaker.is_open:
+                return None
+            previous = self.running.get(name)
+            if previous is not None and not previous.done():
+                # The last run is still hung in the pool, don't pile another one on top
+                logger.error(f"Collector {name} still running from a previous run, serving stale value")
+                breaker.record_failure()
+                self.snapshot.record_failure(name, 0, breaker.is_open)
+                return None
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='collector-worker')
+            future = self.executor.submit(self_profiler.call_collector, name, func)
+            self.running[name] = future
+
+        started = time.monotonic()
+        try:
+            families = future.result(timeout=deadline)
+        except FuturesTimeoutError:
+            logger.error(f"Collector {name} timed out after {deadline}s, serving stale value")
+            families = None
+        except Exception as e:
+            logger.error(f"Collector {name} failed: {e}")
+            families = None
+        duration = time.monotonic() - started
+
+        with self._lock:
+            # Skip results from a collector that was disabled while it ran
+            if name not in self.collectors:
+                return None
+            if families is None:
+                breaker.record_failure()
+                self.snapshot.record_failure(name, duration, breaker.is_open)
+            else:
+                breaker.record_success()
+                self.snapshot.update(name, families, duration)
+        return families
+
+    def _run_collector(self, name, interval, stop_event):
+        while not stop_event.is_set():
+            started = time.monotonic()
+            self.run_once(name)
+            # Keep a steady cadence regardless of how long the collector took
+            elapsed = time.monotonic() - started
+            stop_event.wait(max(interval - elapsed, 0))
+
+
 def collect_all_metrics() -> str:
-    """Collect all metrics and format them for Prometheus"""
+    """Collect all metrics synchronously and format them for Prometheus"""
+    # Runs already in flight on the scheduler are shared rather than repeated
+    for name in collector_scheduler.collectors:
+        collector_scheduler.run_once(name)
+    return metrics_snapshot.render().decode()
+
+
+# Global snapshot served by /metrics and the scheduler that keeps it fresh
+metrics_snapshot = MetricsSnapshot()
+collector_scheduler = CollectorScheduler(metrics_snapshot, enabled_collectors(config),
+                                         **config['scheduler'])
+
+
+def protobuf_varint(value) -> bytes:
+    """Encode a non-negative int as a protobuf varint"""
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def protobuf_field(number, payload) -> bytes:
+    """Encode a length-delimited protobuf field (strings and embedded messages)"""
+    return protobuf_varint(number << 3 | 2) + protobuf_varint(len(payload)) + payload
+
+
+def encode_write_request(series) -> bytes:
+    """Encode [(labels sorted by name, value, timestamp in ms), ...] as a remote-write WriteRequest
+
+    WriteRequest{1: repeated TimeSeries}, TimeSeries{1: repeated Label, 2: repeated Sample},
+    Label{1: name, 2: value}, Sample{1: double value, 2: int64 timestamp}.
+    """
+    out = bytearray()
+    for labels, value, timestamp in series:
+        timeseries = bytearray()
+        for name, label_value in labels:
+            timeseries += protobuf_field(1, protobuf_field(1, name.encode()) + protobuf_field(2, label_value.encode()))
+        timeseries += protobuf_field(2, b'\x09' + struct.pack('<d', value) + b'\x10' + protobuf_varint(timestamp))
+        out += protobuf_field(1, bytes(timeseries))
+    return bytes(out)
+
+
+def snappy_compress(data) -> bytes:
+    """Compress data in the snappy block format that remote-write expects
+
+    A greedy matcher over 4-byte sequences; it compresses less tightly than the C
+    library, but exposition label sets repeat so much that it still shrinks
+    requests several times over.
+    """
+    out = bytearray(protobuf_varint(len(data)))
+
+    def literal(start, end):
+        length = end - start
+        if length <= 0:
+            return
+        if length <= 60:
+            out.append((length - 1) << 2)
+        else:
+            size = (length - 1).bit_length() + 7 >> 3
+            out.append((59 + size) << 2)
+            out.extend((length - 1).to_bytes(size, 'little'))
+        out.extend(data[start:end])
+
+    table = {}
+    literal_start = 0
+    i = 0
+    end = len(data) - 4
+    while i <= end:
+        key = data[i:i + 4]
+        candidate = table.get(key)
+        table[key] = i
+        if candidate is None or i - candidate > 0xffff:
+            i += 1
+            continue
+        length = 4
+        while length < 64 and i + length < len(data) and data[candidate + length] == data[i + length]:
+            length += 1
+        literal(literal_start, i)
+        # Copy with a 2-byte offset: tag, then the offset little-endian
+        out.append((length - 1) << 2 | 2)
+        out.extend((i - candidate).to_bytes(2, 'little'))
+        i += length
+        literal_start = i
+    literal(literal_start, len(data))
+    return bytes(out)
+
+
+class RemoteWriteRejected(Exception):
+    """The endpoint refused a request for good (4xx), so retrying it can't help"""
+
+
+class RemoteWriter:
+    """Pushes the snapshot to a Prometheus remote-write endpoint, spilling to disk while it is unreachable
+
+    Every interval the snapshot is encoded into snappy-compressed WriteRequests
+    and sent over one keep-alive connection. Requests that can't be delivered
+    are written to buffer_dir and replayed oldest first once the endpoint
+    answers again. The buffer is capped at max_buffer_bytes by dropping the
+    oldest requests, and replay reads one request at a time, so memory stays flat.
+    """
+
+    def __init__(self, snapshot, url='', interval=30, timeout=10, job='homelab-exporter', instance='',
+                 buffer_dir='/var/lib/homelab_exporter/remote_write', max_buffer_bytes=64 << 20,
+                 max_samples_per_send=2000, username='', password=''):
+        self.snapshot = snapshot
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.job = job
+        self.instance = instance or socket.gethostname()
+        self.buffer_dir = buffer_dir
+        self.max_buffer_bytes = max_buffer_bytes
+        self.max_samples_per_send = max_samples_per_send
+        self.username = username
+        self.password = password
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._conn = None
+        self._lock = Lock()  # Held for a whole push so a reload can't swap the connection mid-request
+        self.stop_event = None
+
+    def configure(self, settings):
+        """Apply the remote_write config section"""
+        with self._lock:
+            if settings['url'] != self.url or settings['timeout'] != self.timeout:
+                self._close()
+            self.url = settings['url']
+            self.interval = settings['interval']
+            self.timeout = settings['timeout']
+            self.job = settings['job']
+            self.instance = settings['instance'] or socket.gethostname()
+            self.buffer_dir = settings['buffer_dir']
+            self.max_buffer_bytes = settings['max_buffer_bytes']
+            self.max_samples_per_send = settings['max_samples_per_send']
+            self.username = settings['username']
+            self.password = settings['password']
+
+    def start(self):
+        """Start pushing on a background thread (no-op if already running)"""
+        if self.stop_event is not None and not self.stop_event.is_set():
+            return
+        self.stop_event = Event()
+        Thread(target=self._run, args=(self.stop_event,), name="remote-write", daemon=True).start()
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    def requests(self, now=None) -> list:
+        """Encode the snapshot into compressed WriteRequests of at most max_samples_per_send samples"""
+        timestamp = int((time.time() if now is None else now) * 1000)
+        target = (('instance', self.instance), ('job', self.job))
+        series = []
+        for family in self.snapshot.families():
+            for suffix, labels, value in family.samples:
+                series.append((tuple(sorted((('__name__', family.name + suffix),) + labels + target)),
+                               float(value), timestamp))
+        return [snappy_compress(encode_write_request(series[start:start + self.max_samples_per_send]))
+                for start in range(0, len(series), self.max_samples_per_send)]
+
+    def push_once(self):
+        """Replay any buffered requests, then send the current snapshot (buffering it if that fails)"""
+        logger = logging.getLogger('prometheus_exporter')
+        payloads = self.requests()
+        with self._lock:
+            delivered = self._replay()
+            for payload in payloads:
+                if delivered:
+                    try:
+                        self._send(payload)
+                        continue
+                    except RemoteWriteRejected as e:
+                        logger.error(f"Remote write rejected a request, dropping it: {e}")
+                        self.dropped += 1
+                        continue
+                    except (OSError, http.client.HTTPException) as e:
+                        logger.error(f"Remote write to {self.url} failed, buffering to disk: {e}")
+                        delivered = False
+                self._spill(payload)
+
+    def _buffered(self) -> list:
+        """Return the buffered request files, oldest first"""
+        try:
+            names = os.listdir(self.buffer_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(self.buffer_dir, name) for name in names if name.endswith('.snappy'))
+
+    def _replay(self) -> bool:
+        """Send buffered requests oldest first, returns False if the endpoint is still unreachable"""
+        logger = logging.getLogger('prometheus_exporter')
+        buffered = self._buffered()
+        for path in buffered:
+            with open(path, 'rb') as f:
+                payload = f.read()
+            try:
+                self._send(payload)
+            except RemoteWriteRejected as e:
+                # Typically samples older than the receiver accepts after a long outage
+                logger.error(f"Remote write rejected buffered request {path}, dropping it: {e}")
+                self.dropped += 1
+            except (OSError, http.client.HTTPException) as e:
+                logger.debug(f"Remote write endpoint still unreachable: {e}")
+                return False
+            os.remove(path)
+        if buffered:
+            logger.info(f"Replayed {len(buffered)} buffered remote write requests")
+        return True
+
+    def _spill(self, payload):
+        """Write a request to the buffer, dropping the oldest ones beyond max_buffer_bytes"""
+        logger = logging.getLogger('prometheus_exporter')
+        os.makedirs(self.buffer_dir, exist_ok=True)
+        path = os.path.join(self.buffer_dir, f'{time.time_ns():020d}.snappy')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(path + '.tmp', path)
+
+        buffered = [(name, os.path.getsize(name)) for name in self._buffered()]
+        total = sum(size for _, size in buffered)
+        for name, size in buffered:
+            if total <= self.max_buffer_bytes:
+                break
+            os.remove(name)
+            total -= size
+            self.dropped += 1
+            logger.warning(f"Remote write buffer over {self.max_buffer_bytes} bytes, dropped {name}")
+
+    def _connection(self):
+        if self._conn is None:
+            url = urllib.parse.urlsplit(self.url)
+            connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+            self._conn = connection_class(url.hostname, url.port, timeout=self.timeout)
+        return self._conn
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _send(self, payload):
+        url = urllib.parse.urlsplit(self.url)
+        path = (url.path or '/') + (f'?{url.query}' if url.query else '')
+        headers = {
+            'Content-Encoding': 'snappy',
+            'Content-Type': 'application/x-protobuf',
+            'User-Agent': 'homelab-exporter',
+            'X-Prometheus-Remote-Write-Version': '0.1.0',
+        }
+        if self.username:
+            credentials = base64.b64encode(f'{self.username}:{self.password}'.encode()).decode()
+            headers['Authorization'] = f'Basic {credentials}'
+
+        try:
+            _, response, body = request_with_retry(self._connection, lambda conn: self._close(), 'POST', path,
+                                                   body=payload, headers=headers)
+        except Exception:
+            self.failed += 1
+            raise
+        if response.will_close:
+            self._close()
+        if 200 <= response.status < 300:
+            self.sent += 1
+            return
+        self.failed += 1
+        message = f"HTTP {response.status}: {body[:200].decode(errors='replace').strip()}"
+        # 429 and 5xx are worth retrying later, any other 4xx would fail the same way again
+        if 400 <= response.status < 500 and response.status != 429:
+            raise RemoteWriteRejected(message)
+        raise OSError(message)
+
+    def metric_families(self) -> list:
+        """Return the push counters and the current buffer size"""
+        buffered = self._buffered()
+        return [
+            CounterFamily('exporter_remote_write_requests', 'Remote write requests by outcome', ['result'])
+            .set(self.sent, 'sent').set(self.failed, 'failed').set(self.dropped, 'dropped'),
+            GaugeFamily('exporter_remote_write_buffered_requests', 'Requests waiting in the on-disk buffer')
+            .set(len(buffered)),
+            GaugeFamily('exporter_remote_write_buffered_bytes', 'Size of the on-disk buffer')
+            .set(sum(os.path.getsize(path) for path in buffered)),
+        ]
+
+    def _run(self, stop_event):
+        logger = logging.getLogger('prometheus_exporter')
+        while not stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self.push_once()
+            except Exception as e:
+                logger.error(f"Error pushing metrics: {e}")
+            stop_event.wait(max(self.interval - (time.monotonic() - started), 0))
+
+
+# Global remote writer, only started when remote_write is enabled
+remote_writer = RemoteWriter(metrics_snapshot)
+
+
+class PeerFederation:
+    """Merges the /metrics of peer exporters into this one's, each series labelled with its instance
+
+    Peers are fetched concurrently over one keep-alive connection each, all under
+    one shared deadline, on a pool with a worker per peer. Results are cached for
+    ttl seconds. A peer is never fetched twice at once: concurrent scrapes, and
+    scrapes after one whose deadline ran out, wait on the fetch already running.
+    A peer that doesn't answer contributes no series and shows up as federation_peer_up 0.
+    """
+
+    # Sent with every peer fetch so an aggregator asked by another aggregator only returns its own series
+    HOP_HEADER = 'X-Homelab-Federation'
+
+    def __init__(self, peers=(), ttl=15, timeout=5, instance=''):
+        self.peers = list(peers)
+        self.ttl = ttl
+        self.timeout = timeout
+        self.instance = instance or socket.gethostname()
+        self.max_workers = max(len(self.peers), 1)
+        self.executor = None  # Created by the first fetch
+        self._lock = Lock()
+        self._connections = {}  # peer -> (lock, HTTPConnection or None)
+        self._results = {}  # peer -> {'families', 'fetched', 'up', 'duration', 'last_success'}
+        self._in_flight = {}  # peer -> future of its latest fetch
+
+    def configure(self, settings):
+        """Apply the federation config section"""
+        with self._lock:
+            self.peers = list(settings['peers'])
+            self.ttl = settings['ttl']
+            self.timeout = settings['timeout']
+            self.instance = settings['instance'] or socket.gethostname()
+            # One worker per peer, a fetch never waits for a free worker
+            if max(len(self.peers), 1) != self.max_workers:
+                previous = self.executor
+                self.max_workers = max(len(self.peers), 1)
+                self.executor = None
+                if previous is not None:
+                    previous.shutdown(wait=False)
+            for peer in list(self._connections):
+                if peer not in self.peers:
+                    _, conn = self._connections.pop(peer)
+                    if conn[0] is not None:
+                        conn[0].close()
+                    self._results.pop(peer, None)
+                    self._in_flight.pop(peer, None)
+
+    @staticmethod
+    def _url(peer):
+        return urllib.parse.urlsplit(peer if '://' in peer else f'http://{peer}/metrics')
+
+    def _fetch(self, peer) -> list:
+        """GET a peer's /metrics on its pooled connection and parse it"""
+        url = self._url(peer)
+        with self._lock:
+            lock, conn = self._connections.setdefault(peer, (Lock(), [None]))
+        headers = {'Accept': 'text/plain', 'Accept-Encoding': 'gzip', self.HOP_HEADER: '1'}
+        def get_connection():
+            if conn[0] is None:
+                connection_class = (http.client.HTTPSConnection if url.scheme == 'https'
+                                    else http.client.HTTPConnection)
+                conn[0] = connection_class(url.hostname, url.port, timeout=self.timeout)
+            return conn[0]
+
+        def discard_connection(connection):
+            connection.close()
+            conn[0] = None
+
+        with lock:
+            connection, response, body = request_with_retry(get_connection, discard_connection, 'GET',
+                                                            url.path or '/metrics', headers=headers)
+            if response.will_close:
+                discard_connection(connection)
+
+        if response.status != 200:
+            raise OSError(f"HTTP {response.status}")
+        if response.getheader('Content-Encoding') == 'gzip':
+            import gzip
+            body = gzip.decompress(body)
+        return parse_exposition(body.decode())
+
+    def _refresh(self, peer):
+        logger = logging.getLogger('prometheus_exporter')
+        started = time.monotonic()
+        try:
+            families = self._fetch(peer)
+            up = True
+        except Exception as e:
+            logger.error(f"Federation peer {peer} failed: {e}")
+            families, up = [], False
+        with self._lock:
+            previous = self._results.get(peer, {})
+            self._results[peer] = {
+                'families': families, 'fetched': time.monotonic(), 'up': up,
+                'duration': time.monotonic() - started,
+                'last_success': time.time() if up else previous.get('last_success'),
+            }
+
+    def peer_results(self) -> dict:
+        """Return every peer's cached result, refreshing the expired ones concurrently under one deadline"""
+        futures = {}
+        with self._lock:
+            peers = list(self.peers)
+            now = time.monotonic()
+            for peer in peers:
+                if now - self._results.get(peer, {}).get('fetched', -math.inf) < self.ttl:
+                    continue
+                future = self._in_flight.get(peer)
+                # A fetch still running from an earlier scrape is waited on, not started again
+                if future is None or future.done():
+                    if self.executor is None:
+                        self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                           thread_name_prefix='federation')
+                    future = self._in_flight[peer] = self.executor.submit(self._refresh, peer)
+                futures[peer] = future
+
+        # The connection timeout bounds each fetch, this bounds the whole scrape if peers trickle data
+        _, not_done = futures_wait(futures.values(), timeout=self.timeout)
+        with self._lock:
+            for peer, future in futures.items():
+                if future in not_done:
+                    previous = self._results.get(peer, {})
+                    self._results[peer] = {'families': [], 'fetched': time.monotonic(), 'up': False,
+                                           'duration': self.timeout, 'last_success': previous.get('last_success')}
+            return {peer: self._results[peer] for peer in peers if peer in self._results}
+
+    def merge(self, local_families) -> list:
+        """Merge local and peer families by name, adding an instance label to every sample"""
+        logger = logging.getLogger('prometheus_exporter')
+        results = self.peer_results()
+        sources = [(self.instance, local_families)] + [(peer, result['families']) for peer, result in results.items()]
+
+        merged = {}
+        for instance, families in sources:
+            for family in families:
+                target = merged.get(family.name)
+                if target is None:
+                    target = merged[family.name] = type(family)(family.name, family.help)
+                elif type(target) is not type(family):
+                    logger.debug(f"Skipping {family.name} from {instance}, its type differs from another instance")
+                    continue
+                for suffix, labels, value in family.samples:
+                    labels = tuple(label for label in labels if label[0] != 'instance') + (('instance', instance),)
+                    target.samples.append((suffix, labels, value))
+
+        up = GaugeFamily('federation_peer_up', 'Whether the last fetch from a peer exporter succeeded', ['instance'])
+        duration = GaugeFamily('federation_peer_fetch_duration_seconds', 'Duration of the last fetch from a peer',
+                               ['instance'])
+        last_success = GaugeFamily('federation_peer_last_success_timestamp', 'Time a peer was last fetched',
+                                   ['instance'])
+        for peer, result in results.items():
+            up.set(int(result['up']), peer)
+            duration.set(round(result['duration'], 3), peer)
+            if result['last_success'] is not None:
+                last_success.set(round(result['last_success'], 3), peer)
+        return list(merged.values()) + [up, duration, last_success]
+
+
+# Global federation, only used when federation is enabled
+peer_federation = PeerFederation()
+
+
+def load_config(path) -> dict:
+    """Load the YAML config file over the defaults, a missing file means all defaults"""
     logger = logging.getLogger('prometheus_exporter')
-    logger.info("Collecting metrics for Prometheus")
-    metrics = []
+    loaded = copy.deepcopy(DEFAULT_CONFIG)
+    try:
+        with open(path) as f:
+            import yaml
+            overrides = yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        logger.info(f"No config file at {path}, using defaults")
+        return loaded
 
-    # CPU Usage
-    cpu_usage = export_cpu_usage(interval=2) 
-    metrics.append(f"cpu_usage_percent {cpu_usage}")
-    
-    # Memory Usage
-    memory_usage = export_memory_usage()
-    metrics.append(f"memory_usage_percent {memory_usage}")
-    
-    # Disk Usage
-    disk_usage = export_disk_usage(path="/srv")
-    metrics.append(f"disk_usage_percent {disk_usage}")
-    
-    # App Disk Usage
-    app_disk_usage = export_app_disk_usage(base_path="/srv")
-    for app, size_gb in app_disk_usage.items():
-        metrics.append(f"{app} {size_gb}")
-    
-    # Network Speed Metrics (real-time)
-    network_speed = export_network_speed()
-    for metric, value in network_speed.items():
-        metrics.append(f"{metric} {value}")
-    
-    # Network Latency
-    network_latency = export_network_latency()
-    for metric, value in network_latency.items():
-        metrics.append(f"{metric} {value}")
-    
-    # Internet Speed Test (hourly)
-    speedtest_metrics = export_speedtest_metrics()
-    for metric, value in speedtest_metrics.items():
-        metrics.append(f"{metric} {value}")
-    
-    # Tailscale Status
-    tailscale_status = export_tailscale_status()
-    metrics.append(f"tailscaled_running {tailscale_status}")
-    
-    # Service Status (grouped containers)
-    service_status = export_service_status()
-    for service, status in service_status.items():
-        metrics.append(f"{service} {status}")
-    
-    # Internet Status
-    internet_status = export_internet_status(test_hosts=['8.8.8.8', '1.1.1.1'])
-    metrics.append(f"internet_up {internet_status}")
-    
-    return '\n'.join(metrics) + '\n'
+    for section, values in overrides.items():
+        if section not in loaded or not isinstance(values, dict):
+            raise ValueError(f"Unknown or invalid config section: {section}")
+        if section != 'collectors':
+            loaded[section].update(values)
+            continue
+        for name, settings in values.items():
+            if name not in loaded['collectors'] or not isinstance(settings, dict):
+                raise ValueError(f"Unknown or invalid collector config: {name}")
+            # Values replace the defaults whole, so e.g. service_groups isn't merged with the built-in groups
+            loaded['collectors'][name].update(settings)
+            if loaded['collectors'][name]['interval'] <= 0 or loaded['collectors'][name]['deadline'] <= 0:
+                raise ValueError(f"Collector {name} interval and deadline must be positive")
+    for name in ('network_speed', 'network_latency'):
+        settings = loaded['collectors'][name]
+        if not isinstance(settings['window'], int) or settings['window'] <= 0:
+            raise ValueError(f"Collector {name} window must be a positive integer")
+        if not settings['buckets'] or not all(isinstance(bound, (int, float)) for bound in settings['buckets']):
+            raise ValueError(f"Collector {name} buckets must be a non-empty list of numbers")
+    if loaded['remote_write']['enabled'] and not loaded['remote_write']['url']:
+        raise ValueError("remote_write is enabled but has no url")
+    if loaded['federation']['enabled'] and not loaded['federation']['peers']:
+        raise ValueError("federation is enabled but has no peers")
+    if loaded['logging']['format'] not in ('text', 'json'):
+        raise ValueError(f"Unknown logging format: {loaded['logging']['format']}")
+    if not isinstance(logging.getLevelName(str(loaded['logging']['level']).upper()), int):
+        raise ValueError(f"Unknown logging level: {loaded['logging']['level']}")
+    schedule = loaded['collectors']['speedtest']['schedule']
+    if not isinstance(schedule, str):
+        raise ValueError(f"Invalid speedtest schedule: {schedule!r}")
+    CronSchedule(schedule)  # Raises ValueError for a malformed expression
+    return loaded
+
+
+def apply_config(new_config):
+    """Make new_config the active config and reconfigure every component to match it
+
+    Settings that can still be rejected are applied first, so such an error leaves the running config untouched.
+    """
+    global config
+    collectors = new_config['collectors']
+    speed = collectors['speedtest']
+    speedtest_worker.configure(speed['schedule'], speed['jitter'], speed['min_gap'], speed['timeout'])
+
+    config = new_config
+    configure_logging(new_config['logging'])
+
+    app_disk = collectors['app_disk']
+    app_disk_engine.set_base_path(app_disk['base_path'])
+    app_disk_engine.budget = app_disk['budget']
+    app_disk_engine.pause = app_disk['pause']
+    app_disk_engine.full_rescan_interval = app_disk['full_rescan_interval']
+
+    latency = collectors['network_latency']
+    network_prober.count = latency['count']
+    network_prober.timeout = latency['timeout']
+    network_prober.tcp_port = latency['tcp_port']
+    network_prober.configure(latency['window'], latency['buckets'])
+    network_monitor.configure(collectors['network_speed']['window'], collectors['network_speed']['buckets'])
 
+    docker_client.timeout = collectors['services']['timeout']
+    container_cgroups.cgroup_root = collectors['containers']['cgroup_root']
+    mount_stats.timeout = collectors['filesystems']['statvfs_timeout']
 
-def run_http_server(port=9090):
-    """Run HTTP server to expose metrics for Prometheus scraping"""
+    container_state_cache.table.flap_window = collectors['services']['flap_window']
+    container_state_cache.table.flap_threshold = collectors['services']['flap_threshold']
+
+    systemd = collectors['systemd']
+    units = systemd['units'] + ([collectors['tailscale']['unit']] if collectors['tailscale']['enabled'] else [])
+    unit_watcher.configure(units, systemd['bus_socket'])
+    unit_watcher.table.flap_window = systemd['flap_window']
+    unit_watcher.table.flap_threshold = systemd['flap_threshold']
+
+    # Background workers only run for enabled collectors
+    for names, worker in ((('app_disk',), app_disk_engine), (('services', 'containers'), container_state_cache),
+                          (('systemd', 'tailscale'), unit_watcher), (('speedtest',), speedtest_worker)):
+        if any(collectors[name]['enabled'] for name in names):
+            worker.start()
+        else:
+            worker.stop()
+
+    collector_scheduler.reconfigure(enabled_collectors(new_config), **new_config['scheduler'])
+
+    peer_federation.configure(new_config['federation'])
+    remote_writer.configure(new_config['remote_write'])
+    if new_config['remote_write']['enabled']:
+        remote_writer.start()
+    else:
+        remote_writer.stop()
+
+
+def reload_config(path):
+    """Reload the config file (on SIGHUP), keeping the current config if the new one is invalid
+
+    A config that passes validation but fails while being applied is rolled back to the previous one.
+    """
     logger = logging.getLogger('prometheus_exporter')
-    server = HTTPServer(('0.0.0.0', port), MetricsHandler)
+    try:
+        new_config = load_config(path)
+    except Exception as e:
+        logger.error(f"Error reloading config from {path}, keeping current config: {e}")
+        return
+    with config_reload_lock:
+        listener = ('port', 'max_workers')
+        if {key: new_config['server'][key] for key in listener} != {key: config['server'][key] for key in listener}:
+            logger.warning("Server port or max_workers changed, restart the exporter to apply them")
+        previous_config = config
+        sd_notify('RELOADING=1')
+        try:
+            apply_config(new_config)
+        except Exception as e:
+            logger.error(f"Error applying config from {path}, restoring the previous config: {e}")
+            apply_config(previous_config)
+            return
+        finally:
+            sd_notify('READY=1')
+    logger.info(f"Reloaded config from {path}")
+
+
+# Serialises reloads when several SIGHUPs arrive close together
+config_reload_lock = Lock()
+
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    """HTTP server that handles connections on at most max_workers threads at a time"""
+
+    daemon_threads = True
+    # socketserver's default backlog of 5 drops connects when several scrapers arrive at once
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler_class, max_workers=16):
+        super().__init__(server_address, handler_class)
+        self.workers = BoundedSemaphore(max_workers)
+
+    def process_request(self, request, client_address):
+        # Stop accepting new connections while every worker is busy
+        self.workers.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.workers.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.workers.release()
+
+
+# systemd's notify socket, taken out of the environment so that child processes
+# (systemctl, the speed test) can't send it their own status
+NOTIFY_SOCKET = os.environ.pop('NOTIFY_SOCKET', None)
+
+
+def sd_notify(state) -> bool:
+    """Send a state such as READY=1 to systemd when running as a Type=notify service"""
+    address = NOTIFY_SOCKET
+    if not address:
+        return False
+    # A leading @ stands for the abstract socket namespace
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError as e:
+        logging.getLogger('prometheus_exporter').warning(f"Could not notify systemd ({state!r}): {e}")
+        return False
+    return True
+
+
+def process_uptime() -> float:
+    """Seconds since this process started, interpreter start-up and imports included"""
+    # psutil's create_time() rounds the boot time to whole seconds, so count from boot instead
+    with open('/proc/self/stat') as f:
+        # Start time in clock ticks since boot is field 22, the 20th after the ")" closing the command name
+        start_ticks = int(f.read().rpartition(')')[2].split()[19])
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def wait_until_warm(startup_budget=10):
+    """Wait for every collector's first run, but no longer than startup_budget seconds after the process started"""
+    logger = logging.getLogger('prometheus_exporter')
+    remaining = startup_budget - process_uptime()
+    cold = metrics_snapshot.wait_warm(list(collector_scheduler.collectors), max(remaining, 0))
+    self_profiler.startup_seconds = process_uptime()
+    if cold:
+        logger.warning(f"Startup budget of {startup_budget}s used up, serving before the first run of: "
+                       f"{', '.join(cold)}")
+    else:
+        logger.info(f"First snapshot warm {self_profiler.startup_seconds:.2f}s after start")
+
+
+def run_http_server(port=9090, max_workers=16, startup_budget=10):
+    """Run HTTP server to expose metrics for Prometheus scraping
+
+    The port is bound straight away, but connections are only accepted once the
+    first snapshot is warm (or the startup budget ran out), so early scrapes wait
+    in the listen backlog rather than getting half the metrics.
+    """
+    logger = logging.getLogger('prometheus_exporter')
+    server = PooledHTTPServer(('0.0.0.0', port), MetricsHandler, max_workers=max_workers)
     logger.info(f"Starting HTTP server on port {port}")
-    logger.info("Metrics server started on http://0.0.0.0:9090/metrics")
+    wait_until_warm(startup_budget)
+    sd_notify('READY=1\nSTATUS=Serving metrics')
+    logger.info(f"Metrics server started on http://0.0.0.0:{port}/metrics")
     try:
         server.serve_forever()
     except Exception as e:
@@ -556,9 +3926,30 @@ def run_http_server(port=9090):
 
 
 def main():
+    if '--speedtest' in sys.argv[1:]:
+        sys.exit(speedtest_main())
+
     logger = setup_logging()
     logger.info("Prometheus Exporter starting up")
-    run_http_server(port=9090)
+    # Collectors start running as soon as the config is applied
+    cpu_monitor.prime()
+
+    config_path = DEFAULT_CONFIG_PATH
+    if '--config' in sys.argv[1:]:
+        config_path = sys.argv[sys.argv.index('--config') + 1]
+    try:
+        initial_config = load_config(config_path)
+        apply_config(initial_config)
+    except Exception as e:
+        logger.error(f"Invalid config file {config_path}: {e}")
+        sys.exit(1)
+
+    # Reload on SIGHUP off the signal handler so the listener keeps serving meanwhile
+    signal.signal(signal.SIGHUP, lambda signum, frame: Thread(
+        target=reload_config, args=(config_path,), name="config-reload", daemon=True).start())
+
+    server = config['server']
+    run_http_server(port=server['port'], max_workers=server['max_workers'], startup_budget=server['startup_budget'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+"""Incremental app directory sizes: rewalking changed subtrees, time budget and inotify fallbacks"""
+
+import ctypes
+import errno
+import os
+import time
+
+import pytest
+
+import homelab_exporter as exporter
+
+
+def du(path):
+    # Apparent size like `du -sb`: every directory entry plus every file, symlinks not followed
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += os.lstat(root).st_size
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+def settle():
+    # Directory mtimes come from a coarse clock, so leave a tick between a scan and the next change
+    time.sleep(0.05)
+
+
+def make_tree(base):
+    write(str(base / 'jellyfin' / 'config' / 'system.xml'), 1000)
+    write(str(base / 'jellyfin' / 'cache' / 'images' / 'a.jpg'), 5000)
+    write(str(base / 'jellyfin' / 'cache' / 'images' / 'b.jpg'), 7000)
+    write(str(base / 'nextcloud' / 'data' / 'notes.txt'), 300)
+    os.symlink('data/notes.txt', str(base / 'nextcloud' / 'latest'))
+
+
+def expected(base):
+    return {entry.name: du(entry.path) for entry in os.scandir(str(base)) if entry.is_dir()}
+
+
+def count_scans(engine, monkeypatch):
+    scanned = []
+    scan = engine._scan
+
+    def recording_scan(path, key, now):
+        scanned.append(path)
+        return scan(path, key, now)
+    monkeypatch.setattr(engine, '_scan', recording_scan)
+    return scanned
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_totals_follow_adds_and_deletes(tmp_path, use_inotify):
+    make_tree(tmp_path)
+    engine = exporter.DirectorySizeEngine(base_path=str(tmp_path), use_inotify=use_inotify)
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
+
+    settle()
+    write(str(tmp_path / 'jellyfin' / 'cache' / 'images' / 'c.jpg'), 11000)
+    write(str(tmp_path / 'nextcloud' / 'data' / 'photos' / 'cat.png'), 4096)
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
+
+    settle()
+    os.unlink(str(tmp_path / 'jellyfin' / 'cache' / 'images' / 'a.jpg'))
+    os.unlink(str(tmp_path / 'nextcloud' / 'data' / 'photos' / 'cat.png'))
+    os.rmdir(str(tmp_path / 'nextcloud' / 'data' / 'photos'))
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
+    assert str(tmp_path / 'nextcloud' / 'data' / 'photos') not in engine._dirs
+
+    # A removed app disappears and its cached directories are dropped
+    write(str(tmp_path / 'gitea' / 'repo.git' / 'HEAD'), 20)
+    assert engine.refresh(budget=60)
+    assert 'gitea' in engine.sizes()
+    os.unlink(str(tmp_path / 'gitea' / 'repo.git' / 'HEAD'))
+    os.rmdir(str(tmp_path / 'gitea' / 'repo.git'))
+    os.rmdir(str(tmp_path / 'gitea'))
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
+    assert not [path for path in engine._dirs if path.startswith(str(tmp_path / 'gitea'))]
+
+
+def test_warm_pass_only_rescans_changed_directories(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+    engine = exporter.DirectorySizeEngine(base_path=str(tmp_path), use_inotify=False)
+    assert engine.refresh(budget=60)
+    scanned = count_scans(engine, monkeypatch)
+
+    assert engine.refresh(budget=60)
+    assert scanned == []
+
+    settle()
+    write(str(tmp_path / 'jellyfin' / 'cache' / 'images' / 'd.jpg'), 100)
+    assert engine.refresh(budget=60)
+    assert scanned == [str(tmp_path / 'jellyfin' / 'cache' / 'images')]
+    assert engine.sizes() == expected(tmp_path)
+
+
+def test_in_place_growth_without_inotify_waits_for_full_rescan(tmp_path):
+    make_tree(tmp_path)
+    engine = exporter.DirectorySizeEngine(base_path=str(tmp_path), use_inotify=False)
+    assert engine.refresh(budget=60)
+    before = engine.sizes()
+
+    # Appending to a file leaves its directory's mtime alone, so the cached size is kept
+    settle()
+    with open(str(tmp_path / 'jellyfin' / 'config' / 'system.xml'), 'ab') as f:
+        f.write(b'y' * 2500)
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == before
+
+    engine.full_rescan_interval = 0
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
+    assert engine.sizes()['jellyfin'] == before['jellyfin'] + 2500
+
+
+def test_in_place_growth_with_inotify_rescans_only_that_directory(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+    engine = exporter.DirectorySizeEngine(base_path=str(tmp_path))
+    assert engine.refresh(budget=60)
+    if not engine.hints.available:
+        pytest.skip('inotify is not available')
+    scanned = count_scans(engine, monkeypatch)
+
+    with open(str(tmp_path / 'jellyfin' / 'config' / 'system.xml'), 'ab') as f:
+        f.write(b'y' * 2500)
+    assert engine.refresh(budget=60)
+    assert scanned == [str(tmp_path / 'jellyfin' / 'config')]
+    assert engine.sizes() == expected(tmp_path)
+
+
+def test_budget_slices_resume_where_they_stopped(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+    for i in range(20):
+        write(str(tmp_path / 'jellyfin' / 'library' / f'season{i}' / 'episode.mkv'), 100 + i)
+    engine = exporter.DirectorySizeEngine(base_path=str(tmp_path), use_inotify=False)
+    scanned = count_scans(engine, monkeypatch)
+
+    # A zero budget still makes progress, one directory per slice
+    slices = 1
+    while not engine.refresh(budget=0):
+        slices += 1
+        assert slices < 100
+    assert slices > 1
+    assert engine.sizes() == expected(tmp_path)
+    # Nothing is listed twice just because the walk was interrupted
+    assert len(scanned) == len(set(scanned)) == len(engine._dirs)
+
+    # Totals from the last completed pass are kept while the next one is unfinished
+    settle()
+    write(str(tmp_path / 'jellyfin' / 'library' / 'season0' / 'extra.mkv'), 9999)
+    before = engine.sizes()
+    assert not engine.refresh(budget=0)
+    assert engine.sizes() == before
+    while not engine.refresh(budget=0):
+        pass
+    assert engine.sizes() == expected(tmp_path)
+
+
+def test_watch_limit_falls_back_to_mtime_checks(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+    engine = exporter.DirectorySizeEngine(base_path=str(tmp_path))
+    # Set up the hints without watching anything yet
+    engine.hints = exporter.InotifyHints()
+    if not engine.hints.available:
+        pytest.skip('inotify is not available')
+
+    class LimitedLibc:
+        # Behaves like fs.inotify.max_user_watches = 2
+        def __init__(self, libc):
+            self.libc = libc
+
+        def inotify_add_watch(self, fd, path, mask):
+            if len(engine.hints.watches) >= 2:
+                return -1
+            return self.libc.inotify_add_watch(fd, path, mask)
+    engine.hints.libc = LimitedLibc(engine.hints.libc)
+    monkeypatch.setattr(ctypes, 'get_errno', lambda: errno.ENOSPC)
+
+    assert engine.refresh(budget=60)
+    assert engine.hints.exhausted and not engine.hints.available
+    assert len(engine.hints.watches) == 2
+    assert engine.sizes() == expected(tmp_path)
+
+    # New files still show up through directory mtimes
+    settle()
+    write(str(tmp_path / 'nextcloud' / 'data' / 'todo.txt'), 777)
+    write(str(tmp_path / 'jellyfin' / 'cache' / 'images' / 'e.jpg'), 888)
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
+
+    # and growth in unwatched directories is picked up by the full rescan
+    with open(str(tmp_path / 'nextcloud' / 'data' / 'todo.txt'), 'ab') as f:
+        f.write(b'z' * 1000)
+    engine.full_rescan_interval = 0
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
+
+
+def test_lost_inotify_events_rescan_everything(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+    engine = exporter.DirectorySizeEngine(base_path=str(tmp_path))
+    assert engine.refresh(budget=60)
+    scanned = count_scans(engine, monkeypatch)
+
+    with open(str(tmp_path / 'nextcloud' / 'data' / 'notes.txt'), 'ab') as f:
+        f.write(b'z' * 50)
+    monkeypatch.setattr(engine.hints, 'drain', lambda: None)
+    assert engine.refresh(budget=60)
+    assert sorted(scanned) == sorted(engine._dirs)
+    assert engine.sizes() == expected(tmp_path)
+
+
+def test_inotify_unavailable(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+
+    class NoInotifyLibc:
+        def inotify_init1(self, flags):
+            return -1
+    monkeypatch.setattr(ctypes, 'CDLL', lambda name, use_errno=False: NoInotifyLibc())
+    engine = exporter.DirectorySizeEngine(base_path=str(tmp_path))
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
+    assert not engine.hints.available
+    assert engine.hints.drain() == set()
+    assert not engine.hints.watch(str(tmp_path))
+    settle()
+    write(str(tmp_path / 'nextcloud' / 'data' / 'more.txt'), 1234)
+    assert engine.refresh(budget=60)
+    assert engine.sizes() == expected(tmp_path)
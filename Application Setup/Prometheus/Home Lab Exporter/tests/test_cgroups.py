@@ -0,0 +1,130 @@
+"""Per-container resource usage read from a fake cgroup v2 hierarchy"""
+
+import os
+import shutil
+
+import pytest
+
+import homelab_exporter as exporter
+
+JELLYFIN = 'a' * 64
+CADDY = 'b' * 64
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def make_scope(scope, memory_max='max', procs=''):
+    write(os.path.join(scope, 'cpu.stat'),
+          'usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n'
+          'nr_periods 10\nnr_throttled 2\nthrottled_usec 125000\n')
+    write(os.path.join(scope, 'memory.current'), '104857600\n')
+    write(os.path.join(scope, 'memory.max'), f'{memory_max}\n')
+    write(os.path.join(scope, 'memory.stat'),
+          'anon 73400320\nfile 31457280\nkernel 1048576\nshmem 0\npgfault 12345\n')
+    write(os.path.join(scope, 'io.stat'),
+          '8:0 rbytes=4096 wbytes=8192 rios=1 wios=2 dbytes=0 dios=0\n'
+          '259:0 rbytes=1000 wbytes=0 rios=3 wios=0 dbytes=0 dios=0\n')
+    write(os.path.join(scope, 'cgroup.procs'), procs)
+
+
+@pytest.fixture
+def cgroup_root(tmp_path):
+    root = tmp_path / 'cgroup'
+    write(str(root / 'cgroup.controllers'), 'cpuset cpu io memory pids\n')
+    # systemd driver
+    make_scope(str(root / 'system.slice' / f'docker-{JELLYFIN}.scope'), memory_max='536870912')
+    write(str(root / 'system.slice' / 'sshd.service' / 'cgroup.procs'), '')
+    write(str(root / 'system.slice' / 'docker-short.scope' / 'cgroup.procs'), '')
+    # cgroupfs driver
+    make_scope(str(root / 'docker' / CADDY))
+    return str(root)
+
+
+def test_scopes_of_both_drivers(cgroup_root):
+    scopes = exporter.ContainerCgroupReader(cgroup_root).scopes()
+    assert scopes == {
+        JELLYFIN: os.path.join(cgroup_root, 'system.slice', f'docker-{JELLYFIN}.scope'),
+        CADDY: os.path.join(cgroup_root, 'docker', CADDY),
+    }
+
+
+def test_scopes_without_cgroup_v2(tmp_path):
+    with pytest.raises(OSError):
+        exporter.ContainerCgroupReader(str(tmp_path)).scopes()
+
+
+def test_read_usage(cgroup_root):
+    reader = exporter.ContainerCgroupReader(cgroup_root)
+    usage = reader.read(reader.scopes()[JELLYFIN], network=False)
+    assert usage == {
+        'cpu_usage_seconds': 2.5,
+        'cpu_user_seconds': 2.0,
+        'cpu_system_seconds': 0.5,
+        'cpu_throttled_seconds': 0.125,
+        'memory_usage_bytes': 104857600,
+        'memory_limit_bytes': 536870912,
+        'memory_anon_bytes': 73400320,
+        'memory_file_bytes': 31457280,
+        # Summed over both devices
+        'block_read_bytes': 5096,
+        'block_write_bytes': 8192,
+        'block_reads': 4,
+        'block_writes': 2,
+    }
+
+
+def test_unlimited_memory_and_empty_files(cgroup_root):
+    reader = exporter.ContainerCgroupReader(cgroup_root)
+    scope = reader.scopes()[CADDY]
+    # io.stat is empty until the container touched a block device
+    write(os.path.join(scope, 'io.stat'), '')
+    write(os.path.join(scope, 'cpu.stat'), 'usage_usec 10\n')
+    usage = reader.read(scope)
+    assert usage['memory_limit_bytes'] is None
+    assert usage['block_read_bytes'] == usage['block_writes'] == 0
+    assert usage['cpu_usage_seconds'] == 0.00001 and usage['cpu_throttled_seconds'] == 0
+    # No process left to read the network namespace through
+    assert 'network_receive_bytes' not in usage
+
+
+def test_network_counters_through_a_process(cgroup_root):
+    reader = exporter.ContainerCgroupReader(cgroup_root)
+    scope = reader.scopes()[CADDY]
+    write(os.path.join(scope, 'cgroup.procs'), f'{os.getpid()}\n')
+    usage = reader.read(scope)
+    for key in ('network_receive_bytes', 'network_receive_packets',
+                'network_transmit_bytes', 'network_transmit_packets'):
+        assert usage[key] >= 0
+
+
+def test_container_disappearing_mid_read(cgroup_root, monkeypatch):
+    reader = exporter.ContainerCgroupReader(cgroup_root)
+    scopes = reader.scopes()
+    read_keyed = reader._read_keyed
+
+    def read_then_vanish(path):
+        # The container stops right after its first file was read
+        values = read_keyed(path)
+        if JELLYFIN in path:
+            shutil.rmtree(os.path.dirname(path))
+        return values
+    monkeypatch.setattr(reader, '_read_keyed', read_then_vanish)
+    with pytest.raises(FileNotFoundError):
+        reader.read(scopes[JELLYFIN], network=False)
+
+    containers = {
+        'jellyfin': {'id': JELLYFIN, 'state': 'running', 'network_mode': 'bridge'},
+        'caddy': {'id': CADDY, 'state': 'running', 'network_mode': 'host'},
+        'old': {'id': 'c' * 64, 'state': 'exited', 'network_mode': 'bridge'},
+    }
+    make_scope(scopes[JELLYFIN])
+    monkeypatch.setattr(exporter.container_state_cache, 'containers', lambda: containers)
+    monkeypatch.setattr(exporter, 'container_cgroups', reader)
+    # The vanished container is left out, the others are still reported
+    usage = exporter.export_container_resources()
+    assert list(usage) == ['caddy']
+    assert 'network_receive_bytes' not in usage['caddy']
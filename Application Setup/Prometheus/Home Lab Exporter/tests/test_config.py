@@ -0,0 +1,79 @@
+"""load_config validation and reload rollback"""
+
+import copy
+import os
+
+import pytest
+
+import homelab_exporter as exporter
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_config(tmp_path, text):
+    path = tmp_path / 'config.yml'
+    path.write_text(text)
+    return str(path)
+
+
+def test_shipped_config_matches_the_defaults():
+    assert exporter.load_config(os.path.join(HERE, 'config.yml')) == exporter.DEFAULT_CONFIG
+
+
+def test_missing_file_means_defaults(tmp_path):
+    assert exporter.load_config(str(tmp_path / 'missing.yml')) == exporter.DEFAULT_CONFIG
+
+
+@pytest.mark.parametrize('text', [
+    "collectors:\n  speedtest:\n    schedule: 'bad'\n",
+    "collectors:\n  speedtest:\n    schedule: '61 * * * *'\n",
+    "collectors:\n  speedtest:\n    schedule: 5\n",
+    "collectors:\n  nope:\n    enabled: true\n",
+    "logging:\n  format: xml\n",
+    "collectors:\n  network_latency:\n    window: 0\n",
+])
+def test_invalid_values_are_rejected_on_load(tmp_path, text):
+    with pytest.raises(ValueError):
+        exporter.load_config(write_config(tmp_path, text))
+
+
+@pytest.fixture
+def applied(monkeypatch):
+    """Record apply_config calls and systemd notifications instead of reconfiguring the process"""
+    calls = []
+    notifications = []
+
+    def apply_config(new_config):
+        calls.append(new_config)
+        if new_config['collectors']['cpu'].get('explode'):
+            raise RuntimeError('boom')
+        exporter.config = new_config
+
+    monkeypatch.setattr(exporter, 'apply_config', apply_config)
+    monkeypatch.setattr(exporter, 'sd_notify', notifications.append)
+    monkeypatch.setattr(exporter, 'config', copy.deepcopy(exporter.DEFAULT_CONFIG))
+    return calls, notifications
+
+
+def test_reload_keeps_the_config_when_the_file_is_invalid(tmp_path, applied):
+    calls, notifications = applied
+    current = exporter.config
+    exporter.reload_config(write_config(tmp_path, "collectors:\n  speedtest:\n    schedule: 'bad'\n"))
+    assert exporter.config is current
+    assert calls == [] and notifications == []
+
+
+def test_reload_rolls_back_when_applying_fails(tmp_path, applied):
+    calls, notifications = applied
+    current = exporter.config
+    exporter.reload_config(write_config(tmp_path, "collectors:\n  cpu:\n    explode: true\n"))
+    assert exporter.config is current
+    assert calls[-1] is current
+    assert notifications == ['RELOADING=1', 'READY=1']
+
+
+def test_reload_applies_a_valid_config(tmp_path, applied):
+    calls, notifications = applied
+    exporter.reload_config(write_config(tmp_path, "collectors:\n  cpu:\n    interval: 5\n"))
+    assert exporter.config['collectors']['cpu']['interval'] == 5
+    assert notifications == ['RELOADING=1', 'READY=1']
@@ -0,0 +1,233 @@
+"""D-Bus wire format, DBusConnection over a socketpair, and UnitStateWatcher against a fake system bus"""
+
+import os
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import homelab_exporter as exporter
+
+DBusConnection = exporter.DBusConnection
+Watcher = exporter.UnitStateWatcher
+
+
+@pytest.mark.parametrize('signature, value, expected', [
+    ('y', 200, 200),
+    ('b', True, True),
+    ('n', -2, -2),
+    ('x', -(1 << 40), -(1 << 40)),
+    ('t', 1 << 63, 1 << 63),
+    ('d', 2.5, 2.5),
+    ('s', 'dökker.service', 'dökker.service'),
+    ('o', '/org/freedesktop/systemd1/unit/docker_2eservice', '/org/freedesktop/systemd1/unit/docker_2eservice'),
+    ('g', 'sa{sv}as', 'sa{sv}as'),
+    ('v', ('t', 7), 7),
+    ('as', [], []),
+    ('as', ['a', 'bc'], ['a', 'bc']),
+    ('at', [1, 2], [1, 2]),
+    ('a{sv}', {'ActiveState': ('s', 'active'), 'StateChangeTimestamp': ('t', 5)},
+     {'ActiveState': 'active', 'StateChangeTimestamp': 5}),
+    ('a(yv)', [(1, ('o', '/x')), (5, ('u', 3))], [[1, '/x'], [5, 3]]),
+    ('(ysat)', (1, 'x', [9]), [1, 'x', [9]]),
+])
+def test_marshal_round_trip(signature, value, expected):
+    for prefix in (b'', b'\1', b'\1\2\3'):
+        buf = bytearray(prefix)
+        exporter.dbus_marshal(buf, signature, value)
+        decoded, offset = exporter.dbus_unmarshal(buf, len(prefix), signature)
+        assert decoded == expected and offset == len(buf)
+
+
+def test_empty_array_of_8_byte_elements_keeps_its_padding():
+    buf = bytearray()
+    exporter.dbus_marshal(buf, 'at', [])
+    # Length, then padding to the (absent) first element, which the length doesn't include
+    assert bytes(buf) == b'\0' * 8
+    assert exporter.dbus_unmarshal(buf, 0, 'at') == ([], 8)
+
+
+def test_unmarshal_big_endian():
+    data = struct.pack('>I', 3) + b'abc\0' + struct.pack('>I', 42)
+    value, offset = exporter.dbus_unmarshal(data, 0, 's', '>')
+    assert value == 'abc'
+    assert exporter.dbus_unmarshal(data, offset, 'u', '>') == (42, 12)
+
+
+def test_split_signature():
+    assert exporter.dbus_split_signature('sa{sv}as(ia(ss))y') == ['s', 'a{sv}', 'as', '(ia(ss))', 'y']
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    a, b = DBusConnection(timeout=5), DBusConnection(timeout=5)
+    a.sock, b.sock = left, right
+    yield a, b
+    a.close()
+    b.close()
+
+
+def test_messages_round_trip(pair):
+    a, b = pair
+    a.send(DBusConnection.SIGNAL, {1: '/unit/docker', 2: Watcher.PROPERTIES_INTERFACE, 3: 'PropertiesChanged'},
+           'sa{sv}as', (Watcher.UNIT_INTERFACE, {'ActiveState': ('s', 'failed')}, ['SubState']))
+    message_type, fields, body = b.receive()
+    assert message_type == DBusConnection.SIGNAL
+    assert fields == {'path': '/unit/docker', 'interface': Watcher.PROPERTIES_INTERFACE,
+                      'member': 'PropertiesChanged', 'signature': 'sa{sv}as'}
+    assert body == [Watcher.UNIT_INTERFACE, {'ActiveState': 'failed'}, ['SubState']]
+
+
+def test_call_queues_signals_that_arrive_before_the_reply(pair):
+    client, bus = pair
+
+    def serve():
+        bus.receive()
+        bus.send(DBusConnection.SIGNAL, {1: '/a', 3: 'Early'}, 's', ('first',))
+        bus.send(DBusConnection.METHOD_RETURN, {5: 1}, 'o', ('/unit/docker',))
+        bus.receive()
+        bus.send(DBusConnection.ERROR, {4: 'org.freedesktop.systemd1.NoSuchUnit', 5: 2}, 's', ('no such unit',))
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    assert client.call('org.freedesktop.systemd1', '/', 'x', 'LoadUnit', 's', ('docker.service',)) == [
+        '/unit/docker']
+    with pytest.raises(exporter.DBusError, match='NoSuchUnit'):
+        client.call('org.freedesktop.systemd1', '/', 'x', 'LoadUnit', 's', ('nope.service',))
+    thread.join()
+    fields, body = next(client.signals())
+    assert (fields['member'], body) == ('Early', ['first'])
+
+
+class FakeSystemBus:
+    """Accepts one client at a time on a Unix socket and answers like dbus-daemon and systemd would"""
+
+    def __init__(self, path, units):
+        self.units = units  # unit -> {'ActiveState': ..., 'StateChangeTimestamp': ...}
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+        self.connection = None
+        self.matches = []
+        self.ready = threading.Event()
+        self._send_lock = threading.Lock()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    @staticmethod
+    def unit_path(unit):
+        return '/org/freedesktop/systemd1/unit/' + unit.replace('.', '_2e')
+
+    def _serve(self):
+        sock, _ = self.listener.accept()
+        bus = DBusConnection()
+        bus.sock = sock
+        # Accept the client's EXTERNAL auth line, then expect BEGIN before the first message
+        while b'\r\n' not in bus._buffer:
+            bus._fill()
+        assert bus._buffer.startswith(b'\0AUTH EXTERNAL ')
+        sock.sendall(b'OK 0123456789abcdef0123456789abcdef\r\n')
+        while b'BEGIN\r\n' not in bus._buffer:
+            bus._fill()
+        del bus._buffer[:bus._buffer.index(b'BEGIN\r\n') + len(b'BEGIN\r\n')]
+        self.connection = bus
+        serial = 0
+        paths = {self.unit_path(unit): unit for unit in self.units}
+        try:
+            while True:
+                _, fields, args = bus.receive()
+                # The client only sends method calls, numbered from 1
+                serial += 1
+                member = fields['member']
+                reply = ('', ())
+                if member == 'Hello':
+                    reply = ('s', (':1.1',))
+                elif member == 'LoadUnit':
+                    reply = ('o', (self.unit_path(args[0]),))
+                elif member == 'AddMatch':
+                    self.matches.append(args[0])
+                    if len(self.matches) == len(self.units):
+                        self.ready.set()
+                elif member == 'Get':
+                    name = args[1]
+                    value = self.units[paths[fields['path']]][name]
+                    reply = ('v', (('s', value) if name == 'ActiveState' else ('t', value),))
+                with self._send_lock:
+                    bus.send(DBusConnection.METHOD_RETURN, {5: serial}, *reply)
+        except OSError:
+            pass
+
+    def set_state(self, unit, state, timestamp, send_value=True):
+        """Change a unit's state and send PropertiesChanged, with the value or only invalidating it"""
+        self.units[unit] = {'ActiveState': state, 'StateChangeTimestamp': timestamp}
+        changed = {'ActiveState': ('s', state), 'StateChangeTimestamp': ('t', timestamp)} if send_value else {}
+        invalidated = [] if send_value else ['ActiveState', 'StateChangeTimestamp']
+        with self._send_lock:
+            self.connection.send(DBusConnection.SIGNAL, {1: self.unit_path(unit), 2: Watcher.PROPERTIES_INTERFACE,
+                                                         3: 'PropertiesChanged', 7: Watcher.SYSTEMD},
+                                 'sa{sv}as', (Watcher.UNIT_INTERFACE, changed, invalidated))
+
+    def close(self):
+        self.listener.close()
+        if self.connection is not None:
+            self.connection.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.01)
+    raise AssertionError('condition not met in time')
+
+
+@pytest.fixture
+def watched(tmp_path):
+    path = os.path.join(tmp_path, 'system_bus_socket')
+    bus = FakeSystemBus(path, {
+        'docker.service': {'ActiveState': 'active', 'StateChangeTimestamp': 1_700_000_000_000_000},
+        'sshd.service': {'ActiveState': 'inactive', 'StateChangeTimestamp': 0},
+    })
+    watcher = Watcher(timeout=5, resync_interval=30)
+    watcher.table = exporter.StateTable(flap_window=600, flap_threshold=2)
+    watcher.configure(['docker', 'sshd.service'], path)
+    watcher.start()
+    yield bus, watcher
+    watcher.stop()
+    bus.close()
+
+
+def test_watcher_reads_the_initial_states(watched):
+    bus, watcher = watched
+    states = wait_for(watcher.states)
+    assert states['docker.service']['state'] == 'active' and states['docker.service']['running']
+    assert states['docker.service']['last_transition'] == 1_700_000_000
+    assert states['sshd.service']['last_transition'] is None and not states['sshd.service']['running']
+    assert len(bus.matches) == 2 and all("member='PropertiesChanged'" in match for match in bus.matches)
+
+
+def test_properties_changed_updates_the_state_table(watched):
+    bus, watcher = watched
+    wait_for(watcher.states)
+    bus.ready.wait(5)
+
+    bus.set_state('docker.service', 'failed', 1_700_000_100_000_000)
+    wait_for(lambda: watcher.states()['docker.service']['state'] == 'failed')
+    assert watcher.states()['docker.service']['last_transition'] == 1_700_000_100
+
+    # Only invalidated, so the watcher reads the new values back with Get
+    bus.set_state('docker.service', 'active', 1_700_000_200_000_000, send_value=False)
+    docker = wait_for(lambda: watcher.states()['docker.service']['running'] and watcher.states()['docker.service'])
+    assert docker['restarts'] == 1 and not docker['flapping']
+
+    bus.set_state('docker.service', 'failed', 1_700_000_300_000_000)
+    bus.set_state('docker.service', 'activating', 1_700_000_301_000_000)
+    bus.set_state('docker.service', 'active', 1_700_000_302_000_000)
+    docker = wait_for(lambda: watcher.states()['docker.service']['restarts'] == 2
+                      and watcher.states()['docker.service'])
+    assert docker['flapping'] and docker['last_transition'] == 1_700_000_302
+    assert watcher.states()['sshd.service']['restarts'] == 0
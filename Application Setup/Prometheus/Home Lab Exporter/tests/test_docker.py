@@ -0,0 +1,128 @@
+"""DockerClient and ContainerStateCache against a fake Docker Engine on a Unix socket"""
+
+import json
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import homelab_exporter as exporter
+
+
+CONTAINERS = [
+    {'Id': 'a' * 64, 'Names': ['/jellyfin'], 'State': 'running', 'HostConfig': {'NetworkMode': 'bridge'}},
+    {'Id': 'b' * 64, 'Names': ['/immich_server'], 'State': 'exited', 'HostConfig': {'NetworkMode': 'host'}},
+]
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return 'docker.sock'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith('/containers/json'):
+            body = json.dumps(CONTAINERS).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if self.server.close_after_response:
+                # Behave like a daemon that dropped the idle keep-alive connection
+                self.close_connection = True
+        elif self.path.startswith('/events'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            for event in self.server.events:
+                self.wfile.write(json.dumps(event).encode() + b'\n')
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+class FakeDockerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(path, FakeDockerHandler)
+        self.requests = []
+        self.events = []
+        self.close_after_response = False
+
+
+@pytest.fixture
+def docker(tmp_path):
+    path = os.path.join(tmp_path, 'docker.sock')
+    server = FakeDockerServer(path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, path
+    server.shutdown()
+    server.server_close()
+
+
+def test_containers_from_one_list_call(docker):
+    server, path = docker
+    client = exporter.DockerClient(socket_path=path, timeout=5)
+    containers = client.containers()
+    assert containers == {
+        'jellyfin': {'id': 'a' * 64, 'state': 'running', 'network_mode': 'bridge'},
+        'immich_server': {'id': 'b' * 64, 'state': 'exited', 'network_mode': 'host'},
+    }
+    assert client.container_states() == {'jellyfin': 'running', 'immich_server': 'exited'}
+    assert server.requests == ['/containers/json?all=1', '/containers/json?all=1']
+
+
+def test_connection_is_reused(docker):
+    server, path = docker
+    client = exporter.DockerClient(socket_path=path, timeout=5)
+    client.containers()
+    pooled = list(client._pool)
+    client.containers()
+    assert len(pooled) == 1 and client._pool == pooled
+
+
+def test_retries_once_when_the_daemon_closed_the_idle_connection(docker):
+    server, path = docker
+    server.close_after_response = True
+    client = exporter.DockerClient(socket_path=path, timeout=5)
+    client.containers()
+    # The response didn't announce the close, so the dead connection went back to the pool
+    assert len(client._pool) == 1
+    assert client.container_states()['jellyfin'] == 'running'
+
+
+def test_http_error_raises(docker):
+    server, path = docker
+    client = exporter.DockerClient(socket_path=path, timeout=5)
+    with pytest.raises(OSError):
+        client.get('/nope')
+
+
+def test_events_keep_the_cache_current(docker):
+    server, path = docker
+    server.events = [
+        {'Type': 'container', 'Action': 'die', 'Actor': {'ID': 'a' * 64, 'Attributes': {'name': 'jellyfin'}}},
+        {'Type': 'container', 'Action': 'exec_start: sh', 'Actor': {'Attributes': {'name': 'jellyfin'}}},
+        {'Type': 'container', 'Action': 'start', 'Actor': {'ID': 'c' * 64, 'Attributes': {'name': 'mealie'}}},
+        {'Type': 'container', 'Action': 'destroy', 'Actor': {'Attributes': {'name': 'immich_server'}}},
+    ]
+    client = exporter.DockerClient(socket_path=path, timeout=5)
+    cache = exporter.ContainerStateCache(client)
+    assert cache.states() is None
+    cache.sync()
+    for event in client.events(since=0, timeout=5):
+        cache.apply_event(event)
+    assert cache.states() == {'jellyfin': 'exited', 'mealie': 'running'}
+    assert cache.containers()['mealie'] == {'id': 'c' * 64, 'state': 'running', 'network_mode': None}
@@ -0,0 +1,126 @@
+"""Peer federation against local exporters, and the exposition parser it relies on"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import homelab_exporter as exporter
+
+
+def sample_families():
+    gauge = exporter.GaugeFamily('node_temp_celsius', 'Temperature with "quotes" and \\ backslash', ['sensor'])
+    gauge.set(41.5, 'cpu "0"').set(float('nan'), 'line\nbreak').set(float('inf'), 'hot')
+    counter = exporter.CounterFamily('requests', 'Requests served', ['code']).set(12, '200').set(0, '500')
+    histogram = exporter.Histogram((0.1, 1))
+    for value in (0.05, 0.5, 3):
+        histogram.observe(value)
+    window = exporter.RingBuffer(4)
+    window.append(2.0)
+    return [gauge, counter, exporter.HistogramFamily('latency_seconds', 'Latency').add(histogram),
+            exporter.SummaryFamily('rtt_ms', 'RTT', ['target']).add(window, histogram, '1.1.1.1'),
+            exporter.GaugeFamily('up', 'Whether it is up').set(1)]
+
+
+def test_parse_exposition_round_trip():
+    text = exporter.render_families(sample_families())
+    parsed = exporter.parse_exposition(text.decode())
+    assert [type(family) for family in parsed] == [type(family) for family in sample_families()]
+    assert exporter.render_families(parsed) == text
+
+
+def test_parse_exposition_untyped_samples():
+    parsed = exporter.parse_exposition('# HELP loose A sample without TYPE\nloose{a="b"} 3 1700000000000\n')
+    assert [(family.name, family.samples) for family in parsed] == [('loose', [('', (('a', 'b'),), 3)])]
+
+
+def test_parse_exposition_rejects_garbage():
+    with pytest.raises(ValueError):
+        exporter.parse_exposition('not a sample line\n')
+
+
+class PeerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        body = exporter.render_families([exporter.GaugeFamily('peer_value', 'A peer value').set(self.server.value)])
+        self.send_response(200)
+        self.send_header('Content-Type', exporter.TEXT_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # A trickling peer answers every read within the socket timeout but takes trickle seconds overall
+        chunks = max(int(self.server.trickle / 0.2), 1)
+        step = -(-len(body) // chunks)
+        for start in range(0, len(body), step):
+            if self.server.trickle:
+                time.sleep(0.2)
+            self.wfile.write(body[start:start + step])
+            self.wfile.flush()
+
+
+@pytest.fixture
+def peers():
+    servers = []
+
+    def start(value, trickle=0):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), PeerHandler)
+        server.daemon_threads = True
+        server.value, server.trickle, server.requests = value, trickle, 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, f'127.0.0.1:{server.server_port}'
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_scrape_waits_for_one_shared_deadline(peers):
+    fast, fast_peer = peers(1)
+    slow = [peers(value, trickle=2.5) for value in (2, 3)]
+    federation = exporter.PeerFederation([fast_peer] + [peer for _, peer in slow], ttl=0, timeout=1,
+                                         instance='me')
+
+    started = time.monotonic()
+    results = federation.peer_results()
+    # Two slow peers used to cost a timeout each
+    assert time.monotonic() - started < 1.8
+    assert results[fast_peer]['up'] and results[fast_peer]['families'][0].samples == [('', (), 1)]
+    assert [results[peer]['up'] for _, peer in slow] == [False, False]
+
+    # Their fetches are still running, so the next scrape waits on them instead of fetching again
+    results = federation.peer_results()
+    assert [server.requests for server, _ in slow] == [1, 1]
+    assert fast.requests == 2
+    # A fetch that outlived the deadline still stores its result once it completes
+    time.sleep(1.5)
+    federation.ttl = 15
+    results = federation.peer_results()
+    assert all(result['up'] for result in results.values())
+
+
+def test_merge_labels_every_series_with_its_instance(peers):
+    _, peer = peers(7)
+    federation = exporter.PeerFederation([peer], ttl=15, timeout=2, instance='me')
+    local = [exporter.GaugeFamily('peer_value', 'Local').set(5)]
+    merged = {family.name: family for family in federation.merge(local)}
+    assert merged['peer_value'].samples == [('', (('instance', 'me'),), 5), ('', (('instance', peer),), 7)]
+    assert merged['federation_peer_up'].samples == [('', (('instance', peer),), 1)]
+
+
+def test_pool_has_a_worker_per_peer():
+    # Nothing listens on port 1, so every fetch fails straight away
+    peers = [f'127.0.0.{number}:1' for number in range(1, 6)]
+    federation = exporter.PeerFederation(peers[:3], timeout=2)
+    assert federation.max_workers == 3 and federation.executor is None
+    federation.peer_results()
+    assert federation.executor._max_workers == 3
+    federation.configure({'peers': peers, 'ttl': 15, 'timeout': 2, 'instance': 'x'})
+    federation.peer_results()
+    assert federation.max_workers == 5 and federation.executor._max_workers == 5
@@ -0,0 +1,133 @@
+"""Block device counters, mount table parsing and the statvfs cache of the filesystems collector"""
+
+import os
+import time
+from threading import Event
+
+import pytest
+
+import homelab_exporter as exporter
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+DISKSTATS = os.path.join(FIXTURES, 'diskstats')
+MOUNTINFO = os.path.join(FIXTURES, 'mountinfo')
+
+
+def test_diskstats_default_filters():
+    devices = exporter.export_block_device_counters(path=DISKSTATS)
+    assert sorted(devices) == ['dm-0', 'nvme0n1', 'sda', 'sda1']
+
+
+def test_diskstats_fields():
+    devices = exporter.export_block_device_counters(allow=('sd*', 'nvme*', 'dm-*'), deny=('sd?[0-9]',),
+                                                    path=DISKSTATS)
+    assert sorted(devices) == ['dm-0', 'nvme0n1', 'sda']
+    nvme = devices['nvme0n1']
+    # Flush columns of newer kernels are past the known fields and dropped
+    assert list(nvme) == list(exporter.DISKSTATS_FIELDS)
+    assert nvme['reads'] == 5581234 and nvme['sectors_read'] == 402114520
+    assert nvme['writes'] == 9123345 and nvme['sectors_written'] == 812345678
+    assert nvme['io_in_progress'] == 3 and nvme['io_ms'] == 3012334
+    assert nvme['discards'] == 20123 and nvme['sectors_discarded'] == 4123345
+    # Kernels before 4.18 have no discard columns
+    assert devices['dm-0'] == dict(zip(exporter.DISKSTATS_FIELDS[:11], (102, 0, 4110, 33, 7, 0, 56, 2, 0, 40, 35)))
+
+
+@pytest.mark.parametrize('escaped, path', [
+    ('/srv', '/srv'),
+    (r'/srv/media/TV\040Shows', '/srv/media/TV Shows'),
+    (r'/mnt/back\134slash\011tab', '/mnt/back\\slash\ttab'),
+    (r'/mnt/new\012line', '/mnt/new\nline'),
+    # Only three octal digits are an escape
+    (r'/mnt/not\04an\999escape', r'/mnt/not\04an\999escape'),
+])
+def test_unescape_mount_path(escaped, path):
+    assert exporter.unescape_mount_path(escaped) == path
+
+
+def test_read_mounts():
+    mounts = exporter.read_mounts(('ext4', 'xfs', 'nfs4'), path=MOUNTINFO)
+    assert mounts == {
+        '/': {'device': '/dev/nvme0n1p2', 'fstype': 'ext4', 'readonly': False},
+        '/srv': {'device': '/dev/sda1', 'fstype': 'xfs', 'readonly': False},
+        # " - " inside an escaped path isn't taken for the separator of the fstype
+        '/srv/media/TV Shows - Archive': {'device': 'nas:/export/tv shows', 'fstype': 'nfs4', 'readonly': False},
+        '/mnt/back\\slash\ttab': {'device': '/dev/sda1', 'fstype': 'xfs', 'readonly': True},
+        # The later of two mounts on one mount point is the one that's visible
+        '/mnt/usb': {'device': '/dev/sdc1', 'fstype': 'ext4', 'readonly': True},
+    }
+    assert list(exporter.read_mounts(('vfat',), path=MOUNTINFO)) == ['/boot/efi']
+
+
+@pytest.fixture
+def statvfs(monkeypatch):
+    # Fake statvfs: mount points in hung block until released, missing ones fail
+    calls = []
+    hung = {}
+    missing = set()
+    real_statvfs = os.statvfs
+
+    def fake_statvfs(mountpoint):
+        calls.append(mountpoint)
+        if mountpoint in hung:
+            hung[mountpoint].wait(5)
+        if mountpoint in missing:
+            raise FileNotFoundError(mountpoint)
+        return real_statvfs('/')
+    monkeypatch.setattr(exporter.os, 'statvfs', fake_statvfs)
+    yield calls, hung, missing
+    for release in hung.values():
+        release.set()
+
+
+def test_statvfs_results_and_unmounted_mounts_expire(statvfs):
+    calls, hung, missing = statvfs
+    stats = exporter.MountStats(timeout=1.0)
+    result = stats.stats(['/', '/srv'])
+    assert set(result) == {'/', '/srv'}
+    assert all(stat is not None and not stale for stat, stale in result.values())
+
+    # Mounts that are gone from the table are dropped from the cache
+    result = stats.stats(['/'])
+    assert list(result) == ['/'] and set(stats._cache) == {'/'}
+
+    # and a failing statvfs drops the cached result instead of serving it forever
+    missing.add('/')
+    assert stats.stats(['/']) == {'/': (None, False)}
+    assert stats._cache == {}
+
+
+def test_statvfs_timeout_serves_the_last_result(statvfs):
+    calls, hung, missing = statvfs
+    stats = exporter.MountStats(timeout=0.2)
+    first = stats.stats(['/', '/mnt/nfs'])
+    assert not first['/mnt/nfs'][1]
+
+    # The NFS server goes away: the scrape waits at most timeout and flags the old result as stale
+    hung['/mnt/nfs'] = Event()
+    started = time.monotonic()
+    result = stats.stats(['/', '/mnt/nfs'])
+    assert time.monotonic() - started < 1
+    assert result['/mnt/nfs'] == (first['/mnt/nfs'][0], True)
+    assert result['/'][1] is False
+
+    # No new call is made while the hung one is outstanding, even once it's unmounted
+    calls.clear()
+    assert stats.stats(['/', '/mnt/nfs'])['/mnt/nfs'][1]
+    stats.stats(['/'])
+    assert calls.count('/mnt/nfs') == 0
+    assert '/mnt/nfs' in stats._cache
+
+    # Once it answers the mount is fresh again
+    hung.pop('/mnt/nfs').set()
+    deadline = time.monotonic() + 5
+    while stats._pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stats.stats(['/', '/mnt/nfs'])['/mnt/nfs'][1] is False
+
+
+def test_statvfs_timeout_without_a_previous_result(statvfs):
+    calls, hung, missing = statvfs
+    hung['/mnt/nfs'] = Event()
+    stats = exporter.MountStats(timeout=0.1)
+    assert stats.stats(['/mnt/nfs']) == {'/mnt/nfs': (None, True)}
@@ -0,0 +1,55 @@
+"""LatencyProber windows against a local TCP listener"""
+
+import socket
+
+import pytest
+
+import homelab_exporter as exporter
+
+
+@pytest.fixture
+def prober():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    prober = exporter.LatencyProber(count=2, timeout=1, interval=0, tcp_port=listener.getsockname()[1])
+    prober.use_icmp = False
+    yield prober
+    listener.close()
+
+
+def test_probes_are_recorded(prober):
+    assert prober.probe(['127.0.0.1']) == {'127.0.0.1': 2}
+    assert len(prober.windows['127.0.0.1']) == 2
+    assert prober.stats('127.0.0.1')['loss'] == 0
+    assert [family.name for family in prober.metric_families(['127.0.0.1'])] == [
+        'network_rtt_ms', 'network_rtt_window_ms']
+
+
+def test_one_off_probes_stay_out_of_the_windows(prober):
+    assert prober.probe(['127.0.0.1'], count=1, record=False) == {'127.0.0.1': 1}
+    assert prober.windows == {} and prober.histograms == {}
+    assert prober.metric_families(['127.0.0.1'])[0].samples == []
+
+
+def test_configure_keeps_the_newest_probes(prober):
+    prober.probe(['127.0.0.1'], count=4)
+    newest = prober.windows['127.0.0.1'].values()[-3:]
+    prober.configure(3, prober.buckets)
+    assert prober.windows['127.0.0.1'].values() == newest
+    assert prober.histograms['127.0.0.1'].count == 4
+
+    prober.configure(3, [1, 10, 100])
+    assert prober.histograms == {}
+    prober.probe(['127.0.0.1'], count=1)
+    assert prober.histograms['127.0.0.1'].bounds == (1, 10, 100)
+
+
+def test_network_monitor_configure():
+    monitor = exporter.NetworkMonitor(max_history=4)
+    for speed in (1.0, 2.0, 3.0, 4.0):
+        monitor.upload_speeds.append(speed)
+    monitor.configure(2, monitor.buckets)
+    assert monitor.upload_speeds.values() == [3.0, 4.0]
+    monitor.configure(2, [10, 100])
+    assert monitor.upload_histogram.bounds == (10, 100)
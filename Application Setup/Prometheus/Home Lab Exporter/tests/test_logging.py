@@ -0,0 +1,135 @@
+"""Rate limiting of repeated log records and JSON log lines"""
+
+import json
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler
+
+import pytest
+
+import homelab_exporter as exporter
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def logged():
+    logger = logging.getLogger('prometheus_exporter.test_logging')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    logger.addHandler(handler)
+    yield logger, handler
+    logger.removeHandler(handler)
+
+
+def log_from_one_place(logger, value):
+    logger.error(f"Error collecting metrics from 10.0.0.{value}: timed out")
+
+
+def test_repeats_collapse_into_a_suppressed_count(logged):
+    logger, handler = logged
+    limiter = exporter.LogRateLimiter(burst=2, interval=0.2)
+    handler.addFilter(limiter)
+
+    for value in range(10):
+        log_from_one_place(logger, value)
+    # Only the burst gets through, messages differing in numbers alone count as repeats
+    assert [record.getMessage() for record in handler.records] == [
+        "Error collecting metrics from 10.0.0.0: timed out",
+        "Error collecting metrics from 10.0.0.1: timed out",
+    ]
+
+    time.sleep(0.25)
+    log_from_one_place(logger, 99)
+    assert handler.records[-1].getMessage() == (
+        "Error collecting metrics from 10.0.0.99: timed out (suppressed 8 similar)")
+    assert limiter.emitted == {'ERROR': 3} and limiter.suppressed == {'ERROR': 8}
+
+    # The next window starts clean
+    time.sleep(0.25)
+    log_from_one_place(logger, 7)
+    assert handler.records[-1].getMessage() == "Error collecting metrics from 10.0.0.7: timed out"
+
+
+def test_different_call_sites_are_not_collapsed(logged):
+    logger, handler = logged
+    handler.addFilter(exporter.LogRateLimiter(burst=1, interval=60))
+
+    for _ in range(3):
+        logger.warning("Peer unreachable")
+        logger.warning("Peer unreachable")
+        logger.error("Peer unreachable")
+    # One record per line and level, however often each repeats
+    assert [(record.levelname, record.lineno) for record in handler.records] == [
+        ('WARNING', handler.records[0].lineno),
+        ('WARNING', handler.records[0].lineno + 1),
+        ('ERROR', handler.records[0].lineno + 2),
+    ]
+
+
+def test_distinct_messages_from_one_call_site_are_not_collapsed(logged):
+    logger, handler = logged
+    handler.addFilter(exporter.LogRateLimiter(burst=1, interval=60))
+    for unit in ('docker.service', 'caddy.service', 'docker.service'):
+        logger.info(f"Unit {unit} changed state")
+    assert [record.getMessage() for record in handler.records] == [
+        "Unit docker.service changed state",
+        "Unit caddy.service changed state",
+    ]
+
+
+def test_metric_families_count_per_level(logged):
+    logger, handler = logged
+    limiter = exporter.LogRateLimiter(burst=1, interval=60)
+    handler.addFilter(limiter)
+    for _ in range(3):
+        logger.warning("Disk almost full")
+    emitted, suppressed = limiter.metric_families()
+    assert emitted.samples == [('_total', (('level', 'WARNING'),), 1)]
+    assert suppressed.samples == [('_total', (('level', 'WARNING'),), 2)]
+
+
+def raise_and_log(logger):
+    try:
+        {}['missing']
+    except KeyError:
+        logger.exception("Collector 'docker' failed")
+
+
+def test_json_formatter_writes_one_line_with_the_traceback(logged):
+    logger, handler = logged
+    raise_and_log(logger)
+    line = exporter.JsonFormatter().format(handler.records[0])
+    assert '\n' not in line
+    entry = json.loads(line)
+    assert entry['level'] == 'ERROR' and entry['logger'] == 'prometheus_exporter.test_logging'
+    assert entry['message'].startswith("Collector 'docker' failed\nTraceback (most recent call last):")
+    assert "KeyError: 'missing'" in entry['message']
+
+
+def test_json_formatter_after_the_queue(logged):
+    # Queued records carry the formatted traceback in the message and no exc_info
+    logger, handler = logged
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    try:
+        raise_and_log(logger)
+    finally:
+        logger.removeHandler(queue_handler)
+        logger.addHandler(handler)
+    line = exporter.JsonFormatter().format(log_queue.get_nowait())
+    assert '\n' not in line
+    message = json.loads(line)['message']
+    assert message.count('Traceback (most recent call last):') == 1
+    assert "KeyError: 'missing'" in message
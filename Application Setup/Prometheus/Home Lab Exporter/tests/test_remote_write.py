@@ -0,0 +1,208 @@
+"""Remote write encoding, delivery to a stub receiver, and the on-disk buffer"""
+
+import os
+import random
+import socket
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import homelab_exporter as exporter
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def snappy_decompress(data) -> bytes:
+    """Decode the snappy block format: a varint length, then literal and copy elements"""
+    length, pos = read_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        if tag & 3 == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[pos:pos + extra], 'little')
+                pos += extra
+            out += data[pos:pos + size + 1]
+            pos += size + 1
+            continue
+        if tag & 3 == 1:
+            size, offset = 4 + (tag >> 2 & 7), (tag >> 5) << 8 | data[pos]
+            pos += 1
+        else:
+            width = 2 if tag & 3 == 2 else 4
+            size, offset = (tag >> 2) + 1, int.from_bytes(data[pos:pos + width], 'little')
+            pos += width
+        for _ in range(size):
+            out.append(out[-offset])
+    assert len(out) == length
+    return bytes(out)
+
+
+def protobuf_fields(data):
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 2:
+            size, pos = read_varint(data, pos)
+            yield number, data[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            yield number, data[pos:pos + 8]
+            pos += 8
+        else:
+            value, pos = read_varint(data, pos)
+            yield number, value
+
+
+def decode_write_request(data) -> list:
+    """Return [(labels dict, value, timestamp in ms), ...] from a WriteRequest"""
+    series = []
+    for _, timeseries in protobuf_fields(data):
+        labels, samples = {}, []
+        for number, payload in protobuf_fields(timeseries):
+            fields = dict(protobuf_fields(payload))
+            if number == 1:
+                labels[fields[1].decode()] = fields[2].decode()
+            else:
+                samples.append((struct.unpack('<d', fields[1])[0], fields[2]))
+        series.extend((labels, value, timestamp) for value, timestamp in samples)
+    return series
+
+
+class StubReceiverHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = self.server.status
+        if status < 300:
+            self.server.received.append((dict(self.headers), decode_write_request(snappy_decompress(body))))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+@pytest.fixture
+def receiver():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubReceiverHandler)
+    server.daemon_threads = True
+    server.status = 204
+    server.received = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def snapshot():
+    snapshot = exporter.MetricsSnapshot()
+    snapshot.update('test', [exporter.GaugeFamily('test_value', 'A test value', ['name']).set(1.5, 'a')], 0.1)
+    return snapshot
+
+
+def writer_for(snapshot, url, tmp_path, **settings):
+    return exporter.RemoteWriter(snapshot, url=url, timeout=2, instance='node1', buffer_dir=str(tmp_path / 'buffer'),
+                                 **settings)
+
+
+def value_of(series, name):
+    return [(labels, value) for labels, value, _ in series if labels['__name__'] == name]
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'abc',
+    b'a' * 1000,
+    bytes(range(256)) * 4,
+    random.Random(1).randbytes(5000),
+    b'node_cpu_seconds_total{cpu="0",mode="idle"} 1\n' * 300,
+])
+def test_snappy_round_trip(data):
+    assert snappy_decompress(exporter.snappy_compress(data)) == data
+
+
+def test_snappy_output_decodes_with_the_reference_library():
+    cramjam = pytest.importorskip('cramjam')
+    data = b'exporter_remote_write_requests_total{result="sent"} 12\n' * 200
+    assert bytes(cramjam.snappy.decompress_raw(exporter.snappy_compress(data))) == data
+
+
+def test_write_request_round_trip():
+    series = [((('__name__', 'up'), ('job', 'x')), 1.0, 1700000000000),
+              ((('__name__', 'temp'), ('sensor', 'ü')), -2.5, 1)]
+    decoded = decode_write_request(exporter.encode_write_request(series))
+    assert decoded == [({'__name__': 'up', 'job': 'x'}, 1.0, 1700000000000),
+                       ({'__name__': 'temp', 'sensor': 'ü'}, -2.5, 1)]
+
+
+def test_push_to_stub_receiver(receiver, snapshot, tmp_path):
+    writer = writer_for(snapshot, f'http://127.0.0.1:{receiver.server_port}/api/v1/write', tmp_path)
+    writer.push_once()
+    headers, series = receiver.received[0]
+    assert headers['Content-Encoding'] == 'snappy'
+    assert headers['X-Prometheus-Remote-Write-Version'] == '0.1.0'
+    assert value_of(series, 'test_value') == [
+        ({'__name__': 'test_value', 'instance': 'node1', 'job': 'homelab-exporter', 'name': 'a'}, 1.5)]
+    assert writer.sent == 1 and writer._buffered() == []
+
+
+def test_requests_are_split_by_max_samples_per_send(receiver, snapshot, tmp_path):
+    writer = writer_for(snapshot, f'http://127.0.0.1:{receiver.server_port}/', tmp_path, max_samples_per_send=3)
+    total = sum(len(family.samples) for family in snapshot.families())
+    writer.push_once()
+    assert [len(series) for _, series in receiver.received][:-1] == [3] * (len(receiver.received) - 1)
+    assert sum(len(series) for _, series in receiver.received) == total
+
+
+def test_buffer_and_replay_oldest_first(receiver, snapshot, tmp_path):
+    writer = writer_for(snapshot, f'http://127.0.0.1:{receiver.server_port}/', tmp_path)
+    receiver.status = 503
+    writer.push_once()
+    snapshot.update('test', [exporter.GaugeFamily('test_value', 'A test value', ['name']).set(2, 'a')], 0.1)
+    writer.push_once()
+    assert len(writer._buffered()) == 2 and writer.failed == 2
+
+    receiver.status = 204
+    snapshot.update('test', [exporter.GaugeFamily('test_value', 'A test value', ['name']).set(3, 'a')], 0.1)
+    writer.push_once()
+    assert [value_of(series, 'test_value')[0][1] for _, series in receiver.received] == [1.5, 2, 3]
+    assert writer._buffered() == [] and writer.sent == 3
+
+
+def test_rejected_requests_are_dropped_not_buffered(receiver, snapshot, tmp_path):
+    writer = writer_for(snapshot, f'http://127.0.0.1:{receiver.server_port}/', tmp_path)
+    receiver.status = 400
+    writer.push_once()
+    assert writer.dropped == 1 and writer._buffered() == []
+
+
+def test_buffer_is_capped_by_dropping_the_oldest(snapshot, tmp_path):
+    with socket.socket() as closed:
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+    size = len(writer_for(snapshot, '', tmp_path).requests()[0])
+    writer = writer_for(snapshot, f'http://127.0.0.1:{port}/', tmp_path, max_buffer_bytes=size * 3)
+    for _ in range(5):
+        writer.push_once()
+    buffered = writer._buffered()
+    assert len(buffered) == 3 and writer.dropped == 2
+    assert sum(os.path.getsize(path) for path in buffered) <= size * 3
@@ -0,0 +1,59 @@
+"""CollectorScheduler settings applied on reconfigure"""
+
+import homelab_exporter as exporter
+
+
+def collect():
+    return [exporter.GaugeFamily('test_value', 'A test value').set(1)]
+
+
+def fail():
+    raise RuntimeError('down')
+
+
+def test_reconfigure_applies_pool_and_breaker_settings():
+    scheduler = exporter.CollectorScheduler(exporter.MetricsSnapshot(), {'ok': (collect, 60, 5), 'bad': (fail, 60, 5)})
+    scheduler.run_once('ok')
+    scheduler.run_once('bad')
+    previous = scheduler.executor
+    try:
+        scheduler.reconfigure({'ok': (collect, 60, 5), 'bad': (fail, 30, 5)},
+                              max_workers=2, failure_threshold=1, max_backoff=45)
+        assert scheduler.executor is not previous and scheduler.executor._max_workers == 2
+        breaker = scheduler.breakers['bad']
+        assert (breaker.threshold, breaker.base_backoff, breaker.max_backoff) == (1, 30, 45)
+        # The failure before the reload still counts against the new threshold
+        assert breaker.failures >= 1
+    finally:
+        scheduler.stop()
+
+
+def test_reconfigure_keeps_the_pool_when_max_workers_is_unchanged():
+    scheduler = exporter.CollectorScheduler(exporter.MetricsSnapshot(), {'ok': (collect, 60, 5)}, max_workers=3)
+    # The pool is only created by the first run
+    assert scheduler.executor is None
+    scheduler.run_once('ok')
+    executor = scheduler.executor
+    try:
+        scheduler.reconfigure({'ok': (collect, 60, 5)}, max_workers=3, failure_threshold=5, max_backoff=60)
+        assert scheduler.executor is executor
+        assert scheduler.failure_threshold == 5
+    finally:
+        scheduler.stop()
+
+
+def test_network_speed_errors_serve_the_last_value_as_stale(monkeypatch):
+    monkeypatch.setattr(exporter, 'network_monitor', exporter.NetworkMonitor())
+    snapshot = exporter.MetricsSnapshot()
+    collectors = {'network_speed': (exporter.collect_network_speed_metrics, 60, 5)}
+    scheduler = exporter.CollectorScheduler(snapshot, collectors)
+    assert scheduler.run_once('network_speed') is not None
+
+    def denied(*args, **kwargs):
+        raise PermissionError('denied')
+
+    monkeypatch.setattr(exporter.psutil, 'net_io_counters', denied)
+    assert scheduler.run_once('network_speed') is None
+    families = {family.name: family for family in snapshot.families()}
+    assert 'network_upload_speed_mbps' in families
+    assert families['collector_stale'].samples == [('', (('collector', 'network_speed'),), 1)]
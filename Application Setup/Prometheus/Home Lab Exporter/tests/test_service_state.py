@@ -0,0 +1,88 @@
+"""Restart and flap counting of systemd units and Docker containers"""
+
+import time
+
+import homelab_exporter as exporter
+
+
+def test_restarts_need_running_before():
+    table = exporter.StateTable()
+    table.update('docker.service', 'inactive', False)
+    table.update('docker.service', 'active', True, 100)
+    entry = table.snapshot()['docker.service']
+    # Starting a unit first seen stopped isn't a restart
+    assert entry['restarts'] == 0 and entry['last_transition'] == 100
+
+    table.update('docker.service', 'failed', False, 200)
+    table.update('docker.service', 'activating', False, 201)
+    table.update('docker.service', 'active', True, 202)
+    entry = table.snapshot()['docker.service']
+    assert entry['restarts'] == 1 and entry['last_transition'] == 202 and entry['state'] == 'active'
+
+
+def test_same_run_state_is_not_a_transition():
+    table = exporter.StateTable()
+    table.update('tailscaled.service', 'active', True, 100)
+    table.update('tailscaled.service', 'reloading', True, 150)
+    entry = table.snapshot()['tailscaled.service']
+    assert entry['state'] == 'reloading' and entry['last_transition'] == 100 and entry['restarts'] == 0
+
+
+def test_flapping_clears_after_the_window():
+    table = exporter.StateTable(flap_window=0.2, flap_threshold=2)
+    table.update('caddy', 'running', True)
+    for _ in range(2):
+        table.update('caddy', 'exited', False)
+        table.update('caddy', 'running', True)
+    assert table.snapshot()['caddy']['flapping']
+    time.sleep(0.3)
+    entry = table.snapshot()['caddy']
+    assert not entry['flapping'] and entry['restarts'] == 2
+
+
+def test_retain_forgets_unwatched_entries():
+    table = exporter.StateTable()
+    table.update('a', 'running', True)
+    table.update('b', 'running', True)
+    table.retain(['b'])
+    assert list(table.snapshot()) == ['b']
+
+
+class FakeDocker:
+    def containers(self):
+        return {'immich_server': {'id': 'a', 'state': 'running', 'network_mode': 'bridge'},
+                'immich_redis': {'id': 'b', 'state': 'running', 'network_mode': 'bridge'}}
+
+
+def event(action, name, time_nano):
+    return {'Type': 'container', 'Action': action, 'timeNano': time_nano,
+            'Actor': {'ID': name, 'Attributes': {'name': name}}}
+
+
+def test_container_restarts_roll_up_per_service(monkeypatch):
+    cache = exporter.ContainerStateCache(FakeDocker())
+    cache.table = exporter.StateTable(flap_window=600, flap_threshold=2)
+    monkeypatch.setattr(exporter, 'container_state_cache', cache)
+    cache.sync()
+    for action, stamp in (('die', 1), ('start', 2), ('die', 3), ('restart', 4)):
+        cache.apply_event(event(action, 'immich_redis', stamp * 1_000_000_000))
+    # health_status events don't change the run state
+    cache.apply_event(event('health_status: healthy', 'immich_server', 5_000_000_000))
+
+    services = exporter.export_service_history({'immich': ['immich_server', 'immich_redis', 'immich_postgres'],
+                                                'caddy': ['caddy']})
+    assert services['immich'] == {'last_transition': 4, 'restarts': 2, 'flapping': True}
+    assert services['caddy'] == {'last_transition': None, 'restarts': 0, 'flapping': False}
+
+
+def test_kill_without_die_is_not_an_exit(monkeypatch):
+    cache = exporter.ContainerStateCache(FakeDocker())
+    monkeypatch.setattr(exporter, 'container_state_cache', cache)
+    cache.sync()
+    # docker kill -s HUP, e.g. to reload a config, leaves the container running
+    hup = event('kill', 'immich_redis', 1_000_000_000)
+    hup['Actor']['Attributes']['signal'] = '1'
+    cache.apply_event(hup)
+    assert cache.states()['immich_redis'] == 'running'
+    cache.sync()
+    assert exporter.export_service_history({'immich': ['immich_redis']})['immich']['restarts'] == 0
@@ -0,0 +1,188 @@
+"""Cron schedules, and the speed test worker against stub backends"""
+
+import json
+import os
+import sys
+import textwrap
+import time
+import types
+from collections import deque
+from datetime import datetime
+
+import pytest
+
+import homelab_exporter as exporter
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT = {'download_mbps': 940.1, 'upload_mbps': 35.2, 'server_id': '42', 'server_name': 'stub', 'ping_ms': 4.2}
+
+
+def test_cron_fields():
+    schedule = exporter.CronSchedule('*/15 9-17/4 1,15 * 7')
+    assert schedule.minutes == {0, 15, 30, 45}
+    assert schedule.hours == {9, 13, 17}
+    assert schedule.days == {1, 15}
+    assert schedule.months == set(range(1, 13))
+    # Sunday written as 7 is the same as 0
+    assert schedule.weekdays == {0}
+
+
+@pytest.mark.parametrize('expression', ['bad', '* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '5-1 * * * *',
+                                        '*/0 * * * *', 'x * * * *'])
+def test_invalid_cron_expressions(expression):
+    with pytest.raises(ValueError):
+        exporter.CronSchedule(expression)
+
+
+@pytest.mark.parametrize('expression, now, expected', [
+    ('0 * * * *', datetime(2025, 3, 4, 10, 30, 15), datetime(2025, 3, 4, 11, 0)),
+    # Strictly after: a time on the match goes to the next one
+    ('0 * * * *', datetime(2025, 3, 4, 11, 0), datetime(2025, 3, 4, 12, 0)),
+    ('30 2 * * *', datetime(2025, 12, 31, 23, 59), datetime(2026, 1, 1, 2, 30)),
+    # Friday evening to Monday morning
+    ('*/15 9-17 * * 1-5', datetime(2025, 3, 7, 17, 50), datetime(2025, 3, 10, 9, 0)),
+    # Day of month and day of week both restricted: either one matches, like cron
+    ('0 0 13 * 5', datetime(2025, 3, 1), datetime(2025, 3, 7)),
+    ('0 0 29 2 *', datetime(2025, 1, 1), datetime(2028, 2, 29)),
+])
+def test_next_fire_time(expression, now, expected):
+    assert exporter.CronSchedule(expression).next_after(now) == expected
+
+
+def test_expression_that_never_matches():
+    with pytest.raises(ValueError, match='never matches'):
+        exporter.CronSchedule('0 0 31 2 *').next_after(datetime(2025, 1, 1))
+
+
+def stub_command(body):
+    return [sys.executable, '-c', textwrap.dedent(body)]
+
+
+@pytest.fixture
+def state_file(tmp_path):
+    return str(tmp_path / 'lib' / 'speedtest.json')
+
+
+def worker(state_file, body, **kwargs):
+    return exporter.SpeedtestWorker(jitter=0, state_file=state_file, command=stub_command(body), **kwargs)
+
+
+def families_of(worker):
+    return {family.name: family.samples for family in worker.metric_families()}
+
+
+def test_result_is_persisted_and_served_after_a_restart(state_file):
+    first = worker(state_file, f'import json; print(json.dumps({RESULT!r}))')
+    assert first.metric_families() == []
+    result = first.run_once()
+    assert result['success'] and result['download_mbps'] == 940.1
+
+    with open(state_file) as f:
+        assert json.load(f)[0]['server_name'] == 'stub'
+    # Nothing is read until the worker is started
+    restarted = worker(state_file, 'raise SystemExit(1)')
+    assert restarted.metric_families() == []
+    restarted.start()
+    restarted.stop()
+    families = families_of(restarted)
+    assert families['internet_download_speed_mbps'] == [('', (), 940.1)]
+    assert families['speedtest_server_info'] == [('', (('server_id', '42'), ('server_name', 'stub')), 1)]
+
+
+def test_failed_run_reads_zero_but_keeps_the_last_success(state_file):
+    worker(state_file, f'import json; print(json.dumps({RESULT!r}))').run_once()
+    failing = worker(state_file, 'import sys; print("no internet", file=sys.stderr); sys.exit(1)')
+    result = failing.run_once()
+    assert not result['success'] and result['download_mbps'] == 0
+    families = families_of(failing)
+    assert families['speedtest_last_run_success'] == [('', (), 0)]
+    assert families['internet_download_speed_mbps'] == [('', (), 0)]
+    assert families['speedtest_ping_ms'] == [('', (), 4.2)]
+
+
+def test_subprocess_timeout(state_file):
+    slow = worker(state_file, 'import time; time.sleep(30)', timeout=0.5)
+    started = time.monotonic()
+    result = slow.run_once()
+    assert not result['success'] and time.monotonic() - started < 5
+    assert exporter.self_profiler.subprocess_failures['speedtest'] >= 1
+
+
+def test_garbage_output_and_state_file(state_file):
+    assert not worker(state_file, 'print("not json")').run_once()['success']
+    with open(state_file, 'w') as f:
+        f.write('{truncated')
+    garbage = worker(state_file, 'pass')
+    garbage.load()
+    assert garbage.results == deque()
+
+
+def test_history_is_capped(state_file):
+    capped = worker(state_file, f'import json; print(json.dumps({RESULT!r}))', history=2)
+    for _ in range(3):
+        capped.run_once()
+    restarted = worker(state_file, 'pass', history=24)
+    restarted.load()
+    assert len(restarted.results) == 2
+
+
+def test_next_run_respects_the_minimum_gap(state_file):
+    scheduled = worker(state_file, 'pass', schedule='*/5 * * * *', min_gap=1800)
+    now = datetime(2025, 3, 4, 10, 2).timestamp()
+    assert scheduled.next_run_time(now) == datetime(2025, 3, 4, 10, 5).timestamp()
+    scheduled.results.append({'timestamp': now})
+    assert scheduled.next_run_time(now) == datetime(2025, 3, 4, 10, 35).timestamp()
+
+
+@pytest.fixture
+def stub_speedtest(monkeypatch):
+    """A speedtest module standing in for speedtest-cli"""
+    module = types.ModuleType('speedtest')
+
+    class Speedtest:
+        def __init__(self, timeout):
+            pass
+
+        def get_best_server(self):
+            return {'id': 7, 'sponsor': 'Stub ISP', 'latency': 3.456}
+
+        def download(self):
+            return 500_000_000
+
+        def upload(self):
+            if module.fail:
+                raise OSError('upload failed')
+            return 50_000_000
+
+    module.Speedtest = Speedtest
+    module.fail = False
+    monkeypatch.setitem(sys.modules, 'speedtest', module)
+    return module
+
+
+def test_speedtest_backend(stub_speedtest, capsys):
+    assert exporter.speedtest_main() == 0
+    assert json.loads(capsys.readouterr().out) == {'download_mbps': 500.0, 'upload_mbps': 50.0, 'server_id': '7',
+                                                   'server_name': 'Stub ISP', 'ping_ms': 3.46}
+    stub_speedtest.fail = True
+    assert exporter.speedtest_main() == 1
+    assert 'upload failed' in capsys.readouterr().err
+
+
+def test_worker_runs_the_exporter_in_speedtest_mode(tmp_path, monkeypatch, state_file):
+    (tmp_path / 'speedtest.py').write_text(textwrap.dedent('''
+        class Speedtest:
+            def __init__(self, timeout):
+                pass
+            def get_best_server(self):
+                return {'id': 1, 'sponsor': 'Subprocess stub', 'latency': 1}
+            def download(self):
+                return 100_000_000
+            def upload(self):
+                return 10_000_000
+    '''))
+    monkeypatch.setenv('PYTHONPATH', f"{tmp_path}{os.pathsep}{os.environ.get('PYTHONPATH', '')}")
+    default = exporter.SpeedtestWorker(state_file=state_file, timeout=60)
+    assert default.command[1:] == [os.path.join(HERE, 'homelab_exporter.py'), '--speedtest']
+    result = default.run_once()
+    assert result['success'] and result['server_name'] == 'Subprocess stub' and result['download_mbps'] == 100.0
@@ -0,0 +1,31 @@
+"""Importing the exporter (as the speed test subprocess does) stays cheap"""
+
+import os
+import subprocess
+import sys
+
+import homelab_exporter as exporter
+
+CHECK = '''
+import sys, threading
+import homelab_exporter as exporter
+print(sorted(name for name in ('asyncio', 'ctypes', 'gzip') if name in sys.modules))
+print(threading.active_count())
+print(exporter.collector_scheduler.executor, exporter.peer_federation.executor)
+print(exporter.app_disk_engine.hints, exporter.cpu_monitor.last_times)
+'''
+
+
+def test_import_loads_nothing_up_front(tmp_path):
+    # A fresh interpreter, since the test session itself has long imported everything
+    completed = subprocess.run([sys.executable, '-c', CHECK], capture_output=True, text=True, timeout=60,
+                               cwd=str(tmp_path), env=dict(os.environ, PYTHONPATH=os.path.dirname(exporter.__file__)))
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.split('\n')[:4] == ['[]', '1', 'None None', 'None None']
+
+
+def test_cpu_monitor_reads_zero_until_primed():
+    monitor = exporter.CpuMonitor()
+    assert monitor.sample() == (0, {}, {})
+    monitor.prime()
+    assert monitor.last_times is not None
@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+"""Incremental, content-addressed backups of /srv/<app> with a short container downtime window
+
+Layout under /srv/backups/<app>:
+    objects/ab/<sha256>[.gz]       file contents, gzip-compressed unless already compressed
+    snapshots/<timestamp>.json.gz  one manifest per backup (paths, metadata, content hash)
+    index.json                     path -> size, mtime, inode and hash from the last backup
+
+A backup first copies the app's data while it is still running, then stops its
+containers and re-reads only the files whose size, mtime or inode changed since
+that pass. The app is down for the delta instead of for a full tar of its data.
+Results are written to a status file that the Home Lab Exporter reports on.
+"""
+
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import BoundedSemaphore, Lock
+
+SRV_ROOT = '/srv'
+BACKUP_ROOT = '/srv/backups'
+COMPOSE_ROOT = '/home/kscheuer/docker'
+# Read by the exporter's backups collector
+STATUS_FILE = '/var/lib/homelab_backup/status.json'
+
+
+def setup_logging():
+    """Log to the console and to syslog (tag homelab-backup) like the old script's logger calls"""
+    logger = logging.getLogger('homelab_backup')
+    logger.setLevel(logging.INFO)
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(console)
+    # SysLogHandler only fails on the first message when there is no syslog socket
+    if os.path.exists('/dev/log'):
+        syslog = logging.handlers.SysLogHandler(address='/dev/log')
+        syslog.setFormatter(logging.Formatter('homelab-backup: %(levelname)s - %(message)s'))
+        logger.addHandler(syslog)
+    return logger
+
+
+class IOBudget:
+    """Token bucket shared by every reader, capping read throughput at rate bytes/s (0 = unlimited)"""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._available = rate
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(self.rate, self._available + (now - self._updated) * self.rate)
+            self._updated = now
+            self._available -= size
+            wait = -self._available / self.rate if self._available < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+# Budget used while an app is stopped, where finishing quickly matters more than sharing the disk
+UNLIMITED = IOBudget(0)
+
+
+class ObjectStore:
+    """Content-addressed file store, one object per distinct file content"""
+
+    CHUNK_SIZE = 1 << 20
+    # Formats that are already compressed, gzipping them again costs CPU for nothing
+    STORED_RAW = frozenset({
+        '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif', '.mp4', '.mov', '.mkv', '.avi',
+        '.webm', '.mp3', '.m4a', '.aac', '.flac', '.ogg', '.opus', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip',
+        '.7z', '.rar', '.pdf', '.docx', '.xlsx', '.pptx',
+    })
+
+    def __init__(self, root, level=6):
+        self.root = root
+        self.level = level
+        self.tmp_dir = os.path.join(root, 'tmp')
+
+    def path(self, name) -> str:
+        return os.path.join(self.root, name[:2], name)
+
+    def exists(self, digest):
+        """Return the stored object name for a content hash, or None"""
+        for name in (digest, f'{digest}.gz'):
+            if os.path.exists(self.path(name)):
+                return name
+        return None
+
+    def put(self, source, budget) -> tuple:
+        """Hash and store a file in one read, returns (object name, bytes written)"""
+        raw = os.path.splitext(source)[1].lower() in self.STORED_RAW
+        # wbits 31 writes a gzip wrapper, so objects can also be read with plain zcat
+        compressor = None if raw else zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        hasher = hashlib.sha256()
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp = os.path.join(self.tmp_dir, f'{os.getpid()}-{id(hasher)}')
+        try:
+            with open(source, 'rb') as f, open(tmp, 'wb') as out:
+                while True:
+                    chunk = f.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    budget.consume(len(chunk))
+                    hasher.update(chunk)
+                    out.write(compressor.compress(chunk) if compressor else chunk)
+                if compressor:
+                    out.write(compressor.flush())
+
+            digest = hasher.hexdigest()
+            existing = self.exists(digest)
+            if existing:
+                os.remove(tmp)
+                return existing, 0
+            name = digest if raw else f'{digest}.gz'
+            os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+            written = os.path.getsize(tmp)
+            os.replace(tmp, self.path(name))
+            return name, written
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def open(self, name):
+        """Open an object for reading its original content"""
+        path = self.path(name)
+        return gzip.open(path, 'rb') if name.endswith('.gz') else open(path, 'rb')
+
+    def names(self):
+        """Yield every stored object name"""
+        try:
+            prefixes = os.listdir(self.root)
+        except FileNotFoundError:
+            # Nothing stored yet, e.g. an app with only empty directories
+            return
+        for prefix in prefixes:
+            directory = os.path.join(self.root, prefix)
+            if prefix != 'tmp' and os.path.isdir(directory):
+                yield from os.listdir(directory)
+
+    def remove(self, name) -> int:
+        path = self.path(name)
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+
+
+class AppBackup:
+    """Backs up one app directory into its own object store, snapshots and index
+
+    The running pass reads through pool, shared with other apps and throttled. The
+    stopped pass reads through stopped_pool so it never queues behind that work.
+    """
+
+    # Files queued on a pool per scan, so a tree full of changed files isn't queued all at once
+    MAX_PENDING = 256
+
+    def __init__(self, app, pool, srv_root=SRV_ROOT, backup_root=BACKUP_ROOT, compose_root=COMPOSE_ROOT, level=6,
+                 stopped_pool=None):
+        self.app = app
+        self.pool = pool
+        self.stopped_pool = stopped_pool or pool
+        self.source = os.path.join(srv_root, app)
+        self.compose_dir = os.path.join(compose_root, app)
+        self.dest = os.path.join(backup_root, app)
+        self.snapshot_dir = os.path.join(self.dest, 'snapshots')
+        self.index_file = os.path.join(self.dest, 'index.json')
+        self.store = ObjectStore(os.path.join(self.dest, 'objects'), level)
+        self.logger = logging.getLogger('homelab_backup')
+        self.index = {}  # relative path -> [size, mtime_ns, inode, object name]
+        self.stored_bytes = 0
+        self._lock = Lock()
+
+    def load_index(self):
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+        # An object removed by hand would otherwise be trusted forever
+        self.index = {path: entry for path, entry in self.index.items() if os.path.exists(self.store.path(entry[3]))}
+
+    def save_index(self):
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_file)
+
+    def _store_file(self, relative, path, st, budget):
+        """Store one file and index it if it didn't change while being read"""
+        name, written = self.store.put(path, budget)
+        after = os.lstat(path)
+        with self._lock:
+            self.stored_bytes += written
+            if (after.st_size, after.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                self.index[relative] = [st.st_size, st.st_mtime_ns, st.st_ino, name]
+            else:
+                # Written to while running, the stopped pass will read it again
+                self.index.pop(relative, None)
+        return name
+
+    def scan(self, budget, pool=None) -> list:
+        """Walk the app directory, storing new and changed files on pool, and return the snapshot entries
+
+        Entries are [path, type, mode, uid, gid, mtime_ns, size, object name or link target].
+        """
+        pool = pool or self.pool
+        slots = BoundedSemaphore(self.MAX_PENDING)
+        entries = []
+        pending = []
+        stack = ['']
+        while stack:
+            relative_dir = stack.pop()
+            try:
+                it = os.scandir(os.path.join(self.source, relative_dir))
+            except FileNotFoundError:
+                # Removed while the app was running
+                continue
+            with it:
+                for entry in it:
+                    relative = os.path.join(relative_dir, entry.name)
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        target = os.readlink(entry.path) if stat.S_ISLNK(st.st_mode) else None
+                    except FileNotFoundError:
+                        continue
+                    meta = [relative, None, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid, st.st_mtime_ns, 0, None]
+                    if stat.S_ISDIR(st.st_mode):
+                        meta[1] = 'dir'
+                        stack.append(relative)
+                    elif stat.S_ISLNK(st.st_mode):
+                        meta[1] = 'symlink'
+                        meta[7] = target
+                    elif stat.S_ISREG(st.st_mode):
+                        meta[1] = 'file'
+                        meta[6] = st.st_size
+                        known = self.index.get(relative)
+                        if known and known[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+                            meta[7] = known[3]
+                        else:
+                            # Wait for a queued file to finish before walking further ahead of the pool
+                            slots.acquire()
+                            future = pool.submit(self._store_file, relative, entry.path, st, budget)
+                            future.add_done_callback(lambda _: slots.release())
+                            pending.append((meta, future))
+                    else:
+                        # Sockets, fifos and devices have no content to back up
+                        continue
+                    entries.append(meta)
+
+        for meta, future in pending:
+            try:
+                meta[7] = future.result()
+            except FileNotFoundError:
+                # Deleted while the app was running
+                entries.remove(meta)
+        return entries
+
+    def compose(self, action):
+        self.logger.info(f"{self.app}: docker compose {action}")
+        subprocess.run(['docker', 'compose', action], cwd=self.compose_dir, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    def write_snapshot(self, entries, created) -> str:
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = os.path.join(self.snapshot_dir, f"{created.strftime('%Y-%m-%dT%H%M%S')}.json.gz")
+        with gzip.open(path + '.tmp', 'wt') as f:
+            json.dump({'app': self.app, 'created': created.isoformat(), 'entries': entries}, f)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def snapshots(self) -> list:
+        """Return snapshot paths, oldest first"""
+        try:
+            names = os.listdir(self.snapshot_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(self.snapshot_dir, name) for name in names if name.endswith('.json.gz'))
+
+    @staticmethod
+    def read_snapshot(path) -> dict:
+        with gzip.open(path, 'rt') as f:
+            return json.load(f)
+
+    def prune(self, retention_days, keep=1):
+        """Remove snapshots older than retention_days (always keeping the newest keep) and unreferenced objects"""
+        cutoff = datetime.now() - timedelta(days=retention_days)
+        snapshots = self.snapshots()
+        for path in snapshots[:-max(keep, 1)]:
+            created = datetime.strptime(os.path.basename(path)[:-len('.json.gz')], '%Y-%m-%dT%H%M%S')
+            if created < cutoff:
+                self.logger.info(f"{self.app}: removing expired snapshot {os.path.basename(path)}")
+                os.remove(path)
+
+        referenced = set()
+        for path in self.snapshots():
+            referenced.update(entry[7] for entry in self.read_snapshot(path)['entries'] if entry[1] == 'file')
+        freed = sum(self.store.remove(name) for name in list(self.store.names()) if name not in referenced)
+        self.index = {path: entry for path, entry in self.index.items() if entry[3] in referenced}
+        if freed:
+            self.logger.info(f"{self.app}: freed {freed} bytes of unreferenced objects")
+
+    def run(self, budget, retention_days, stop=True, min_free_bytes=1 << 30, keep=1) -> dict:
+        """Back up the app and return the result recorded in the status file"""
+        started = time.time()
+        if not os.path.isdir(self.source):
+            raise FileNotFoundError(f"App data directory not found: {self.source}")
+        if stop and not os.path.isdir(self.compose_dir):
+            raise FileNotFoundError(f"Docker compose directory not found: {self.compose_dir}")
+        os.makedirs(self.dest, exist_ok=True)
+
+        with open(os.path.join(self.dest, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError(f"Another backup of {self.app} is running")
+
+            free = shutil.disk_usage(self.dest).free
+            if free < min_free_bytes:
+                raise OSError(f"Only {free} bytes free in {self.dest}")
+
+            self.load_index()
+            # Copy everything while the app is still up, throttled so it doesn't starve the app's own I/O
+            self.logger.info(f"{self.app}: copying changed files while running")
+            entries = self.scan(budget)
+
+            downtime = 0.0
+            if stop:
+                self.compose('stop')
+                stopped = time.monotonic()
+                try:
+                    # Only files changed since the running pass are read again, at full speed on a pool
+                    # of their own, so they don't wait behind other apps' throttled running passes
+                    entries = self.scan(UNLIMITED, self.stopped_pool)
+                finally:
+                    self.compose('start')
+                    downtime = time.monotonic() - stopped
+                self.logger.info(f"{self.app}: back up after {downtime:.1f}s of downtime")
+
+            snapshot = self.write_snapshot(entries, datetime.now())
+            self.prune(retention_days, keep)
+            self.save_index()
+
+        files = [entry for entry in entries if entry[1] == 'file']
+        result = {
+            'success': True,
+            'timestamp': started,
+            'duration_seconds': round(time.time() - started, 3),
+            'downtime_seconds': round(downtime, 3),
+            'bytes': sum(entry[6] for entry in files),
+            'files': len(files),
+            'stored_bytes': self.stored_bytes,
+            'snapshot': os.path.basename(snapshot),
+        }
+        self.logger.info(f"{self.app}: backup completed, {result['files']} files ({result['bytes']} bytes), "
+                         f"{result['stored_bytes']} new bytes stored in {result['duration_seconds']}s")
+        return result
+
+    def restore(self, snapshot, target):
+        """Recreate a snapshot's files, links and metadata under target"""
+        entries = self.read_snapshot(snapshot)['entries']
+        os.makedirs(target, exist_ok=True)
+        for relative, kind, mode, uid, gid, mtime_ns, size, data in entries:
+            path = os.path.join(target, relative)
+            # Restoring over an existing tree: replace links and files rather than writing through a link
+            if kind != 'dir' and (os.path.islink(path) or os.path.isfile(path)):
+                os.unlink(path)
+            if kind == 'dir':
+                os.makedirs(path, exist_ok=True)
+            elif kind == 'symlink':
+                os.symlink(data, path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with self.store.open(data) as src, open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, ObjectStore.CHUNK_SIZE)
+        # Metadata last and deepest first, so writing children doesn't reset directory mtimes
+        for relative, kind, mode, uid, gid, mtime_ns, size, data in sorted(entries, key=lambda e: e[0],
+                                                                            reverse=True):
+            path = os.path.join(target, relative)
+            if os.geteuid() == 0:
+                os.lchown(path, uid, gid)
+            if kind != 'symlink':
+                os.chmod(path, mode)
+                os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def update_status(status_file, app, result):
+    """Merge one app's result into the shared status file, keeping its last success on failure"""
+    os.makedirs(os.path.dirname(status_file), exist_ok=True)
+    with open(status_file + '.lock', 'w') as lock:
+        # Several cron jobs may finish at the same time
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(status_file) as f:
+                status = json.load(f)
+        except (FileNotFoundError, ValueError):
+            status = {}
+        previous = status.get(app, {})
+        if result['success']:
+            result['last_success_timestamp'] = result['timestamp'] + result['duration_seconds']
+        else:
+            result = dict(previous, success=False, timestamp=result['timestamp'])
+        status[app] = result
+        tmp = status_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, status_file)
+
+
+def run_backups(args) -> int:
+    logger = logging.getLogger('homelab_backup')
+    budget = IOBudget(int(args.io_limit * (1 << 20)))
+    failed = 0
+    # One pool of compression workers is shared by every app's running pass, so the cores stay busy but not
+    # oversubscribed. Passes with the containers stopped get their own unthrottled pool and never wait behind it.
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, \
+            ThreadPoolExecutor(max_workers=args.workers) as stopped_pool, \
+            ThreadPoolExecutor(max_workers=args.jobs) as apps:
+        backups = {app: AppBackup(app, pool, args.srv_root, args.backup_root, args.compose_root, args.level,
+                                  stopped_pool)
+                   for app in args.apps}
+        futures = {app: apps.submit(backup.run, budget, args.retention_days, not args.no_stop,
+                                    int(args.min_free_gb * (1 << 30)), args.keep)
+                   for app, backup in backups.items()}
+        for app, future in futures.items():
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"{app}: backup failed: {e}")
+                result = {'success': False, 'timestamp': time.time()}
+                failed += 1
+            update_status(args.status_file, app, result)
+    return 1 if failed else 0
+
+
+def restore_backup(args) -> int:
+    backup = AppBackup(args.app, None, backup_root=args.backup_root)
+    snapshots = backup.snapshots()
+    if not snapshots:
+        print(f"No snapshots for {args.app}", file=sys.stderr)
+        return 1
+    if args.snapshot == 'latest':
+        snapshot = snapshots[-1]
+    else:
+        snapshot = os.path.join(backup.snapshot_dir, args.snapshot)
+        if not snapshot.endswith('.json.gz'):
+            snapshot += '.json.gz'
+    backup.restore(snapshot, args.target)
+    print(f"Restored {os.path.basename(snapshot)} to {args.target}")
+    return 0
+
+
+def list_snapshots(args) -> int:
+    backup = AppBackup(args.app, None, backup_root=args.backup_root)
+    for path in backup.snapshots():
+        files = [entry for entry in backup.read_snapshot(path)['entries'] if entry[1] == 'file']
+        print(f"{os.path.basename(path)[:-len('.json.gz')]}  {len(files)} files  {sum(e[6] for e in files)} bytes")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental backups of /srv/<app> with short downtime')
+    parser.add_argument('--backup-root', default=BACKUP_ROOT)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Back up one or more apps concurrently')
+    run.add_argument('apps', nargs='+')
+    run.add_argument('--retention-days', type=int, default=14)
+    run.add_argument('--keep', type=int, default=1, help='Snapshots kept regardless of age')
+    run.add_argument('--jobs', type=int, default=2, help='Apps backed up at the same time')
+    run.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Parallel hashing/compression')
+    run.add_argument('--io-limit', type=float, default=100, help='Read MB/s while apps are running (0 = no limit)')
+    run.add_argument('--level', type=int, default=6, help='gzip compression level')
+    run.add_argument('--min-free-gb', type=float, default=1)
+    run.add_argument('--no-stop', action='store_true', help="Don't stop the app's containers")
+    run.add_argument('--srv-root', default=SRV_ROOT)
+    run.add_argument('--compose-root', default=COMPOSE_ROOT)
+    run.add_argument('--status-file', default=STATUS_FILE)
+    run.set_defaults(func=run_backups)
+
+    restore = commands.add_parser('restore', help='Restore a snapshot into a directory')
+    restore.add_argument('app')
+    restore.add_argument('snapshot', help="Snapshot name from 'list', or latest")
+    restore.add_argument('target')
+    restore.set_defaults(func=restore_backup)
+
+    snapshots = commands.add_parser('list', help="List an app's snapshots")
+    snapshots.add_argument('app')
+    snapshots.set_defaults(func=list_snapshots)
+
+    args = parser.parse_args()
+    setup_logging()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
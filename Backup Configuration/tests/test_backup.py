@@ -0,0 +1,158 @@
+"""Backups of a tmp_path app tree with the containers left running"""
+
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+import backup
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backup.py')
+
+
+@pytest.fixture
+def roots(tmp_path):
+    srv = tmp_path / 'srv'
+    app = srv / 'vaultwarden'
+    (app / 'data' / 'attachments').mkdir(parents=True)
+    (app / 'empty').mkdir()
+    (app / 'config.json').write_text('{"signups": false}\n')
+    (app / 'data' / 'db.sqlite3').write_bytes(os.urandom(3 << 20))
+    (app / 'data' / 'attachments' / 'photo.jpg').write_bytes(os.urandom(4096))
+    # Same content twice is stored once
+    (app / 'data' / 'attachments' / 'copy.jpg').write_bytes((app / 'data' / 'attachments' / 'photo.jpg').read_bytes())
+    os.symlink('data/db.sqlite3', app / 'current.db')
+    os.chmod(app / 'config.json', 0o600)
+    return srv, tmp_path / 'backups'
+
+
+@pytest.fixture
+def pool():
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        yield pool
+
+
+def run(srv, backups, pool, retention_days=14, keep=1):
+    app = backup.AppBackup('vaultwarden', pool, str(srv), str(backups), str(srv.parent / 'compose'))
+    return app, app.run(backup.IOBudget(0), retention_days, stop=False, min_free_bytes=0, keep=keep)
+
+
+def age_snapshot(app, result, days):
+    """Rename a snapshot as if it had been taken days ago"""
+    created = datetime.now() - timedelta(days=days)
+    path = os.path.join(app.snapshot_dir, f"{created.strftime('%Y-%m-%dT%H%M%S')}.json.gz")
+    os.replace(os.path.join(app.snapshot_dir, result['snapshot']), path)
+    return path
+
+
+def files_of(snapshot):
+    return {entry[0]: entry[7] for entry in backup.AppBackup.read_snapshot(snapshot)['entries'] if entry[1] == 'file'}
+
+
+def test_incremental_pass_reuses_unchanged_objects(roots, pool):
+    srv, backups = roots
+    app, first = run(srv, backups, pool)
+    assert first['success'] and first['files'] == 4
+    objects = set(app.store.names())
+    assert len(objects) == 3
+    assert any(name.endswith('.gz') for name in objects) and any(not name.endswith('.gz') for name in objects)
+    before = files_of(app.snapshots()[-1])
+    age_snapshot(app, first, 1)
+
+    (srv / 'vaultwarden' / 'config.json').write_text('{"signups": true}\n')
+    (srv / 'vaultwarden' / 'data' / 'new.txt').write_text('new\n')
+    app, second = run(srv, backups, pool)
+    after = files_of(app.snapshots()[-1])
+    # Only the changed and the new file were read and stored
+    assert second['stored_bytes'] < 1024
+    assert after['data/db.sqlite3'] == before['data/db.sqlite3']
+    assert after['data/attachments/photo.jpg'] == before['data/attachments/photo.jpg'] == \
+        after['data/attachments/copy.jpg']
+    assert after['config.json'] != before['config.json']
+    assert set(app.store.names()) == objects | {after['config.json'], after['data/new.txt']}
+
+
+def assert_same_tree(source, target):
+    for root, dirs, files in os.walk(source):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            restored = os.path.join(target, os.path.relpath(path, source))
+            if os.path.islink(path):
+                assert os.readlink(restored) == os.readlink(path)
+                continue
+            st, restored_st = os.stat(path), os.stat(restored)
+            assert (restored_st.st_mode, restored_st.st_mtime_ns) == (st.st_mode, st.st_mtime_ns)
+            if os.path.isfile(path):
+                with open(path, 'rb') as a, open(restored, 'rb') as b:
+                    assert a.read() == b.read()
+
+
+def test_restore_round_trip_and_over_an_existing_tree(roots, pool, tmp_path):
+    srv, backups = roots
+    app, _ = run(srv, backups, pool)
+    target = tmp_path / 'restore'
+    app.restore(app.snapshots()[-1], str(target))
+    assert_same_tree(str(srv / 'vaultwarden'), str(target))
+
+    # Restoring again replaces the links and files already there, even a link swapped in for a file
+    (target / 'config.json').unlink()
+    os.symlink('/etc/hostname', target / 'config.json')
+    app.restore(app.snapshots()[-1], str(target))
+    assert_same_tree(str(srv / 'vaultwarden'), str(target))
+
+
+def test_prune_keeps_generations_and_frees_unreferenced_objects(roots, pool):
+    srv, backups = roots
+    config = srv / 'vaultwarden' / 'config.json'
+    generations = []
+    for days in (40, 30, 20):
+        config.write_text(f'{{"generation": {days}}}\n')
+        app, result = run(srv, backups, pool)
+        generations.append(files_of(age_snapshot(app, result, days))['config.json'])
+
+    config.write_text('{"generation": 0}\n')
+    app, _ = run(srv, backups, pool, keep=2)
+    # Everything is past retention, but the two newest generations stay
+    assert len(app.snapshots()) == 2
+    assert files_of(app.snapshots()[0])['config.json'] == generations[2]
+    names = set(app.store.names())
+    assert generations[2] in names and generations[0] not in names and generations[1] not in names
+
+    app, _ = run(srv, backups, pool)
+    assert len(app.snapshots()) == 1 and generations[2] not in set(app.store.names())
+
+
+def test_app_with_only_empty_directories(tmp_path, pool):
+    (tmp_path / 'srv' / 'caddy' / 'config').mkdir(parents=True)
+    app = backup.AppBackup('caddy', pool, str(tmp_path / 'srv'), str(tmp_path / 'backups'))
+    result = app.run(backup.IOBudget(0), 14, stop=False, min_free_bytes=0)
+    assert result['files'] == 0 and list(app.store.names()) == []
+
+
+def test_io_budget_throttles_reads():
+    budget = backup.IOBudget(1 << 20)
+    started = datetime.now()
+    for _ in range(3):
+        budget.consume(1 << 20)
+    assert datetime.now() - started >= timedelta(seconds=1.9)
+
+
+def test_command_line_with_no_stop(roots, tmp_path):
+    srv, backups = roots
+    status = tmp_path / 'status.json'
+    common = [sys.executable, SCRIPT, '--backup-root', str(backups)]
+    subprocess.run(common + ['run', 'vaultwarden', '--no-stop', '--srv-root', str(srv), '--status-file', str(status),
+                             '--min-free-gb', '0', '--workers', '2'], check=True, capture_output=True)
+    result = json.loads(status.read_text())['vaultwarden']
+    assert result['success'] and result['files'] == 4 and result['downtime_seconds'] == 0
+    assert result['last_success_timestamp'] >= result['timestamp']
+
+    listing = subprocess.run(common + ['list', 'vaultwarden'], check=True, capture_output=True, text=True).stdout
+    assert '4 files' in listing
+    target = tmp_path / 'restore'
+    subprocess.run(common + ['restore', 'vaultwarden', 'latest', str(target)], check=True, capture_output=True)
+    assert_same_tree(str(srv / 'vaultwarden'), str(target))